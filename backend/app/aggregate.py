@@ -0,0 +1,113 @@
+from sqlalchemy import select
+from .database import SessionLocal
+from .models import Session as SessionModel, Screenshot
+from .grids import load_grid, encode_grid, decode_grid, grid_shape, GRID_WIDTH, GRID_HEIGHT, GRID_SCALE
+from .cache import heatmap_cache, cache_key
+from .jobs import window_grid
+import os
+import struct
+import zlib
+import numpy as np
+
+# Cross-session heatmaps are a map-reduce over per-session count grids: sessions are split
+# into chunks of AGGREGATE_CHUNK, each chunk's grids are summed on the analytics pool, and
+# the chunk sums are added up. Chunk sums are cached by their sessions' data versions, so a
+# new or updated session only costs re-reducing its own chunk.
+AGGREGATE_CHUNK = int(os.environ.get("HEATGAZE_AGGREGATE_CHUNK", "32"))
+
+# Upper bound on sessions in one aggregate
+AGGREGATE_MAX_SESSIONS = int(os.environ.get("HEATGAZE_AGGREGATE_MAX_SESSIONS", "5000"))
+
+# global: every sample weighs the same; session: every session weighs the same
+NORMALIZATIONS = ("global", "session")
+
+_HEADER = struct.Struct("<QQ")  # points, sessions
+
+def select_sessions(db, user_id, kind, start_date=None, end_date=None, url=None, session_ids=None):
+    """
+    (id, data_version) of the user's sessions with samples of one kind, recorded
+    (created) between start_date and end_date, that showed url, ordered by id
+    """
+    count = SessionModel.gaze_count if kind == "gaze" else SessionModel.cursor_count
+    query = select(SessionModel.id, SessionModel.data_version).where(
+        SessionModel.user_id == user_id, count > 0
+    )
+    if start_date is not None:
+        query = query.where(SessionModel.created_at >= start_date)
+    if end_date is not None:
+        query = query.where(SessionModel.created_at <= end_date)
+    if url:
+        query = query.where(SessionModel.id.in_(select(Screenshot.session_id).where(Screenshot.url == url)))
+    if session_ids:
+        query = query.where(SessionModel.id.in_(session_ids))
+    return [(row.id, row.data_version or 0) for row in db.execute(query.order_by(SessionModel.id))]
+
+def chunk_sessions(sessions, size=AGGREGATE_CHUNK):
+    """Split the id-ordered session list into map tasks; new sessions only touch the last chunk"""
+    size = max(1, size)
+    return [sessions[i:i + size] for i in range(0, len(sessions), size)]
+
+def session_partial(db, session_id, version, kind, url=None):
+    """
+    A session's count grid and point count, limited to the periods url was on screen.
+    Unfiltered grids are the persisted per-session grids; url-filtered ones are cached.
+    """
+    if not url:
+        return load_grid(db, session_id, kind)
+
+    key = cache_key("url_grid", session_id, version, kind, url, GRID_WIDTH, GRID_HEIGHT, GRID_SCALE)
+    data = heatmap_cache.get_bytes(key)
+    if data is not None:
+        total, _ = _HEADER.unpack_from(data)
+        return decode_grid(data[_HEADER.size:], grid_shape()), total
+
+    counts, total = window_grid(db, session_id, kind, url=url)
+    heatmap_cache.put_bytes(key, _HEADER.pack(total, 1) + encode_grid(counts))
+    return counts, total
+
+def _chunk_key(chunk, kind, url, normalize):
+    return cache_key("aggregate_chunk", kind, url or "", normalize, GRID_WIDTH, GRID_HEIGHT, GRID_SCALE,
+                     *(f"{session_id}:{version}" for session_id, version in chunk))
+
+def reduce_chunk(chunk, kind, url=None, normalize="global"):
+    """
+    Map step: sum the grids of one chunk of (session id, data version) pairs.
+    Runs on the analytics pool with its own database session. Returns (grid, points, sessions).
+    """
+    key = _chunk_key(chunk, kind, url, normalize)
+    data = heatmap_cache.get_bytes(key)
+    if data is not None:
+        points, used = _HEADER.unpack_from(data)
+        grid = np.frombuffer(zlib.decompress(data[_HEADER.size:]), dtype="<f8").reshape(grid_shape()).copy()
+        return grid, points, used
+
+    grid = np.zeros(grid_shape(), dtype=np.float64)
+    points = 0
+    used = 0
+    db = SessionLocal()
+    try:
+        for session_id, version in chunk:
+            counts, counted = session_partial(db, session_id, version, kind, url)
+            if not counted:
+                continue
+            if normalize == "session":
+                counts /= counted
+            grid += counts
+            points += counted
+            used += 1
+    finally:
+        db.close()
+
+    heatmap_cache.put_bytes(key, _HEADER.pack(points, used) + zlib.compress(grid.astype("<f8").tobytes(), 1))
+    return grid, points, used
+
+def combine(partials):
+    """Reduce step: add up the chunk sums from reduce_chunk"""
+    grid = np.zeros(grid_shape(), dtype=np.float64)
+    points = 0
+    used = 0
+    for partial_grid, partial_points, partial_used in partials:
+        grid += partial_grid
+        points += partial_points
+        used += partial_used
+    return grid, points, used
@@ -0,0 +1,66 @@
+from sqlalchemy import select, insert, delete
+from .models import DensityBacklog
+from .ingest import SampleBatch, concat_batches
+import zlib
+import numpy as np
+
+# The ingest transaction only records each batch here (one small insert). Folding the backlog
+# into the session's ~2 MB compressed count grid and its time bucket grids happens once per
+# heatmap or timeline read, for everything written since the last one, instead of once per
+# batch while the SQLite write lock is held.
+
+def encode_backlog(batch, chunked=False):
+    """
+    Timestamps and coordinates as float64 columns, zlib compressed. With chunked, coordinates
+    are rounded to float32 the way sample chunks store them, so the grid counts exactly what
+    a rebuild from storage would.
+    """
+    x, y = batch.x, batch.y
+    if chunked:
+        x = np.asarray(x).astype(np.float32).astype(np.float64)
+        y = np.asarray(y).astype(np.float32).astype(np.float64)
+    return zlib.compress(np.stack([batch.timestamps, x, y]).astype("<f8").tobytes(), 1)
+
+def decode_backlog(data):
+    columns = np.frombuffer(zlib.decompress(data), dtype="<f8").reshape(3, -1)
+    return SampleBatch(*(column.astype(np.float64) for column in columns))
+
+def record_backlog(db, session_id, kind, batch, chunked=False):
+    """Queue a freshly written batch for the session's count grid and time buckets. Does not commit."""
+    if batch is None or len(batch) == 0:
+        return
+    db.execute(insert(DensityBacklog).values(
+        session_id=session_id, kind=kind, count=len(batch), data=encode_backlog(batch, chunked)
+    ))
+
+def has_backlog(db, session_id, kind):
+    return db.execute(
+        select(DensityBacklog.id).where(DensityBacklog.session_id == session_id, DensityBacklog.kind == kind).limit(1)
+    ).first() is not None
+
+def claim_backlog(db, session_id, kind):
+    """
+    Delete the session's backlog of one kind and return it as one SampleBatch (None if empty).
+    The DELETE takes SQLite's write lock, so until the caller commits no writer can add samples
+    and no other reader can fold the same backlog. Does not commit.
+    """
+    rows = db.execute(
+        delete(DensityBacklog)
+        .where(DensityBacklog.session_id == session_id, DensityBacklog.kind == kind)
+        .returning(DensityBacklog.data)
+    ).scalars().all()
+    return concat_batches([decode_backlog(data) for data in rows])
+
+def fold_backlog(db, session_id, kind):
+    """
+    Bring the session's count grid and time buckets of one kind up to date and commit: add the
+    backlog to each, or build it from storage (which already holds the backlog's samples) if
+    the session has none yet. Both are updated together because claiming empties the backlog.
+    """
+    from .grids import update_grid
+    from .timeline import update_time_buckets
+
+    batch = claim_backlog(db, session_id, kind)
+    update_grid(db, session_id, kind, batch)
+    update_time_buckets(db, session_id, kind, batch)
+    db.commit()
@@ -0,0 +1,256 @@
+from collections import OrderedDict
+import hashlib
+import asyncio
+import json
+import os
+import threading
+
+# Rendered heatmap results are kept in memory up to CACHE_MAX_BYTES (least recently used
+# entries are evicted first) and on disk up to CACHE_DISK_MAX_BYTES, so they survive restarts.
+# Keys include the session's data_version, so entries for a session go stale on ingest and
+# simply age out.
+CACHE_ENABLED = os.environ.get("HEATGAZE_CACHE_ENABLED", "1") not in ("0", "false", "no")
+CACHE_MAX_BYTES = int(os.environ.get("HEATGAZE_CACHE_MAX_BYTES", str(64 * 1024 * 1024)))
+CACHE_DIR = os.environ.get("HEATGAZE_CACHE_DIR", os.path.join("data", "cache"))
+CACHE_DISK_MAX_BYTES = int(os.environ.get("HEATGAZE_CACHE_DISK_MAX_BYTES", str(512 * 1024 * 1024)))
+# Once over CACHE_DISK_MAX_BYTES, pruning deletes down to this fraction of it
+CACHE_DISK_LOW_WATER = float(os.environ.get("HEATGAZE_CACHE_DISK_LOW_WATER", "0.9"))
+CACHE_SUFFIX = ".cache"
+
+def _json_default(value):
+    """numpy scalars and arrays that end up in stats dicts"""
+    if hasattr(value, "tolist"):
+        return value.tolist()
+    raise TypeError(f"Object of type {type(value).__name__} is not JSON serializable")
+
+def cache_key(*parts):
+    """Stable hex key for a tuple of JSON-serializable key parts"""
+    encoded = json.dumps(parts, sort_keys=True, default=_json_default).encode()
+    return hashlib.sha256(encoded).hexdigest()
+
+class ResultCache:
+    """
+    Two-tier cache of byte strings (and JSON results stored as bytes): a byte-bounded
+    in-memory LRU in front of a directory of files. A memory miss that hits on disk is
+    promoted back into memory. Thread-safe.
+    """
+
+    def __init__(self, max_bytes=CACHE_MAX_BYTES, directory=CACHE_DIR,
+                 disk_max_bytes=CACHE_DISK_MAX_BYTES, enabled=CACHE_ENABLED):
+        self.max_bytes = max_bytes
+        self.directory = directory
+        self.disk_max_bytes = disk_max_bytes
+        self.enabled = enabled
+
+        self._entries = OrderedDict()  # key -> bytes, oldest first
+        self._bytes = 0
+        self._disk_bytes = None  # Size of the disk tier, measured on first write
+        self._lock = threading.Lock()  # Memory tier and hit counters
+        self._disk_lock = threading.Lock()  # Disk byte count and eviction counter
+        self._prune_lock = threading.Lock()  # Held by the one writer pruning the directory
+
+        self.hits = 0
+        self.disk_hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self.disk_evictions = 0
+
+    # Memory tier
+
+    def _remember(self, key, data):
+        """Insert into the LRU, evicting the least recently used entries to stay under max_bytes"""
+        if len(data) > self.max_bytes:
+            return
+        old = self._entries.pop(key, None)
+        if old is not None:
+            self._bytes -= len(old)
+        self._entries[key] = data
+        self._bytes += len(data)
+        while self._bytes > self.max_bytes:
+            _, evicted = self._entries.popitem(last=False)
+            self._bytes -= len(evicted)
+            self.evictions += 1
+
+    # Disk tier (file I/O runs outside _lock; async callers run it on a worker thread)
+
+    def _path(self, key):
+        return os.path.join(self.directory, key + CACHE_SUFFIX)
+
+    def _read_disk(self, key):
+        path = self._path(key)
+        try:
+            with open(path, "rb") as f:
+                data = f.read()
+            # Touch it so disk pruning drops the least recently used files first
+            os.utime(path)
+            return data
+        except OSError:
+            return None
+
+    def _write_disk(self, key, data):
+        try:
+            os.makedirs(self.directory, exist_ok=True)
+            path = self._path(key)
+            replaced = os.path.getsize(path) if os.path.exists(path) else 0
+            tmp = f"{path}.{threading.get_ident()}.tmp"
+            with open(tmp, "wb") as f:
+                f.write(data)
+            os.replace(tmp, path)
+            with self._disk_lock:
+                if self._disk_bytes is None:
+                    self._disk_bytes = sum(size for _, size, _ in self._disk_files())
+                else:
+                    self._disk_bytes += len(data) - replaced
+                over = self._disk_bytes > self.disk_max_bytes
+            # One writer prunes at a time; the others carry on
+            if over and self._prune_lock.acquire(blocking=False):
+                try:
+                    self._prune_disk()
+                finally:
+                    self._prune_lock.release()
+        except OSError as e:
+            print(f"Error writing cache entry {key}: {e}")
+
+    def _disk_files(self):
+        files = []
+        for entry in os.scandir(self.directory):
+            if entry.is_file() and entry.name.endswith(CACHE_SUFFIX):
+                try:
+                    stat = entry.stat()
+                except OSError:
+                    continue
+                files.append((stat.st_mtime, stat.st_size, entry.path))
+        return files
+
+    def _prune_disk(self):
+        """
+        Delete the least recently used files until the directory is down to the low-water
+        mark, so the next few writes don't each trigger another scan
+        """
+        files = self._disk_files()
+        total = sum(size for _, size, _ in files)
+        target = int(self.disk_max_bytes * CACHE_DISK_LOW_WATER)
+        freed = 0
+        evicted = 0
+        for _, size, path in sorted(files):
+            if total - freed <= target:
+                break
+            try:
+                os.remove(path)
+            except OSError:
+                continue
+            freed += size
+            evicted += 1
+        with self._disk_lock:
+            # Writes that landed during the scan stay counted
+            self._disk_bytes = max(self._disk_bytes - freed, 0)
+            self.disk_evictions += evicted
+
+    def _lookup(self, key):
+        """Memory tier lookup: the bytes, or None on a miss"""
+        with self._lock:
+            data = self._entries.get(key)
+            if data is not None:
+                self._entries.move_to_end(key)
+                self.hits += 1
+            return data
+
+    def _load(self, key):
+        """Disk tier lookup after a memory miss; a hit is promoted into memory"""
+        data = self._read_disk(key)
+        with self._lock:
+            if data is None:
+                self.misses += 1
+                return None
+            self.disk_hits += 1
+            self._remember(key, data)
+        return data
+
+    # Public interface. get_bytes/put_bytes/get/put do disk I/O on the calling thread and are
+    # meant for worker threads; async routes use fetch_bytes/store_bytes/fetch/store so a
+    # memory miss never blocks the event loop.
+
+    def get_bytes(self, key):
+        """The cached bytes for key, or None"""
+        if not self.enabled:
+            return None
+        data = self._lookup(key)
+        return data if data is not None else self._load(key)
+
+    def put_bytes(self, key, data):
+        """Store bytes in both tiers"""
+        if not self.enabled:
+            return
+        with self._lock:
+            self._remember(key, data)
+        self._write_disk(key, data)
+
+    def get(self, key):
+        """The cached JSON value for key, or None"""
+        data = self.get_bytes(key)
+        return json.loads(data) if data is not None else None
+
+    def put(self, key, value):
+        """Store a JSON-serializable value"""
+        if self.enabled:
+            self.put_bytes(key, json.dumps(value, default=_json_default).encode())
+
+    async def fetch_bytes(self, key):
+        """get_bytes for async callers: memory hits inline, the disk tier on a worker thread"""
+        if not self.enabled:
+            return None
+        data = self._lookup(key)
+        return data if data is not None else await asyncio.to_thread(self._load, key)
+
+    async def store_bytes(self, key, data):
+        """put_bytes for async callers: the disk write (and any pruning) on a worker thread"""
+        if not self.enabled:
+            return
+        with self._lock:
+            self._remember(key, data)
+        await asyncio.to_thread(self._write_disk, key, data)
+
+    async def fetch(self, key):
+        """get for async callers"""
+        data = await self.fetch_bytes(key)
+        return json.loads(data) if data is not None else None
+
+    async def store(self, key, value):
+        """put for async callers"""
+        if self.enabled:
+            await self.store_bytes(key, json.dumps(value, default=_json_default).encode())
+
+    def clear(self):
+        """Drop every entry from both tiers (counters are kept)"""
+        with self._lock:
+            self._entries.clear()
+            self._bytes = 0
+        with self._prune_lock, self._disk_lock:
+            if os.path.isdir(self.directory):
+                for _, _, path in self._disk_files():
+                    try:
+                        os.remove(path)
+                    except OSError:
+                        continue
+            self._disk_bytes = 0
+
+    def stats(self):
+        with self._lock, self._disk_lock:
+            lookups = self.hits + self.disk_hits + self.misses
+            return {
+                "enabled": self.enabled,
+                "hits": self.hits,
+                "disk_hits": self.disk_hits,
+                "misses": self.misses,
+                "hit_rate": round((self.hits + self.disk_hits) / lookups, 3) if lookups else 0,
+                "evictions": self.evictions,
+                "disk_evictions": self.disk_evictions,
+                "entries": len(self._entries),
+                "bytes": self._bytes,
+                "max_bytes": self.max_bytes,
+                "disk_bytes": self._disk_bytes,
+                "disk_max_bytes": self.disk_max_bytes
+            }
+
+# Shared cache for the heatmap routes (JSON results and PNG tiles)
+heatmap_cache = ResultCache()
@@ -0,0 +1,153 @@
+from sqlalchemy import select, update, insert
+from .models import SampleChunk
+from .ingest import SampleBatch, concat_batches
+import os
+import struct
+import zlib
+import numpy as np
+
+# Samples per chunk
+CHUNK_SIZE = 4096
+
+# Appends top up the newest chunk only while it holds fewer samples than this; after that a new
+# chunk is started, so a stream of small batches rewrites at most this many samples per append
+TAIL_MERGE_SAMPLES = int(os.environ.get("HEATGAZE_CHUNK_TAIL_MERGE_SAMPLES", str(CHUNK_SIZE // 4)))
+
+# Chunk layout before zlib compression (little-endian):
+#   header:  4s magic "HGK1", uint32 count, uint8 flags, 3 bytes padding, int64 first timestamp (us)
+#   columns: int64[count] timestamp deltas (us, first is 0), float32[count] x, float32[count] y,
+#            float32[count] pupil_left, float32[count] pupil_right  (only if FLAG_PUPILS)
+CHUNK_MAGIC = b"HGK1"
+CHUNK_HEADER = struct.Struct("<4sIB3xq")
+FLAG_PUPILS = 1
+COMPRESSION_LEVEL = 1
+
+def encode_chunk(batch):
+    """Delta-encode timestamps, pack coordinates as float32 and compress"""
+    count = len(batch)
+    micros = np.rint(np.asarray(batch.timestamps, dtype=np.float64) * 1000).astype(np.int64)
+    first = int(micros[0]) if count else 0
+    deltas = np.diff(micros, prepend=first)
+
+    has_pupils = batch.pupil_left is not None or batch.pupil_right is not None
+    parts = [
+        CHUNK_HEADER.pack(CHUNK_MAGIC, count, FLAG_PUPILS if has_pupils else 0, first),
+        deltas.astype("<i8").tobytes(),
+        np.asarray(batch.x).astype("<f4").tobytes(),
+        np.asarray(batch.y).astype("<f4").tobytes()
+    ]
+    if has_pupils:
+        for column in (batch.pupil_left, batch.pupil_right):
+            if column is None:
+                column = np.full(count, np.nan)
+            parts.append(np.asarray(column).astype("<f4").tobytes())
+    return zlib.compress(b"".join(parts), COMPRESSION_LEVEL)
+
+def decode_chunk(data):
+    """Decode a chunk back into a SampleBatch with float64 columns"""
+    raw = zlib.decompress(data)
+    magic, count, flags, first = CHUNK_HEADER.unpack_from(raw, 0)
+    if magic != CHUNK_MAGIC:
+        raise ValueError("Not a sample chunk")
+
+    offset = CHUNK_HEADER.size
+    deltas = np.frombuffer(raw, dtype="<i8", count=count, offset=offset)
+    offset += count * 8
+    timestamps = (first + np.cumsum(deltas)) / 1000.0
+
+    columns = []
+    for _ in range(4 if flags & FLAG_PUPILS else 2):
+        columns.append(np.frombuffer(raw, dtype="<f4", count=count, offset=offset).astype(np.float64))
+        offset += count * 4
+    if not flags & FLAG_PUPILS:
+        columns += [None, None]
+    return SampleBatch(timestamps, *columns)
+
+def sort_batch(batch):
+    """Order a batch by timestamp (stable, so equal timestamps keep arrival order)"""
+    if np.all(batch.timestamps[:-1] <= batch.timestamps[1:]):
+        return batch
+    return batch.take(np.argsort(batch.timestamps, kind="stable"))
+
+def _chunk_rows(session_id, kind, batch):
+    """Insert values for a time-sorted batch, in blocks of at most CHUNK_SIZE samples"""
+    rows = []
+    for start in range(0, len(batch), CHUNK_SIZE):
+        block = batch.take(slice(start, start + CHUNK_SIZE))
+        rows.append({
+            "session_id": session_id,
+            "kind": kind,
+            "start_time": float(block.timestamps[0]),
+            "end_time": float(block.timestamps[-1]),
+            "count": len(block),
+            "data": encode_chunk(block)
+        })
+    return rows
+
+def append_chunks(db, session_id, kind, batch):
+    """
+    Append samples to a session's chunks. The only chunk ever rewritten is the newest one
+    while it holds fewer than TAIL_MERGE_SAMPLES samples: batches that start after every
+    other chunk ends top it up (or start new chunks once it is full). A late batch reaching
+    back before the end of older chunks (a client retry, a journal replay) is written as
+    chunks of its own that overlap the existing ones; readers merge overlapping chunks by
+    timestamp. So an append rewrites a bounded number of samples however old the batch is.
+    Blocks are at most CHUNK_SIZE samples. Does not commit.
+    """
+    if batch is None or len(batch) == 0:
+        return 0
+
+    scope = (SampleChunk.session_id == session_id, SampleChunk.kind == kind)
+    batch = sort_batch(batch)
+    first = float(batch.timestamps[0])
+    # The newest chunk, and the chunks (at most two are needed) ending after this batch starts
+    tail = db.execute(
+        select(SampleChunk.id, SampleChunk.data, SampleChunk.count)
+        .where(*scope)
+        .order_by(SampleChunk.end_time.desc(), SampleChunk.id.desc())
+        .limit(1)
+    ).first()
+    later = db.execute(
+        select(SampleChunk.id).where(*scope, SampleChunk.end_time > first).limit(2)
+    ).scalars().all()
+
+    if tail is not None and tail.count < TAIL_MERGE_SAMPLES and set(later) <= {tail.id}:
+        combined = sort_batch(concat_batches([decode_chunk(tail.data), batch]))
+        rows = _chunk_rows(session_id, kind, combined)
+        db.execute(update(SampleChunk).where(SampleChunk.id == tail.id).values(**rows[0]))
+        rows = rows[1:]
+    else:
+        rows = _chunk_rows(session_id, kind, batch)
+    if rows:
+        db.execute(insert(SampleChunk), rows)
+    return len(batch)
+
+def load_chunks(db, session_id, kind, latest=False, limit=None):
+    """
+    Decode a session's chunks into one time-ordered SampleBatch.
+    With limit, only enough chunks are decoded to cover the first (or, with latest, last) limit
+    samples: chunks are walked by start_time (or end_time, newest first), and since they may
+    overlap, the walk goes on while a chunk can still hold one of those samples.
+    """
+    query = select(SampleChunk.data, SampleChunk.count, SampleChunk.start_time, SampleChunk.end_time).where(
+        SampleChunk.session_id == session_id, SampleChunk.kind == kind
+    ).order_by(SampleChunk.end_time.desc() if latest else SampleChunk.start_time)
+
+    batches = []
+    total = 0
+    cutoff = None
+    for row in db.execute(query):
+        if cutoff is not None and (row.end_time < cutoff if latest else row.start_time > cutoff):
+            break
+        batches.append(decode_chunk(row.data))
+        total += row.count
+        if limit is not None and total >= limit:
+            # The limit-th sample so far; only chunks reaching past it can change the result
+            timestamps = np.concatenate([batch.timestamps for batch in batches])
+            kth = total - limit if latest else limit - 1
+            cutoff = float(np.partition(timestamps, kth)[kth])
+
+    combined = concat_batches(batches)
+    if combined is None:
+        return None
+    return sort_batch(combined)
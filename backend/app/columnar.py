@@ -0,0 +1,139 @@
+from .ingest import SampleBatch, batch_from_points, validate_batch
+import json
+import struct
+import numpy as np
+
+# Content type of the packed binary batch format
+BINARY_CONTENT_TYPE = "application/x-heatgaze-columnar"
+
+# Binary layout (little-endian):
+#   header:  4s magic "HGC1", uint32 count, uint8 flags, 3 bytes padding
+#   columns: int64[count] timestamp (ms), float32[count] x, float32[count] y,
+#            float32[count] pupil_left, float32[count] pupil_right  (only if FLAG_PUPILS)
+BINARY_MAGIC = b"HGC1"
+HEADER = struct.Struct("<4sIB3x")
+FLAG_PUPILS = 1
+FLAG_CURSOR = 2
+
+def batch_from_columns(columns, with_pupils=False):
+    """
+    Decode a columnar JSON payload {"t": [...], "x": [...], "y": [...], "pupil_left": [...],
+    "pupil_right": [...]} into a validated SampleBatch. Raises ValueError on malformed input.
+    """
+    try:
+        timestamps = np.asarray(columns["t"], dtype=np.float64)
+        x = np.asarray(columns["x"], dtype=np.float64)
+        y = np.asarray(columns["y"], dtype=np.float64)
+    except KeyError as e:
+        raise ValueError(f"Missing column {e}")
+    except (TypeError, ValueError):
+        raise ValueError("Columns t, x and y must be arrays of numbers")
+
+    # Check ndim before len(): a scalar column like {"t": 5} has no length
+    if timestamps.ndim != 1:
+        raise ValueError("Columns t, x and y must be flat arrays of equal length")
+    count = len(timestamps)
+    if x.shape != (count,) or y.shape != (count,):
+        raise ValueError("Columns t, x and y must be flat arrays of equal length")
+
+    pupil_left = pupil_right = None
+    if with_pupils:
+        pupil_left = _optional_column(columns, "pupil_left", count)
+        pupil_right = _optional_column(columns, "pupil_right", count)
+
+    return validate_batch(SampleBatch(timestamps, x, y, pupil_left, pupil_right))
+
+def _optional_column(columns, name, count):
+    values = columns.get(name)
+    if values is None:
+        return None
+    try:
+        # None entries become NaN, which is stored as NULL
+        column = np.asarray([np.nan if v is None else v for v in values], dtype=np.float64)
+    except (TypeError, ValueError):
+        raise ValueError(f"Column {name} must be an array of numbers")
+    if column.shape != (count,):
+        raise ValueError(f"Column {name} must have the same length as t")
+    return column
+
+def decode_binary(payload, with_pupils=False):
+    """Decode the packed binary format straight into NumPy arrays and validate it"""
+    if len(payload) < HEADER.size:
+        raise ValueError("Payload too short")
+    magic, count, flags = HEADER.unpack_from(payload, 0)
+    if magic != BINARY_MAGIC:
+        raise ValueError("Bad magic, expected HGC1")
+
+    has_pupils = bool(flags & FLAG_PUPILS)
+    expected = HEADER.size + count * (8 + 4 + 4 + (8 if has_pupils else 0))
+    if len(payload) != expected:
+        raise ValueError(f"Payload length {len(payload)} does not match {count} samples")
+
+    offset = HEADER.size
+    timestamps = np.frombuffer(payload, dtype="<i8", count=count, offset=offset)
+    offset += count * 8
+    x = np.frombuffer(payload, dtype="<f4", count=count, offset=offset)
+    offset += count * 4
+    y = np.frombuffer(payload, dtype="<f4", count=count, offset=offset)
+    offset += count * 4
+
+    pupil_left = pupil_right = None
+    if has_pupils and with_pupils:
+        pupil_left = np.frombuffer(payload, dtype="<f4", count=count, offset=offset).astype(np.float64)
+        pupil_right = np.frombuffer(payload, dtype="<f4", count=count, offset=offset + count * 4).astype(np.float64)
+
+    batch = SampleBatch(
+        timestamps.astype(np.float64),
+        x.astype(np.float64),
+        y.astype(np.float64),
+        pupil_left,
+        pupil_right
+    )
+    return validate_batch(batch)
+
+def encode_binary(batch, cursor=False):
+    """Pack a SampleBatch into the binary format (used by clients, tests and exports)"""
+    count = len(batch)
+    has_pupils = batch.pupil_left is not None or batch.pupil_right is not None
+    flags = (FLAG_PUPILS if has_pupils else 0) | (FLAG_CURSOR if cursor else 0)
+
+    parts = [
+        HEADER.pack(BINARY_MAGIC, count, flags),
+        np.asarray(batch.timestamps).astype("<i8").tobytes(),
+        np.asarray(batch.x).astype("<f4").tobytes(),
+        np.asarray(batch.y).astype("<f4").tobytes()
+    ]
+    if has_pupils:
+        for column in (batch.pupil_left, batch.pupil_right):
+            if column is None:
+                column = np.full(count, np.nan)
+            parts.append(np.asarray(column).astype("<f4").tobytes())
+    return b"".join(parts)
+
+def is_cursor_payload(payload):
+    """Whether a binary payload is flagged as cursor samples (used by the streaming endpoint)"""
+    if len(payload) < HEADER.size:
+        return False
+    _, _, flags = HEADER.unpack_from(payload, 0)
+    return bool(flags & FLAG_CURSOR)
+
+def decode_payload(body, content_type, with_pupils=False, parse_string_timestamps=False):
+    """
+    Decode a batch request body into a validated SampleBatch.
+    Accepts the packed binary format, a columnar JSON object or the original list of point objects.
+    Raises ValueError for malformed payloads.
+    """
+    media_type = (content_type or "").split(";")[0].strip().lower()
+    if media_type in (BINARY_CONTENT_TYPE, "application/octet-stream"):
+        return decode_binary(body, with_pupils=with_pupils)
+
+    try:
+        data = json.loads(body)
+    except ValueError:
+        raise ValueError("Body is not valid JSON")
+
+    if isinstance(data, list):
+        return batch_from_points(data, with_pupils=with_pupils, parse_string_timestamps=parse_string_timestamps)
+    if isinstance(data, dict):
+        return batch_from_columns(data, with_pupils=with_pupils)
+    raise ValueError("Expected a list of points or a columnar object")
@@ -0,0 +1,41 @@
+from fastapi import Response
+from .cache import cache_key
+
+# Rendered images are a function of the session's data version and the request parameters,
+# so their ETag is known (and If-None-Match can be answered) before anything is rendered.
+# Responses are per user, hence private; data-version images are revalidated on every use,
+# images that can never change (completed heatmap jobs) are cached for good.
+REVALIDATE = "private, no-cache"
+IMMUTABLE = "private, max-age=31536000, immutable"
+
+# Image formats the image endpoints can encode
+IMAGE_MEDIA_TYPES = {"png": "image/png", "webp": "image/webp"}
+
+def make_etag(*parts):
+    """Strong ETag (quoted) for a response determined entirely by parts"""
+    return '"' + cache_key(*parts)[:32] + '"'
+
+def etag_matches(if_none_match, etag):
+    """
+    Whether an If-None-Match header value matches etag. Uses the weak comparison
+    If-None-Match calls for: W/ prefixes are ignored.
+    """
+    if not if_none_match:
+        return False
+    for candidate in if_none_match.split(","):
+        candidate = candidate.strip()
+        if candidate == "*":
+            return True
+        if candidate.startswith("W/"):
+            candidate = candidate[2:]
+        if candidate == etag:
+            return True
+    return False
+
+def not_modified(etag, cache_control=REVALIDATE):
+    return Response(status_code=304, headers={"ETag": etag, "Cache-Control": cache_control})
+
+def image_response(content, media_type, etag, cache_control=REVALIDATE):
+    """Image bytes with the validator and caching headers"""
+    return Response(content=content, media_type=media_type,
+                    headers={"ETag": etag, "Cache-Control": cache_control})
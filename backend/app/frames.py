@@ -0,0 +1,79 @@
+from collections import deque
+from .storage import iter_samples
+from .utils import accumulate_points, smooth_density
+from .rendering import render_heatmap_png
+import math
+import os
+import numpy as np
+
+# Upper bound on frames per animation request
+MAX_FRAMES = int(os.environ.get("HEATGAZE_MAX_FRAMES", "1000"))
+
+FRAME_MODES = ("cumulative", "sliding")
+
+def frame_count(start_time, end_time, step_ms):
+    """Frames needed to cover start_time..end_time (inclusive) in step_ms steps"""
+    return int((end_time - start_time) // step_ms) + 1
+
+def iter_frame_counts(db, session_id, kind, start_time, end_time, step_ms, width, height, scale=1,
+                      mode="cumulative", window_ms=None):
+    """
+    One pass over a session's time-sorted samples, yielding a count grid per step:
+    (frame index, frame end time, counts, points in the frame). Frame k covers samples up to
+    start_time + (k + 1) * step_ms: all of them since start_time in "cumulative" mode, or the
+    last window_ms (rounded up to whole steps) in "sliding" mode.
+
+    Each step's samples are counted once into a delta grid; cumulative frames add deltas to a
+    running total, sliding frames also subtract the delta that left the window. The yielded
+    counts array is reused between frames, so consume (render) it before the next one.
+    """
+    frames = frame_count(start_time, end_time, step_ms)
+    shape = (-(-height // scale), -(-width // scale))
+    running = np.zeros(shape, dtype=np.float64)
+    running_points = 0
+    window_steps = max(1, math.ceil((window_ms or step_ms) / step_ms))
+    history = deque()  # (delta counts, delta points) of the frames inside the sliding window
+
+    pending = np.zeros(shape, dtype=np.float64)
+    pending_points = 0
+    frame = 0
+
+    def emit():
+        nonlocal running, running_points
+        running += pending
+        running_points += pending_points
+        if mode == "sliding":
+            history.append((pending.copy(), pending_points))
+            if len(history) > window_steps:
+                old_counts, old_points = history.popleft()
+                running -= old_counts
+                running_points -= old_points
+        return frame, start_time + (frame + 1) * step_ms, running, running_points
+
+    for batch in iter_samples(db, session_id, kind, start_time=start_time, end_time=end_time):
+        # iter_samples merges both storage engines by timestamp, so index never goes back
+        index = np.floor((batch.timestamps - start_time) / step_ms).astype(np.int64)
+        for target in np.unique(index):
+            while frame < target:
+                yield emit()
+                pending[:] = 0
+                pending_points = 0
+                frame += 1
+            selected = index == target
+            counts, counted = accumulate_points(batch.x[selected], batch.y[selected], width, height, scale=scale)
+            pending += counts
+            pending_points += counted
+
+    while frame < frames:
+        yield emit()
+        pending[:] = 0
+        pending_points = 0
+        frame += 1
+
+def render_frame(counts, width, height, scale=1):
+    """PNG bytes of one frame: smoothed, normalized to its own peak and colorized (quietly, unlike generate_heatmap)"""
+    density = smooth_density(counts, width, height, scale=scale)
+    peak = float(density.max())
+    if peak > 0:
+        density /= peak
+    return render_heatmap_png(density, low=0.0, high=1.0)
@@ -0,0 +1,168 @@
+from sqlalchemy import select, insert, update
+from sqlalchemy.exc import IntegrityError
+from .models import SessionGrid
+from .utils import accumulate_points, density_heatmap, smooth_density, HEATMAP_QUALITY_SCALES, HEATMAP_SIGMA, HEATMAP_DTYPE
+from .rendering import render_heatmap_image
+from scipy.ndimage import gaussian_filter
+from datetime import datetime
+import os
+import zlib
+import numpy as np
+
+# Per-session count grids cover this screen area, one cell per GRID_SCALE x GRID_SCALE pixels.
+# Heatmaps at coarser quality levels sum cells; "full" quality is served at GRID_SCALE.
+GRID_WIDTH = int(os.environ.get("HEATGAZE_GRID_WIDTH", "1920"))
+GRID_HEIGHT = int(os.environ.get("HEATGAZE_GRID_HEIGHT", "1080"))
+GRID_SCALE = int(os.environ.get("HEATGAZE_GRID_SCALE", "2"))
+GRID_COMPRESSION = 1
+
+def grid_shape(width=GRID_WIDTH, height=GRID_HEIGHT, scale=GRID_SCALE):
+    return -(-height // scale), -(-width // scale)
+
+def encode_grid(counts):
+    """uint32 little-endian cells, zlib compressed (mostly zeros, so this stays small)"""
+    return zlib.compress(np.asarray(counts, dtype="<u4").tobytes(), GRID_COMPRESSION)
+
+def decode_grid(data, shape):
+    return np.frombuffer(zlib.decompress(data), dtype="<u4").reshape(shape).astype(np.float64)
+
+def count_grid(batch, width=GRID_WIDTH, height=GRID_HEIGHT, scale=GRID_SCALE):
+    """Bin a SampleBatch into a count grid. Returns (counts, points counted)."""
+    return accumulate_points(batch.x, batch.y, width, height, scale=scale)
+
+def coarsen(counts, factor):
+    """Sum factor x factor blocks of cells (padding the edges with zeros)"""
+    if factor == 1:
+        return counts
+    rows, cols = counts.shape
+    padded = np.zeros((-(-rows // factor) * factor, -(-cols // factor) * factor), dtype=counts.dtype)
+    padded[:rows, :cols] = counts
+    return padded.reshape(padded.shape[0] // factor, factor, padded.shape[1] // factor, factor).sum(axis=(1, 3))
+
+def counts_at_scale(counts, scale, grid_scale=GRID_SCALE):
+    """
+    Counts for a requested density scale. Returns (counts, effective scale): scales finer than
+    the stored grid (or not a multiple of it) are served at the nearest coarser multiple.
+    """
+    factor = max(1, -(-scale // grid_scale))
+    return coarsen(counts, factor), grid_scale * factor
+
+def fit_grid(counts, width, height, grid_scale=GRID_SCALE):
+    """Crop or zero-pad a stored grid to cover a width x height screen"""
+    rows, cols = grid_shape(width, height, grid_scale)
+    if counts.shape == (rows, cols):
+        return counts
+    fitted = np.zeros((rows, cols), dtype=counts.dtype)
+    keep_rows, keep_cols = min(rows, counts.shape[0]), min(cols, counts.shape[1])
+    fitted[:keep_rows, :keep_cols] = counts[:keep_rows, :keep_cols]
+    return fitted
+
+def fixation_cells(counts, grid_scale=GRID_SCALE):
+    """N x 2 array of (x, y) pixel centers of the occupied cells, for NSS/AUC"""
+    rows, cols = np.nonzero(counts)
+    return np.column_stack((cols * grid_scale + grid_scale // 2, rows * grid_scale + grid_scale // 2))
+
+def grid_heatmap(counts, width, height, quality="full", grid_scale=GRID_SCALE):
+    """
+    generate_heatmap for a stored count grid: same smoothing and rendering, with the
+    quality level's density scale rounded up to a multiple of the grid's scale.
+    Returns colored heatmap as a base64 string and the normalized raw heatmap
+    """
+    scale = HEATMAP_QUALITY_SCALES.get(quality, 1)
+    counts, scale = counts_at_scale(fit_grid(counts, width, height, grid_scale), scale, grid_scale)
+    return density_heatmap(counts, width, height, scale=scale)
+
+def grid_density(counts, width, height, quality="full", grid_scale=GRID_SCALE, sigma=HEATMAP_SIGMA):
+    """
+    The density behind grid_heatmap before it is upsampled: smoothed and normalized to 0..1,
+    one float32 cell per scale x scale screen pixels. Returns (density, scale).
+    """
+    scale = HEATMAP_QUALITY_SCALES.get(quality, 1)
+    counts, scale = counts_at_scale(fit_grid(counts, width, height, grid_scale), scale, grid_scale)
+    density = gaussian_filter(np.asarray(counts, dtype=HEATMAP_DTYPE), sigma=sigma / scale, output=HEATMAP_DTYPE)
+    peak = float(density.max())
+    if peak > 0:
+        density /= peak
+    return density, scale
+
+def grid_image(counts, width, height, quality="full", format="png", grid_scale=GRID_SCALE):
+    """The image grid_heatmap renders, as PNG or WebP bytes (no base64, no raw heatmap)"""
+    scale = HEATMAP_QUALITY_SCALES.get(quality, 1)
+    counts, scale = counts_at_scale(fit_grid(counts, width, height, grid_scale), scale, grid_scale)
+    density = smooth_density(counts, width, height, scale=scale)
+    peak = float(density.max())
+    if peak > 0:
+        density /= peak
+    return render_heatmap_image(density, format)
+
+def _build_grid(db, session_id, kind):
+    """Count grid over every stored sample of one kind (used when a session has none yet)"""
+    from .storage import iter_samples
+
+    counts = np.zeros(grid_shape(), dtype=np.float64)
+    total = 0
+    for batch in iter_samples(db, session_id, kind):
+        batch_counts, counted = count_grid(batch)
+        counts += batch_counts
+        total += counted
+    return counts, total
+
+def _load_row(db, session_id, kind):
+    return db.execute(
+        select(SessionGrid.id, SessionGrid.data, SessionGrid.count)
+        .where(SessionGrid.session_id == session_id, SessionGrid.kind == kind,
+               SessionGrid.width == GRID_WIDTH, SessionGrid.height == GRID_HEIGHT,
+               SessionGrid.scale == GRID_SCALE)
+    ).first()
+
+def _insert_grid(db, session_id, kind, counts, total):
+    """Insert the grid, dropping any stored with a different geometry first"""
+    db.execute(SessionGrid.__table__.delete().where(
+        SessionGrid.session_id == session_id, SessionGrid.kind == kind,
+        ~((SessionGrid.width == GRID_WIDTH) & (SessionGrid.height == GRID_HEIGHT) & (SessionGrid.scale == GRID_SCALE))
+    ))
+    db.execute(insert(SessionGrid).values(
+        session_id=session_id, kind=kind, width=GRID_WIDTH, height=GRID_HEIGHT, scale=GRID_SCALE,
+        count=total, data=encode_grid(counts), updated_at=datetime.now()
+    ))
+
+def update_grid(db, session_id, kind, batch):
+    """
+    Add samples that are already stored (the session's claimed backlog, or None) to its
+    persisted count grid. A session without a grid (recorded before grids existed, or under
+    another geometry) gets one built from all its stored samples instead. Does not commit.
+    """
+    row = _load_row(db, session_id, kind)
+    if row is None:
+        counts, total = _build_grid(db, session_id, kind)
+        _insert_grid(db, session_id, kind, counts, total)
+        return
+    if batch is None or len(batch) == 0:
+        return
+
+    batch_counts, counted = count_grid(batch)
+    counts = decode_grid(row.data, batch_counts.shape) + batch_counts
+    db.execute(
+        update(SessionGrid).where(SessionGrid.id == row.id)
+        .values(data=encode_grid(counts), count=row.count + counted, updated_at=datetime.now())
+    )
+
+def load_grid(db, session_id, kind):
+    """
+    The session's count grid for one kind as (counts at GRID_SCALE, points counted). Samples
+    written since the last read are folded in first (and committed), and sessions recorded
+    before grids existed get theirs built and persisted on first use.
+    """
+    from .backlog import has_backlog, fold_backlog
+
+    row = _load_row(db, session_id, kind)
+    if row is None or has_backlog(db, session_id, kind):
+        try:
+            fold_backlog(db, session_id, kind)
+        except IntegrityError:
+            # Another reader built it meanwhile; its copy is at least as recent
+            db.rollback()
+        row = _load_row(db, session_id, kind)
+    if row is None:
+        return np.zeros(grid_shape(), dtype=np.float64), 0
+    return decode_grid(row.data, grid_shape()), row.count
@@ -0,0 +1,186 @@
+from sqlalchemy import insert
+from sqlalchemy.orm import Session
+from .models import GazeData, CursorData
+from datetime import datetime
+import numpy as np
+
+# Points with coordinates further than this from the origin are treated as garbage
+MAX_COORDINATE = 100000.0
+
+# Upper bound for timestamps (year 3000, in epoch milliseconds)
+MAX_TIMESTAMP_MS = 32503680000000.0
+
+# Number of rows sent to the driver per executemany call
+INSERT_CHUNK_SIZE = 5000
+
+# Columnar batch of samples for one session
+class SampleBatch:
+    """
+    A batch of gaze or cursor samples held as parallel NumPy arrays.
+    Timestamps are milliseconds since the epoch (float64), coordinates are float64.
+    """
+
+    def __init__(self, timestamps, x, y, pupil_left=None, pupil_right=None, rejected=0):
+        self.timestamps = timestamps
+        self.x = x
+        self.y = y
+        self.pupil_left = pupil_left
+        self.pupil_right = pupil_right
+        self.rejected = rejected
+
+    def __len__(self):
+        return len(self.timestamps)
+
+    def select(self, mask):
+        """Return a new batch containing only the samples where mask is True"""
+        return SampleBatch(
+            self.timestamps[mask],
+            self.x[mask],
+            self.y[mask],
+            self.pupil_left[mask] if self.pupil_left is not None else None,
+            self.pupil_right[mask] if self.pupil_right is not None else None,
+            rejected=self.rejected + int(np.count_nonzero(~mask))
+        )
+
+    def take(self, index):
+        """Return a new batch with the samples at index (a slice or an integer array)"""
+        return SampleBatch(
+            self.timestamps[index],
+            self.x[index],
+            self.y[index],
+            self.pupil_left[index] if self.pupil_left is not None else None,
+            self.pupil_right[index] if self.pupil_right is not None else None,
+            rejected=self.rejected
+        )
+
+def concat_batches(batches):
+    """Concatenate several SampleBatch objects into one"""
+    batches = [b for b in batches if b is not None and len(b) > 0]
+    if not batches:
+        return None
+    if len(batches) == 1:
+        return batches[0]
+
+    def column(name):
+        parts = [getattr(b, name) for b in batches]
+        if all(p is None for p in parts):
+            return None
+        return np.concatenate([
+            p if p is not None else np.full(len(b), np.nan)
+            for p, b in zip(parts, batches)
+        ])
+
+    return SampleBatch(
+        column('timestamps'), column('x'), column('y'),
+        column('pupil_left'), column('pupil_right'),
+        rejected=sum(b.rejected for b in batches)
+    )
+
+def _to_float(value):
+    """Convert a JSON value to float, returning NaN for anything unusable"""
+    if value is None or isinstance(value, bool):
+        return np.nan
+    try:
+        return float(value)
+    except (TypeError, ValueError):
+        return np.nan
+
+def _parse_timestamp(value, parse_strings):
+    """Convert a timestamp value to epoch milliseconds, NaN if it can't be parsed"""
+    if isinstance(value, (int, float)) and not isinstance(value, bool):
+        return float(value)
+    if parse_strings and value is not None:
+        try:
+            return datetime.fromisoformat(str(value)).timestamp() * 1000.0
+        except ValueError:
+            # Same fallback as the original cursor endpoint: use the arrival time
+            return datetime.now().timestamp() * 1000.0
+    return np.nan
+
+def validate_batch(batch):
+    """
+    Drop samples with non-finite or out-of-range values in one vectorized pass.
+    Optional pupil columns are not validated beyond being turned into NULLs when not finite.
+    """
+    mask = (
+        np.isfinite(batch.timestamps) & (batch.timestamps > 0) & (batch.timestamps < MAX_TIMESTAMP_MS) &
+        np.isfinite(batch.x) & (np.abs(batch.x) <= MAX_COORDINATE) &
+        np.isfinite(batch.y) & (np.abs(batch.y) <= MAX_COORDINATE)
+    )
+    if mask.all():
+        return batch
+    return batch.select(mask)
+
+def batch_from_points(points, with_pupils=False, parse_string_timestamps=False):
+    """
+    Convert a list of point dicts (the JSON batch payload) into a validated SampleBatch.
+    Points that are not dicts or lack numeric x/y/timestamp are dropped and counted in
+    batch.rejected rather than logged one by one.
+    """
+    received = len(points)
+    points = [p for p in points if isinstance(p, dict)]
+    rejected = received - len(points)
+    count = len(points)
+
+    timestamps = np.fromiter(
+        (_parse_timestamp(p.get('timestamp'), parse_string_timestamps) for p in points),
+        dtype=np.float64, count=count
+    )
+    x = np.fromiter((_to_float(p.get('x')) for p in points), dtype=np.float64, count=count)
+    y = np.fromiter((_to_float(p.get('y')) for p in points), dtype=np.float64, count=count)
+
+    pupil_left = pupil_right = None
+    if with_pupils:
+        pupil_left = np.fromiter((_to_float(p.get('pupilLeftSize')) for p in points), dtype=np.float64, count=count)
+        pupil_right = np.fromiter((_to_float(p.get('pupilRightSize')) for p in points), dtype=np.float64, count=count)
+
+    return validate_batch(SampleBatch(timestamps, x, y, pupil_left, pupil_right, rejected=rejected))
+
+def _nullable(values):
+    """Turn a float array into a list where NaN becomes None (NULL in the database)"""
+    if values is None:
+        return None
+    return [None if v != v else v for v in values.tolist()]
+
+def _timestamp_column(timestamps):
+    """Convert epoch milliseconds to naive local datetimes, matching datetime.fromtimestamp"""
+    from_ts = datetime.fromtimestamp
+    return [from_ts(ms / 1000.0) for ms in timestamps.tolist()]
+
+def build_rows(session_id, batch, with_pupils=False):
+    """Build the parameter dicts for a multi-row insert"""
+    times = _timestamp_column(batch.timestamps)
+    xs = batch.x.tolist()
+    ys = batch.y.tolist()
+
+    if with_pupils:
+        lefts = _nullable(batch.pupil_left) or [None] * len(xs)
+        rights = _nullable(batch.pupil_right) or [None] * len(xs)
+        return [
+            {"session_id": session_id, "timestamp": t, "x": x, "y": y,
+             "pupil_left": pl, "pupil_right": pr}
+            for t, x, y, pl, pr in zip(times, xs, ys, lefts, rights)
+        ]
+
+    return [
+        {"session_id": session_id, "timestamp": t, "x": x, "y": y}
+        for t, x, y in zip(times, xs, ys)
+    ]
+
+def _bulk_insert(db, model, rows):
+    """Insert rows with executemany, chunked to keep statement size bounded"""
+    if not rows:
+        return
+    stmt = insert(model)
+    for start in range(0, len(rows), INSERT_CHUNK_SIZE):
+        db.execute(stmt, rows[start:start + INSERT_CHUNK_SIZE])
+
+def insert_gaze_batch(db: Session, session_id: int, batch: SampleBatch):
+    """Write a gaze batch with a single Core executemany. Does not commit."""
+    _bulk_insert(db, GazeData, build_rows(session_id, batch, with_pupils=True))
+    return len(batch)
+
+def insert_cursor_batch(db: Session, session_id: int, batch: SampleBatch):
+    """Write a cursor batch with a single Core executemany. Does not commit."""
+    _bulk_insert(db, CursorData, build_rows(session_id, batch))
+    return len(batch)
@@ -0,0 +1,312 @@
+from .database import SessionLocal
+from .ingest import concat_batches
+from .storage import write_samples
+from .journal import Journal, JOURNAL_ENABLED
+import asyncio
+import os
+import time
+
+# Group commit: the writer commits once this many milliseconds have passed or rows are queued
+FLUSH_INTERVAL_MS = int(os.environ.get("HEATGAZE_INGEST_FLUSH_MS", "200"))
+FLUSH_ROWS = int(os.environ.get("HEATGAZE_INGEST_FLUSH_ROWS", "5000"))
+
+# Backpressure: producers wait (up to BACKPRESSURE_TIMEOUT seconds) while this many rows are pending
+MAX_PENDING_ROWS = int(os.environ.get("HEATGAZE_INGEST_MAX_PENDING_ROWS", "200000"))
+BACKPRESSURE_TIMEOUT = float(os.environ.get("HEATGAZE_INGEST_BACKPRESSURE_TIMEOUT", "2.0"))
+
+# Writer rounds a failing batch is retried for before it is left to the journal (replayed on startup)
+COMMIT_RETRIES = int(os.environ.get("HEATGAZE_INGEST_COMMIT_RETRIES", "3"))
+
+class QueueFullError(Exception):
+    """Raised when the ingestion queue stays full for longer than the backpressure timeout"""
+    pass
+
+class IngestCommitError(Exception):
+    """Raised when accepted samples could not be written; they stay in the journal"""
+    pass
+
+class IngestItem:
+    """One accepted batch waiting to be written"""
+
+    def __init__(self, seq, session_id, gaze, cursor):
+        self.seq = seq
+        self.session_id = session_id
+        self.gaze = gaze
+        self.cursor = cursor
+        self.rows = (len(gaze) if gaze is not None else 0) + (len(cursor) if cursor is not None else 0)
+        self.attempts = 0
+
+class IngestionQueue:
+    """
+    In-process write-behind queue for gaze and cursor samples.
+
+    Batch endpoints submit() validated batches and return immediately. A single writer task
+    drains the queue and writes everything pending in one transaction (group commit), so
+    concurrent sessions share one SQLite write lock acquisition instead of one per request.
+
+    With a journal attached, every batch is appended to it before being queued and the
+    journal is checkpointed after each group commit, so a crash can't lose accepted samples.
+    Batches that fail to commit are retried for COMMIT_RETRIES writer rounds and then kept
+    in the journal: the checkpoint never moves past an uncommitted batch.
+    """
+
+    def __init__(self, session_factory=SessionLocal, flush_interval_ms=FLUSH_INTERVAL_MS,
+                 flush_rows=FLUSH_ROWS, max_pending_rows=MAX_PENDING_ROWS, journal=None):
+        self.session_factory = session_factory
+        self.journal = journal
+        self.flush_interval_ms = flush_interval_ms
+        self.flush_rows = flush_rows
+        self.max_pending_rows = max_pending_rows
+
+        self._pending = []
+        self._pending_rows = 0
+        self._next_seq = 1
+        self._committed_seq = 0
+        self._last_seq_by_session = {}
+        # Batches given up on after COMMIT_RETRIES failed rounds, by seq; only the journal has them now
+        self._retained = {}
+        self._task = None
+        self._wakeup = None
+        self._changed = None
+
+        # Counters exposed for monitoring
+        self.stats = {"batches": 0, "rows": 0, "commits": 0, "errors": 0, "rejected_full": 0, "retained": 0}
+
+    @property
+    def running(self):
+        return self._task is not None and not self._task.done()
+
+    @property
+    def pending_rows(self):
+        return self._pending_rows
+
+    async def start(self):
+        """Start the writer task on the running event loop"""
+        if self.running:
+            return
+        if self.journal is not None:
+            self._next_seq = max(self._next_seq, self.journal.last_seq + 1)
+        self._wakeup = asyncio.Event()
+        self._changed = asyncio.Condition()
+        self._task = asyncio.create_task(self._run())
+
+    async def stop(self):
+        """Drain everything still queued, then stop the writer"""
+        if not self.running:
+            return
+        try:
+            await self.flush()
+        except IngestCommitError as e:
+            print(f"Stopping the ingestion writer with uncommitted samples: {e}")
+        self._task.cancel()
+        try:
+            await self._task
+        except asyncio.CancelledError:
+            pass
+        self._task = None
+        if self.journal is not None:
+            self.journal.close()
+
+    def recover(self):
+        """
+        Replay journal records that were accepted but never committed (e.g. after a crash),
+        then checkpoint and drop the replayed segments. Call once on startup, before start().
+        Records that fail to commit again are queued for the writer to retry and the checkpoint
+        stops before them. Returns the number of replayed rows that were committed.
+        """
+        if self.journal is None:
+            return 0
+        items = [IngestItem(seq, session_id, gaze, cursor) for seq, session_id, gaze, cursor in self.journal.replay()]
+        failed = self._commit(items) if items else []
+        self._next_seq = max(self._next_seq, self.journal.last_seq + 1)
+        self._requeue(failed)
+        self._committed_seq = self._resolved_seq(self.journal.last_seq)
+        self._checkpoint()
+        if failed:
+            print(f"{len(failed)} journal records failed to replay and were queued for retry")
+        failed_seqs = {item.seq for item in failed}
+        return sum(item.rows for item in items if item.seq not in failed_seqs)
+
+    async def submit(self, session_id, gaze=None, cursor=None):
+        """
+        Queue samples for a session and return the batch sequence number.
+        Falls back to a synchronous write when the writer isn't running (scripts, tools).
+        """
+        item = IngestItem(self._next_seq, session_id, gaze, cursor)
+        if item.rows == 0:
+            return self._committed_seq
+
+        if not self.running:
+            self._next_seq += 1
+            if self._commit([item]):
+                raise IngestCommitError(f"Could not write {item.rows} samples for session {session_id}")
+            self._committed_seq = item.seq
+            return item.seq
+
+        # Backpressure: wait for the writer to make room
+        deadline = time.monotonic() + BACKPRESSURE_TIMEOUT
+        while self._pending_rows and self._pending_rows + item.rows > self.max_pending_rows:
+            remaining = deadline - time.monotonic()
+            if remaining <= 0:
+                self.stats["rejected_full"] += 1
+                raise QueueFullError(f"Ingestion queue is full ({self._pending_rows} rows pending)")
+            self._wakeup.set()
+            async with self._changed:
+                try:
+                    await asyncio.wait_for(self._changed.wait(), timeout=remaining)
+                except asyncio.TimeoutError:
+                    pass
+
+        item.seq = self._next_seq
+        self._next_seq += 1
+        if self.journal is not None:
+            self.journal.append(item.seq, session_id, gaze, cursor)
+        self._pending.append(item)
+        self._pending_rows += item.rows
+        self._last_seq_by_session[session_id] = item.seq
+        if self._pending_rows >= self.flush_rows:
+            self._wakeup.set()
+        return item.seq
+
+    async def flush(self, session_id=None):
+        """
+        Wait until everything submitted so far (for one session, or for all) is committed.
+        Raises IngestCommitError if some of it could not be written (it stays in the journal).
+        """
+        if session_id is None:
+            target = self._next_seq - 1
+        else:
+            target = self._last_seq_by_session.get(session_id, 0)
+
+        if target > self._committed_seq and self.running:
+            self._wakeup.set()
+            async with self._changed:
+                await self._changed.wait_for(lambda: self._committed_seq >= target or not self.running)
+
+        retained = [
+            item for item in self._retained.values()
+            if item.seq <= target and (session_id is None or item.session_id == session_id)
+        ]
+        if retained:
+            raise IngestCommitError(
+                f"{sum(item.rows for item in retained)} samples could not be written and are kept in the journal"
+            )
+
+    async def _run(self):
+        """Writer loop: group-commit whatever is pending every interval or when enough rows are queued"""
+        while True:
+            try:
+                await asyncio.wait_for(self._wakeup.wait(), timeout=self.flush_interval_ms / 1000)
+            except asyncio.TimeoutError:
+                pass
+            self._wakeup.clear()
+            if self.journal is not None:
+                self.journal.sync()
+
+            if not self._pending:
+                continue
+
+            items = self._pending
+            self._pending = []
+            self._pending_rows = 0
+            try:
+                failed = await asyncio.to_thread(self._commit, items)
+            except Exception as e:
+                self.stats["errors"] += 1
+                print(f"Ingestion writer failed to commit {len(items)} batches: {e}")
+                failed = items
+
+            self._requeue(failed)
+            self._committed_seq = max(self._committed_seq, self._resolved_seq(items[-1].seq))
+            try:
+                self._checkpoint()
+            except OSError as e:
+                print(f"Failed to checkpoint the ingestion journal: {e}")
+            async with self._changed:
+                self._changed.notify_all()
+
+    def _requeue(self, failed):
+        """Put failed items back in front of the queue, or retain them once they are out of retries"""
+        retry = []
+        for item in failed:
+            item.attempts += 1
+            if item.attempts >= COMMIT_RETRIES:
+                self._retained[item.seq] = item
+                self.stats["retained"] += 1
+                print(f"Giving up on batch {item.seq} for session {item.session_id} "
+                      f"after {item.attempts} attempts; it stays in the journal")
+            else:
+                retry.append(item)
+        if retry:
+            self._pending[:0] = retry
+            self._pending_rows += sum(item.rows for item in retry)
+
+    def _resolved_seq(self, seq):
+        """Highest seq up to seq with every batch at or below it committed or retained"""
+        if self._pending:
+            seq = min(seq, min(item.seq for item in self._pending) - 1)
+        return seq
+
+    def _checkpoint(self):
+        """
+        Checkpoint the journal up to the committed prefix: never past a batch that is waiting for
+        a retry or was retained. Batches committed after a retained one are replayed again on the
+        next startup (the journal is at-least-once).
+        """
+        if self.journal is None:
+            return
+        seq = self._committed_seq
+        if self._retained:
+            seq = min(seq, min(self._retained) - 1)
+        self.journal.mark_committed(seq)
+
+    def _commit(self, items):
+        """
+        Write a group of items in one transaction. Runs in a worker thread.
+        Returns the items that could not be written.
+        """
+        by_session = {}
+        for item in items:
+            gaze, cursor = by_session.setdefault(item.session_id, ([], []))
+            gaze.append(item.gaze)
+            cursor.append(item.cursor)
+
+        db = self.session_factory()
+        try:
+            for session_id, (gaze, cursor) in by_session.items():
+                write_samples(db, session_id, gaze=concat_batches(gaze), cursor=concat_batches(cursor))
+            db.commit()
+            self.stats["commits"] += 1
+            failed_sessions = set()
+        except Exception as e:
+            db.rollback()
+            print(f"Error in group commit of {len(items)} batches, retrying per session: {e}")
+            failed_sessions = self._commit_per_session(db, by_session)
+        finally:
+            db.close()
+
+        written = [item for item in items if item.session_id not in failed_sessions]
+        self.stats["batches"] += len(written)
+        self.stats["rows"] += sum(item.rows for item in written)
+        return [item for item in items if item.session_id in failed_sessions]
+
+    def _commit_per_session(self, db, by_session):
+        """
+        Fallback after a failed group commit, so one bad session can't hold back everyone's data.
+        Returns the ids of the sessions that still failed.
+        """
+        failed = set()
+        for session_id, (gaze, cursor) in by_session.items():
+            try:
+                write_samples(db, session_id, gaze=concat_batches(gaze), cursor=concat_batches(cursor))
+                db.commit()
+                self.stats["commits"] += 1
+            except Exception as e:
+                db.rollback()
+                self.stats["errors"] += 1
+                failed.add(session_id)
+                print(f"Keeping queued samples for session {session_id} for a retry: {e}")
+        return failed
+
+# Shared queue used by the batch and streaming endpoints, recovered and started in main.py
+ingest_queue = IngestionQueue(journal=Journal() if JOURNAL_ENABLED else None)
@@ -0,0 +1,138 @@
+from sqlalchemy import select, update
+from .database import SessionLocal
+from .models import Heatmap, Screenshot
+from .grids import count_grid, grid_shape, grid_heatmap, fit_grid, fixation_cells
+from .storage import iter_samples
+from .utils import calculate_heatmap_stats
+from .workers import analytics_pool
+from datetime import datetime
+import base64
+import os
+import numpy as np
+
+# Rendered heatmap images are written here as <heatmap id>.png (outside static/, so they are
+# only served through the authenticated image endpoint)
+HEATMAP_DIR = os.environ.get("HEATGAZE_HEATMAP_DIR", os.path.join("data", "heatmaps"))
+
+JOB_STATUSES = ("pending", "running", "completed", "failed")
+
+def url_intervals(db, session_id, url):
+    """
+    Time intervals (ms since epoch, inclusive) during which url was on screen, from the
+    session's screenshot timeline: each screenshot starts an interval that lasts until just
+    before the next one. Returns None when the session has no screenshot of url, so the
+    filter can't be applied.
+    """
+    shots = db.execute(
+        select(Screenshot.timestamp, Screenshot.url)
+        .where(Screenshot.session_id == session_id, Screenshot.timestamp.isnot(None))
+        .order_by(Screenshot.timestamp)
+    ).all()
+    intervals = []
+    for index, (timestamp, shot_url) in enumerate(shots):
+        if shot_url != url:
+            continue
+        end = shots[index + 1][0] if index + 1 < len(shots) else None
+        if intervals and intervals[-1][1] == timestamp:
+            intervals[-1] = (intervals[-1][0], end)
+        else:
+            intervals.append((timestamp, end))
+    # End each interval one microsecond (the storage precision) before the next page's screenshot
+    return [(start, end - 0.001 if end is not None else None) for start, end in intervals] or None
+
+def _clip(intervals, start_time, end_time):
+    """Intersect (start, end) intervals (None = open) with the start_time..end_time window"""
+    clipped = []
+    for start, end in intervals:
+        if start_time is not None:
+            start = start_time if start is None else max(start, start_time)
+        if end_time is not None:
+            end = end_time if end is None else min(end, end_time)
+        if start is None or end is None or start <= end:
+            clipped.append((start, end))
+    return clipped
+
+def window_grid(db, session_id, kind, start_time=None, end_time=None, url=None):
+    """
+    Count grid over a session's samples of one kind in start_time..end_time (None = open),
+    limited to the periods url was on screen when the session has screenshots of it
+    """
+    intervals = [(start_time, end_time)]
+    if url:
+        on_screen = url_intervals(db, session_id, url)
+        if on_screen is not None:
+            intervals = _clip(on_screen, start_time, end_time)
+
+    counts = np.zeros(grid_shape(), dtype=np.float64)
+    total = 0
+    for start, end in intervals:
+        for batch in iter_samples(db, session_id, kind, start_time=start, end_time=end):
+            batch_counts, counted = count_grid(batch)
+            counts += batch_counts
+            total += counted
+    return counts, total
+
+def _count_window(db, heatmap):
+    """Count grid over the heatmap's session samples in its time window and url intervals"""
+    return window_grid(db, heatmap.session_id, heatmap.kind, heatmap.start_time, heatmap.end_time, heatmap.url)
+
+def image_path(heatmap_id):
+    return os.path.join(HEATMAP_DIR, f"{heatmap_id}.png")
+
+def _set(db, heatmap_id, **values):
+    db.execute(update(Heatmap).where(Heatmap.id == heatmap_id).values(**values))
+    db.commit()
+
+def run_heatmap_job(heatmap_id):
+    """Render one queued heatmap and store its image and stats. Runs on the analytics pool."""
+    db = SessionLocal()
+    try:
+        heatmap = db.get(Heatmap, heatmap_id)
+        if heatmap is None or heatmap.status not in ("pending", "running"):
+            return
+        _set(db, heatmap_id, status="running")
+        print(f"Heatmap job {heatmap_id}: session {heatmap.session_id}, {heatmap.kind}, "
+              f"window {heatmap.start_time}..{heatmap.end_time}, url {heatmap.url!r}")
+
+        counts, total = _count_window(db, heatmap)
+        stats = {"pointCount": 0}
+        path = None
+        if total:
+            image, raw = grid_heatmap(counts, heatmap.width, heatmap.height, quality=heatmap.quality)
+            stats = calculate_heatmap_stats(
+                raw, fixation_cells(fit_grid(counts, heatmap.width, heatmap.height)), point_count=total
+            )
+            if image:
+                os.makedirs(HEATMAP_DIR, exist_ok=True)
+                path = image_path(heatmap_id)
+                with open(path, "wb") as f:
+                    f.write(base64.b64decode(image))
+
+        _set(db, heatmap_id, status="completed", point_count=total, stats=stats, image_path=path,
+             error=None, completed_at=datetime.now())
+        print(f"Heatmap job {heatmap_id} completed with {total} points")
+    except Exception as e:
+        print(f"Heatmap job {heatmap_id} failed: {str(e)}")
+        import traceback
+        traceback.print_exc()
+        db.rollback()
+        _set(db, heatmap_id, status="failed", error=str(e), completed_at=datetime.now())
+    finally:
+        db.close()
+
+def submit_heatmap_job(heatmap_id):
+    """Queue a pending heatmap row for rendering"""
+    return analytics_pool.submit(run_heatmap_job, heatmap_id)
+
+def resume_heatmap_jobs():
+    """Requeue jobs that were pending or running when the server stopped. Returns how many."""
+    db = SessionLocal()
+    try:
+        ids = db.execute(
+            select(Heatmap.id).where(Heatmap.status.in_(("pending", "running"))).order_by(Heatmap.id)
+        ).scalars().all()
+    finally:
+        db.close()
+    for heatmap_id in ids:
+        submit_heatmap_job(heatmap_id)
+    return len(ids)
@@ -0,0 +1,237 @@
+from .ingest import SampleBatch
+import os
+import struct
+import time
+import zlib
+import numpy as np
+
+# Journal location and policy
+JOURNAL_DIR = os.environ.get("HEATGAZE_JOURNAL_DIR", os.path.join("data", "journal"))
+JOURNAL_ENABLED = os.environ.get("HEATGAZE_JOURNAL_ENABLED", "1") not in ("0", "false", "no")
+
+# fsync policy: "always" (every append), "interval" (at most every FSYNC_INTERVAL_MS), "never" (leave it to the OS)
+FSYNC_POLICY = os.environ.get("HEATGAZE_JOURNAL_FSYNC", "interval")
+FSYNC_INTERVAL_MS = int(os.environ.get("HEATGAZE_JOURNAL_FSYNC_INTERVAL_MS", "100"))
+
+# A new segment is started once the active one grows past this size
+SEGMENT_BYTES = int(os.environ.get("HEATGAZE_JOURNAL_SEGMENT_BYTES", str(16 * 1024 * 1024)))
+
+# Record layout (little-endian):
+#   header:  uint32 payload length, uint32 crc32 of payload, uint64 sequence number
+#   payload: int64 session_id, then a gaze block and a cursor block
+#   block:   uint32 count, uint8 has_pupils, then float64 columns t, x, y[, pupil_left, pupil_right]
+RECORD_HEADER = struct.Struct("<IIQ")
+PAYLOAD_HEADER = struct.Struct("<q")
+BLOCK_HEADER = struct.Struct("<IB")
+SEGMENT_PREFIX = "segment-"
+SEGMENT_SUFFIX = ".log"
+CHECKPOINT_FILE = "checkpoint"
+
+def _encode_block(batch):
+    if batch is None or len(batch) == 0:
+        return BLOCK_HEADER.pack(0, 0)
+    has_pupils = batch.pupil_left is not None or batch.pupil_right is not None
+    parts = [BLOCK_HEADER.pack(len(batch), 1 if has_pupils else 0)]
+    columns = [batch.timestamps, batch.x, batch.y]
+    if has_pupils:
+        columns += [
+            batch.pupil_left if batch.pupil_left is not None else np.full(len(batch), np.nan),
+            batch.pupil_right if batch.pupil_right is not None else np.full(len(batch), np.nan)
+        ]
+    parts.extend(np.asarray(c, dtype="<f8").tobytes() for c in columns)
+    return b"".join(parts)
+
+def _decode_block(payload, offset):
+    count, has_pupils = BLOCK_HEADER.unpack_from(payload, offset)
+    offset += BLOCK_HEADER.size
+    columns = []
+    for _ in range(5 if has_pupils else 3):
+        columns.append(np.frombuffer(payload, dtype="<f8", count=count, offset=offset).copy())
+        offset += count * 8
+    if count == 0:
+        return None, offset
+    if not has_pupils:
+        columns += [None, None]
+    return SampleBatch(*columns), offset
+
+def encode_record(seq, session_id, gaze=None, cursor=None):
+    """Serialize one accepted batch into a journal record"""
+    payload = PAYLOAD_HEADER.pack(session_id) + _encode_block(gaze) + _encode_block(cursor)
+    return RECORD_HEADER.pack(len(payload), zlib.crc32(payload), seq) + payload
+
+def decode_payload(payload):
+    """Inverse of encode_record's payload: returns (session_id, gaze, cursor)"""
+    (session_id,) = PAYLOAD_HEADER.unpack_from(payload, 0)
+    gaze, offset = _decode_block(payload, PAYLOAD_HEADER.size)
+    cursor, _ = _decode_block(payload, offset)
+    return session_id, gaze, cursor
+
+def read_segment(path):
+    """
+    Yield (seq, session_id, gaze, cursor) for every intact record in a segment.
+    Reading stops at the first torn or corrupt record, which is what a crash mid-append leaves behind.
+    """
+    with open(path, "rb") as f:
+        data = f.read()
+
+    offset = 0
+    while offset + RECORD_HEADER.size <= len(data):
+        length, crc, seq = RECORD_HEADER.unpack_from(data, offset)
+        start = offset + RECORD_HEADER.size
+        payload = data[start:start + length]
+        if len(payload) < length or zlib.crc32(payload) != crc:
+            print(f"Journal segment {path} has a torn record at offset {offset}, ignoring the rest")
+            return
+        session_id, gaze, cursor = decode_payload(payload)
+        yield seq, session_id, gaze, cursor
+        offset = start + length
+
+class Journal:
+    """
+    Append-only journal of accepted ingestion batches.
+
+    Every batch is appended (and fsynced according to FSYNC_POLICY) before it is queued for
+    the database. After a group commit the queue calls mark_committed(), which records the
+    committed sequence number in a checkpoint file and deletes or truncates segments that are
+    entirely committed. On startup replay() hands back the records that never made it to the
+    database, giving at-least-once durability.
+    """
+
+    def __init__(self, directory=JOURNAL_DIR, fsync_policy=FSYNC_POLICY,
+                 fsync_interval_ms=FSYNC_INTERVAL_MS, segment_bytes=SEGMENT_BYTES):
+        self.directory = directory
+        self.fsync_policy = fsync_policy
+        self.fsync_interval_ms = fsync_interval_ms
+        self.segment_bytes = segment_bytes
+
+        self.last_seq = 0
+        self._file = None
+        self._path = None
+        self._size = 0
+        self._last_fsync = 0.0
+        self._dirty = False
+        # Highest sequence number in each closed segment, so fully committed ones can be dropped
+        self._closed_segments = {}
+        self._active_max_seq = 0
+
+    # Segment bookkeeping
+
+    def _segment_paths(self):
+        if not os.path.isdir(self.directory):
+            return []
+        names = sorted(
+            name for name in os.listdir(self.directory)
+            if name.startswith(SEGMENT_PREFIX) and name.endswith(SEGMENT_SUFFIX)
+        )
+        return [os.path.join(self.directory, name) for name in names]
+
+    def _checkpoint_path(self):
+        return os.path.join(self.directory, CHECKPOINT_FILE)
+
+    def read_checkpoint(self):
+        try:
+            with open(self._checkpoint_path()) as f:
+                return int(f.read().strip() or 0)
+        except (FileNotFoundError, ValueError):
+            return 0
+
+    def _write_checkpoint(self, seq):
+        os.makedirs(self.directory, exist_ok=True)
+        tmp = self._checkpoint_path() + ".tmp"
+        with open(tmp, "w") as f:
+            f.write(str(seq))
+            f.flush()
+            if self.fsync_policy != "never":
+                os.fsync(f.fileno())
+        os.replace(tmp, self._checkpoint_path())
+
+    def _open_segment(self, first_seq):
+        os.makedirs(self.directory, exist_ok=True)
+        self._path = os.path.join(self.directory, f"{SEGMENT_PREFIX}{first_seq:020d}{SEGMENT_SUFFIX}")
+        self._file = open(self._path, "ab")
+        self._size = self._file.tell()
+        self._active_max_seq = 0
+
+    def _close_segment(self):
+        if self._file is None:
+            return
+        self._sync(force=True)
+        self._file.close()
+        if self._active_max_seq:
+            self._closed_segments[self._path] = self._active_max_seq
+        else:
+            os.remove(self._path)
+        self._file = None
+        self._path = None
+
+    def _sync(self, force=False):
+        if self._file is None or not self._dirty:
+            return
+        self._file.flush()
+        if self.fsync_policy == "never":
+            self._dirty = False
+            return
+        now = time.monotonic()
+        if force or self.fsync_policy == "always" or (now - self._last_fsync) * 1000 >= self.fsync_interval_ms:
+            os.fsync(self._file.fileno())
+            self._last_fsync = now
+            self._dirty = False
+
+    # Public API
+
+    def append(self, seq, session_id, gaze=None, cursor=None):
+        """Append one batch. Returns once the record is written per the fsync policy."""
+        if self._file is None or self._size >= self.segment_bytes:
+            self._close_segment()
+            self._open_segment(seq)
+
+        record = encode_record(seq, session_id, gaze, cursor)
+        self._file.write(record)
+        self._size += len(record)
+        self._active_max_seq = seq
+        self.last_seq = max(self.last_seq, seq)
+        self._dirty = True
+        self._sync()
+
+    def sync(self):
+        """Flush buffered records to disk if the fsync policy says it's time (called on each writer tick)"""
+        self._sync()
+
+    def mark_committed(self, seq):
+        """Record that everything up to seq is in the database and drop committed segments"""
+        self._write_checkpoint(seq)
+
+        for path, max_seq in list(self._closed_segments.items()):
+            if max_seq <= seq:
+                os.remove(path)
+                del self._closed_segments[path]
+
+        # Truncate the active segment when everything in it is committed
+        if self._file is not None and self._active_max_seq and self._active_max_seq <= seq:
+            self._file.close()
+            os.remove(self._path)
+            self._file = None
+            self._path = None
+
+    def replay(self):
+        """
+        Return the records that were accepted but never committed, oldest first, as
+        (seq, session_id, gaze, cursor) tuples. Also positions last_seq after everything seen
+        so new appends never reuse a sequence number.
+        """
+        committed = self.read_checkpoint()
+        self.last_seq = max(self.last_seq, committed)
+        pending = []
+        for path in self._segment_paths():
+            max_seq = 0
+            for seq, session_id, gaze, cursor in read_segment(path):
+                max_seq = max(max_seq, seq)
+                if seq > committed:
+                    pending.append((seq, session_id, gaze, cursor))
+            self._closed_segments[path] = max_seq
+            self.last_seq = max(self.last_seq, max_seq)
+        pending.sort(key=lambda record: record[0])
+        return pending
+
+    def close(self):
+        self._close_segment()
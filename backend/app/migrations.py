@@ -0,0 +1,87 @@
+from sqlalchemy import text, inspect, select
+from sqlalchemy.schema import CreateColumn
+from .models import Session as SessionModel, GazeData, CursorData, SampleChunk, Heatmap
+from .storage import refresh_session_stats
+
+# Base.metadata.create_all() only creates missing tables; it never changes a table that
+# already exists in heatgaze.db. Schema changes to existing tables are applied here as
+# numbered steps, and the last applied step is stored in SQLite's PRAGMA user_version.
+
+def _index(model, name):
+    """Look up an Index declared in a model's __table_args__ by name"""
+    for index in model.__table__.indexes:
+        if index.name == name:
+            return index
+    raise KeyError(f"{model.__tablename__} has no index {name}")
+
+def _add_sample_indexes(connection):
+    """Composite (session_id, timestamp) indexes on the per-sample tables"""
+    for model, name in [
+        (GazeData, "ix_gaze_data_session_timestamp"),
+        (CursorData, "ix_cursor_data_session_timestamp"),
+        (SampleChunk, "ix_sample_chunks_session_kind_start"),
+    ]:
+        _index(model, name).create(connection, checkfirst=True)
+
+def _add_missing_columns(connection, model, names):
+    """ALTER TABLE ADD COLUMN for each named model column the existing table lacks"""
+    existing = {column["name"] for column in inspect(connection).get_columns(model.__tablename__)}
+    for name in names:
+        if name in existing:
+            continue
+        ddl = CreateColumn(model.__table__.c[name]).compile(dialect=connection.dialect)
+        connection.execute(text(f"ALTER TABLE {model.__tablename__} ADD COLUMN {ddl}"))
+
+# Columns refresh_session_stats writes; every step that backfills with it needs all of them
+SESSION_COUNTER_COLUMNS = [
+    "gaze_count", "cursor_count", "first_sample_time", "last_sample_time",
+    "gaze_first_time", "gaze_last_time", "sample_rate"
+]
+
+def _add_session_counters(connection):
+    """Per-session sample counters, backfilled from the samples already stored"""
+    _add_missing_columns(connection, SessionModel, SESSION_COUNTER_COLUMNS)
+    for session_id in connection.execute(select(SessionModel.id)).scalars().all():
+        refresh_session_stats(connection, session_id)
+
+def _add_data_version(connection):
+    """Per-session data version that keys cached heatmap results"""
+    _add_missing_columns(connection, SessionModel, ["data_version"])
+
+def _add_heatmap_job_columns(connection):
+    """Job status, parameters and results on heatmaps (existing rows count as completed)"""
+    _add_missing_columns(connection, Heatmap, [
+        "status", "kind", "quality", "start_time", "end_time", "width", "height",
+        "point_count", "stats", "error", "completed_at"
+    ])
+
+# (version, description, step) in the order they are applied
+MIGRATIONS = [
+    (1, "composite (session_id, timestamp) indexes on gaze_data and cursor_data", _add_sample_indexes),
+    (2, "per-session sample counters", _add_session_counters),
+    (3, "per-session data version", _add_data_version),
+    (4, "heatmap generation jobs", _add_heatmap_job_columns),
+    (5, "gaze-only sample span for the sample rate", _add_session_counters),
+]
+
+SCHEMA_VERSION = MIGRATIONS[-1][0]
+
+def get_schema_version(connection):
+    return connection.execute(text("PRAGMA user_version")).scalar() or 0
+
+def upgrade_schema(engine):
+    """
+    Bring an existing database up to SCHEMA_VERSION. Safe to call on every startup:
+    steps that were already applied are skipped. Returns the list of applied versions.
+    """
+    applied = []
+    with engine.begin() as connection:
+        current = get_schema_version(connection)
+        for version, description, step in MIGRATIONS:
+            if version <= current:
+                continue
+            print(f"Upgrading database schema to version {version}: {description}")
+            step(connection)
+            connection.execute(text(f"PRAGMA user_version = {int(version)}"))
+            applied.append(version)
+    return applied
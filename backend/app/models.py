@@ -1,4 +1,4 @@
-from sqlalchemy import Column, Integer, String, Float, DateTime, ForeignKey, Boolean, Text, JSON
+from sqlalchemy import Column, Integer, String, Float, DateTime, ForeignKey, Boolean, Text, JSON, LargeBinary, Index, UniqueConstraint
 from sqlalchemy.orm import relationship
 from .database import Base
 from datetime import datetime
@@ -30,17 +30,35 @@ class Session(Base):
     updated_at = Column(DateTime, nullable=True)
     user_id = Column(Integer, ForeignKey("users.id"), nullable=True)
 
+    # Sample aggregates, maintained by app/storage.py in the same transaction as each write
+    gaze_count = Column(Integer, nullable=False, default=0, server_default="0")
+    cursor_count = Column(Integer, nullable=False, default=0, server_default="0")
+    first_sample_time = Column(Float, nullable=True)  # Earliest gaze/cursor timestamp (ms since epoch)
+    last_sample_time = Column(Float, nullable=True)  # Latest gaze/cursor timestamp (ms since epoch)
+    gaze_first_time = Column(Float, nullable=True)  # Earliest gaze timestamp (ms since epoch)
+    gaze_last_time = Column(Float, nullable=True)  # Latest gaze timestamp (ms since epoch)
+    sample_rate = Column(Float, nullable=True)  # Gaze samples per second over the gaze span
+    data_version = Column(Integer, nullable=False, default=0, server_default="0")  # Bumped on every write; keys cached results
+
     # Relationships
     user = relationship("User", back_populates="sessions")
     gaze_data = relationship("GazeData", back_populates="session", cascade="all, delete-orphan")
     heatmaps = relationship("Heatmap", back_populates="session", cascade="all, delete-orphan")
     screenshots = relationship("Screenshot", back_populates="session", cascade="all, delete-orphan")
     cursor_data = relationship("CursorData", back_populates="session", cascade="all, delete-orphan")
+    sample_chunks = relationship("SampleChunk", back_populates="session", cascade="all, delete-orphan")
+    grids = relationship("SessionGrid", back_populates="session", cascade="all, delete-orphan")
+    time_buckets = relationship("SessionTimeBucket", back_populates="session", cascade="all, delete-orphan")
+    density_backlog = relationship("DensityBacklog", back_populates="session", cascade="all, delete-orphan")
 
 # GazeData model for individual gaze data points
 class GazeData(Base):
     __tablename__ = "gaze_data"
-    __table_args__ = {'extend_existing': True}
+    # Every sample query filters on session_id and orders by timestamp
+    __table_args__ = (
+        Index("ix_gaze_data_session_timestamp", "session_id", "timestamp"),
+        {'extend_existing': True}
+    )
 
     id = Column(Integer, primary_key=True, index=True)
     session_id = Column(Integer, ForeignKey("sessions.id"), nullable=False)
@@ -56,7 +74,11 @@ class GazeData(Base):
 # CursorData model for mouse movement tracking
 class CursorData(Base):
     __tablename__ = "cursor_data"
-    __table_args__ = {'extend_existing': True}
+    # Every sample query filters on session_id and orders by timestamp
+    __table_args__ = (
+        Index("ix_cursor_data_session_timestamp", "session_id", "timestamp"),
+        {'extend_existing': True}
+    )
 
     id = Column(Integer, primary_key=True, index=True)
     session_id = Column(Integer, ForeignKey("sessions.id"), nullable=False)
@@ -67,6 +89,86 @@ class CursorData(Base):
     # Relationships
     session = relationship("Session", back_populates="cursor_data")
 
+# SampleChunk model for the chunked storage engine: a compressed block of samples of one kind
+class SampleChunk(Base):
+    __tablename__ = "sample_chunks"
+    __table_args__ = (
+        Index("ix_sample_chunks_session_kind_start", "session_id", "kind", "start_time"),
+        {'extend_existing': True}
+    )
+
+    id = Column(Integer, primary_key=True, index=True)
+    session_id = Column(Integer, ForeignKey("sessions.id"), nullable=False)
+    kind = Column(String, nullable=False)  # "gaze" or "cursor"
+    start_time = Column(Float, nullable=False)  # First timestamp in the chunk (ms since epoch)
+    end_time = Column(Float, nullable=False)  # Last timestamp in the chunk (ms since epoch)
+    count = Column(Integer, nullable=False)
+    data = Column(LargeBinary, nullable=False)
+
+    # Relationships
+    session = relationship("Session", back_populates="sample_chunks")
+
+# SessionGrid model: running per-pixel-block sample counts of one kind, caught up from the density backlog
+class SessionGrid(Base):
+    __tablename__ = "session_grids"
+    __table_args__ = (
+        UniqueConstraint("session_id", "kind", name="uq_session_grids_session_kind"),
+        {'extend_existing': True}
+    )
+
+    id = Column(Integer, primary_key=True, index=True)
+    session_id = Column(Integer, ForeignKey("sessions.id"), nullable=False)
+    kind = Column(String, nullable=False)  # "gaze" or "cursor"
+    width = Column(Integer, nullable=False)  # Screen area covered, in pixels
+    height = Column(Integer, nullable=False)
+    scale = Column(Integer, nullable=False)  # Pixels per cell side
+    count = Column(Integer, nullable=False)  # Samples counted (in-bounds only)
+    data = Column(LargeBinary, nullable=False)  # zlib-compressed uint32 cells
+    updated_at = Column(DateTime, default=datetime.now)
+
+    # Relationships
+    session = relationship("Session", back_populates="grids")
+
+# DensityBacklog model: samples written since the session's count grid and time buckets were last
+# brought up to date, folded into them by the next read instead of by every ingest transaction
+class DensityBacklog(Base):
+    __tablename__ = "density_backlog"
+    __table_args__ = (
+        Index("ix_density_backlog_session_kind", "session_id", "kind"),
+        {'extend_existing': True}
+    )
+
+    id = Column(Integer, primary_key=True, index=True)
+    session_id = Column(Integer, ForeignKey("sessions.id"), nullable=False)
+    kind = Column(String, nullable=False)  # "gaze" or "cursor"
+    count = Column(Integer, nullable=False)
+    data = Column(LargeBinary, nullable=False)  # zlib-compressed float64 timestamp, x and y columns
+
+    # Relationships
+    session = relationship("Session", back_populates="density_backlog")
+
+# SessionTimeBucket model: coarse count grid of one kind's samples in one fixed time bucket
+class SessionTimeBucket(Base):
+    __tablename__ = "session_time_buckets"
+    __table_args__ = (
+        UniqueConstraint("session_id", "kind", "bucket", name="uq_session_time_buckets_session_kind_bucket"),
+        {'extend_existing': True}
+    )
+
+    id = Column(Integer, primary_key=True, index=True)
+    session_id = Column(Integer, ForeignKey("sessions.id"), nullable=False)
+    kind = Column(String, nullable=False)  # "gaze" or "cursor"
+    bucket = Column(Integer, nullable=False)  # floor(timestamp / bucket_ms)
+    bucket_ms = Column(Integer, nullable=False)
+    width = Column(Integer, nullable=False)  # Screen area covered, in pixels
+    height = Column(Integer, nullable=False)
+    scale = Column(Integer, nullable=False)  # Pixels per cell side
+    count = Column(Integer, nullable=False)  # Samples counted (in-bounds only)
+    data = Column(LargeBinary, nullable=False)  # zlib-compressed uint32 cells
+
+    # Relationships
+    session = relationship("Session", back_populates="time_buckets")
+
 # Heatmap model for generated heatmap images
 class Heatmap(Base):
     __tablename__ = "heatmaps"
@@ -77,6 +179,19 @@ class Heatmap(Base):
     url = Column(String, nullable=False)
     image_path = Column(String, nullable=True)
     created_at = Column(DateTime, default=datetime.now)
+
+    # Generation job: parameters, progress and result (filled in by app/jobs.py)
+    status = Column(String, nullable=False, default="pending", server_default="completed")  # pending, running, completed, failed
+    kind = Column(String, nullable=True)  # "gaze" or "cursor"
+    quality = Column(String, nullable=True)
+    start_time = Column(Float, nullable=True)  # Sample window (ms since epoch), open-ended when null
+    end_time = Column(Float, nullable=True)
+    width = Column(Integer, nullable=True)
+    height = Column(Integer, nullable=True)
+    point_count = Column(Integer, nullable=True)
+    stats = Column(JSON, nullable=True)
+    error = Column(Text, nullable=True)
+    completed_at = Column(DateTime, nullable=True)
     
     # Relationships
     session = relationship("Session", back_populates="heatmaps")
@@ -0,0 +1,68 @@
+import struct
+import zlib
+import cv2
+import numpy as np
+
+# Content type of the raw density grid format served by GET /sessions/{id}/heatmap?format=grid
+GRID_CONTENT_TYPE = "application/x-heatgaze-grid"
+
+# Binary layout (little-endian):
+#   header: 4s magic "HGG1", uint8 dtype, uint8 flags, 2 bytes padding, uint32 rows,
+#           uint32 cols, uint32 scale (screen pixels per cell), uint32 width, uint32 height
+#           (screen size; the last row/column may reach past it), uint32 points
+#   cells:  rows * cols values of the density normalized to 0..1, row-major, as
+#           uint8 (value * 255, rounded) or float16; zlib-compressed if FLAG_ZLIB
+GRID_MAGIC = b"HGG1"
+GRID_HEADER = struct.Struct("<4sBB2xIIIIII")
+DTYPE_UINT8 = 1
+DTYPE_FLOAT16 = 2
+FLAG_ZLIB = 1
+
+GRID_DTYPES = {"uint8": DTYPE_UINT8, "float16": DTYPE_FLOAT16}
+_NUMPY_DTYPES = {DTYPE_UINT8: np.dtype("u1"), DTYPE_FLOAT16: np.dtype("<f2")}
+
+# zlib level for grid bodies; smooth densities compress well at the fastest levels
+GRID_COMPRESSION = 1
+
+def encode_density_grid(density, scale, width, height, points=0, dtype="uint8", compress=True):
+    """Pack a 0..1 density grid (see grids.grid_density) into the binary grid format"""
+    code = GRID_DTYPES.get(dtype, DTYPE_UINT8)
+    if code == DTYPE_UINT8:
+        # 0..1 onto 0..255, rounded, saturating (OpenCV's conversion does all three in one pass)
+        cells = cv2.convertScaleAbs(density, alpha=255)
+    else:
+        cells = density.astype("<f2")
+    body = cells.tobytes()
+    flags = 0
+    if compress:
+        body = zlib.compress(body, GRID_COMPRESSION)
+        flags |= FLAG_ZLIB
+    rows, cols = density.shape
+    return GRID_HEADER.pack(GRID_MAGIC, code, flags, rows, cols, scale, width, height, points) + body
+
+def decode_density_grid(payload):
+    """
+    Unpack the binary grid format. Returns (density as float32 0..1, header dict).
+    Raises ValueError on malformed input.
+    """
+    if len(payload) < GRID_HEADER.size:
+        raise ValueError("Payload too short")
+    magic, code, flags, rows, cols, scale, width, height, points = GRID_HEADER.unpack_from(payload, 0)
+    if magic != GRID_MAGIC:
+        raise ValueError("Bad magic, expected HGG1")
+    if code not in _NUMPY_DTYPES:
+        raise ValueError(f"Unknown cell type {code}")
+
+    body = payload[GRID_HEADER.size:]
+    if flags & FLAG_ZLIB:
+        body = zlib.decompress(body)
+    dtype = _NUMPY_DTYPES[code]
+    if len(body) != rows * cols * dtype.itemsize:
+        raise ValueError(f"Body length {len(body)} does not match a {rows}x{cols} grid")
+
+    cells = np.frombuffer(body, dtype=dtype).reshape(rows, cols)
+    density = cells.astype(np.float32)
+    if code == DTYPE_UINT8:
+        density /= 255
+    header = {"rows": rows, "cols": cols, "scale": scale, "width": width, "height": height, "points": points}
+    return density, header
@@ -0,0 +1,104 @@
+from functools import lru_cache
+from PIL import Image
+import base64
+import io
+import os
+import cv2
+import numpy as np
+
+# Heatmap colormap stops as RGBA in [0, 1], evenly spaced from the lowest to the highest
+# value (transparent, then blue to red)
+HEATMAP_COLORS = ((0, 0, 0, 0), (0, 0, 1, 0.3), (0, 1, 1, 0.5), (0, 1, 0, 0.7), (1, 1, 0, 0.8), (1, 0, 0, 0.9))
+LUT_SIZE = 256
+
+# zlib level for heatmap PNGs; 3 is the fastest level for these smooth palette images
+PNG_COMPRESSION = 3
+
+# Lossy WebP quality for heatmap images (alpha is kept)
+WEBP_QUALITY = int(os.environ.get("HEATGAZE_WEBP_QUALITY", "80"))
+
+# Part of every cached heatmap's key and ETag (with WEBP_QUALITY): bump it whenever the bytes
+# for the same counts change (colormap stops, smoothing, encoding), so neither the memory and
+# disk caches nor clients' 304s keep serving images from the old renderer
+RENDER_VERSION = 1
+
+@lru_cache(maxsize=16)
+def colormap_lut(colors=HEATMAP_COLORS, size=LUT_SIZE):
+    """
+    size x 4 uint8 RGBA lookup table, linearly interpolated between the color stops like
+    matplotlib's LinearSegmentedColormap.from_list. Cached and read-only, so it is safe to
+    share between threads.
+    """
+    stops = np.asarray(colors, dtype=np.float64)
+    positions = np.linspace(0.0, 1.0, len(stops))
+    samples = np.linspace(0.0, 1.0, size)
+    rgba = np.stack([np.interp(samples, positions, stops[:, channel]) for channel in range(4)], axis=1)
+    lut = (rgba * 255).astype(np.uint8)
+    lut.setflags(write=False)
+    return lut
+
+@lru_cache(maxsize=16)
+def _png_palette(colors=HEATMAP_COLORS):
+    """The LUT split into the PNG PLTE (RGB) and tRNS (alpha) chunks"""
+    lut = colormap_lut(colors)
+    return lut[:, :3].tobytes(), lut[:, 3].tobytes()
+
+def color_indices(grid, low=None, high=None):
+    """
+    Map a 2D array onto LUT indices 0..255, scaling its min..max onto the table like imshow does
+    (or a fixed low..high range, so separately rendered pieces share one color scale).
+    Returns a uint8 array of the same shape.
+    """
+    grid = np.asarray(grid)
+    low = float(np.min(grid)) if low is None else float(low)
+    span = (float(np.max(grid)) if high is None else float(high)) - low
+    if span <= 0:
+        return np.zeros(grid.shape, dtype=np.uint8)
+    # floor(v * 256) clipped to 255, done by OpenCV's saturating conversion in one pass
+    alpha = LUT_SIZE / span
+    return cv2.convertScaleAbs(grid, alpha=alpha, beta=-low * alpha - 0.5)
+
+def colorize(grid, colors=HEATMAP_COLORS):
+    """Map a 2D array through the colormap. Returns a (height, width, 4) uint8 RGBA image."""
+    return colormap_lut(colors)[color_indices(grid)]
+
+def encode_png(image):
+    """PNG bytes for a BGR/BGRA/grayscale uint8 image"""
+    ok, encoded = cv2.imencode(".png", image, [cv2.IMWRITE_PNG_COMPRESSION, PNG_COMPRESSION])
+    if not ok:
+        raise ValueError("PNG encoding failed")
+    return encoded.tobytes()
+
+def render_heatmap_png(grid, colors=HEATMAP_COLORS, low=None, high=None):
+    """
+    Render a density grid as a transparent PNG with one pixel per grid cell.
+    The image is written as an 8-bit palette PNG whose palette is the colormap LUT, which is
+    a quarter of the pixel data of RGBA and decodes to the same colors.
+    """
+    palette, transparency = _png_palette(colors)
+    image = Image.fromarray(color_indices(grid, low, high), mode="P")
+    image.putpalette(palette)
+    buf = io.BytesIO()
+    image.save(buf, format="PNG", compress_level=PNG_COMPRESSION, transparency=transparency)
+    return buf.getvalue()
+
+def render_heatmap_base64(grid, colors=HEATMAP_COLORS):
+    """render_heatmap_png as a base64 string (what the heatmap JSON responses carry)"""
+    return base64.b64encode(render_heatmap_png(grid, colors)).decode("utf-8")
+
+def render_heatmap_image(grid, format="png", colors=HEATMAP_COLORS, low=None, high=None):
+    """render_heatmap_png, or the same colors as an RGBA WebP for format="webp" """
+    if format != "webp":
+        return render_heatmap_png(grid, colors, low, high)
+    rgba = colormap_lut(colors)[color_indices(grid, low, high)]
+    buf = io.BytesIO()
+    Image.fromarray(rgba, mode="RGBA").save(buf, format="WEBP", quality=WEBP_QUALITY)
+    return buf.getvalue()
+
+def convert_image(data, format):
+    """Re-encode PNG (or any PIL-readable) image bytes as format ("png" returns them unchanged)"""
+    if format != "webp":
+        return data
+    buf = io.BytesIO()
+    Image.open(io.BytesIO(data)).save(buf, format="WEBP", quality=WEBP_QUALITY)
+    return buf.getvalue()
@@ -15,6 +15,8 @@ class SessionResponse(BaseModel):
     updated_at: Optional[datetime] = None
     has_recording: Optional[bool] = None
     recording_count: Optional[int] = None
+    cursor_count: Optional[int] = None
+    sample_rate: Optional[float] = None
     duration: Optional[int] = None
     username: Optional[str] = None
 
@@ -0,0 +1,434 @@
+from sqlalchemy import select, update, func, case, or_, and_
+from sqlalchemy.orm import Session
+from .models import Session as SessionModel, GazeData, CursorData, SampleChunk
+from .ingest import SampleBatch, concat_batches, insert_gaze_batch, insert_cursor_batch
+from .chunks import append_chunks, load_chunks, decode_chunk, sort_batch
+from .backlog import record_backlog
+from datetime import datetime
+import base64
+import binascii
+import json
+import math
+import os
+import numpy as np
+
+# Storage engine for new samples: "rows" (one gaze_data/cursor_data row per sample)
+# or "chunks" (compressed per-session blocks in sample_chunks). Readers always merge both,
+# so switching engines never hides existing data.
+STORAGE_ENGINE = os.environ.get("HEATGAZE_STORAGE_ENGINE", "rows")
+
+SAMPLE_MODELS = {"gaze": GazeData, "cursor": CursorData}
+
+# Rows fetched per round trip when streaming a whole session (exports)
+EXPORT_BLOCK_ROWS = int(os.environ.get("HEATGAZE_EXPORT_BLOCK_ROWS", "5000"))
+
+# Page sizes for the point listing endpoints
+DEFAULT_PAGE_SIZE = int(os.environ.get("HEATGAZE_PAGE_SIZE", "5000"))
+MAX_PAGE_SIZE = int(os.environ.get("HEATGAZE_MAX_PAGE_SIZE", "20000"))
+
+def write_samples(db: Session, session_id: int, gaze: SampleBatch = None, cursor: SampleBatch = None):
+    """
+    Persist gaze and/or cursor samples for a session with the configured storage engine
+    and add them to the session's counters. Heatmap count grids and time buckets only get a
+    backlog entry, folded in by the next read. Does not commit.
+
+    Returns: (gaze_points_added, cursor_points_added)
+    """
+    gaze_added = cursor_added = 0
+    if STORAGE_ENGINE == "chunks":
+        gaze_added = append_chunks(db, session_id, "gaze", gaze)
+        cursor_added = append_chunks(db, session_id, "cursor", cursor)
+    else:
+        if gaze is not None and len(gaze):
+            gaze_added = insert_gaze_batch(db, session_id, gaze)
+        if cursor is not None and len(cursor):
+            cursor_added = insert_cursor_batch(db, session_id, cursor)
+    update_session_stats(db, session_id, gaze, cursor)
+    chunked = STORAGE_ENGINE == "chunks"
+    record_backlog(db, session_id, "gaze", gaze, chunked)
+    record_backlog(db, session_id, "cursor", cursor, chunked)
+    return gaze_added, cursor_added
+
+def _sample_rate(gaze_count, first, last):
+    """Gaze samples per second between the first and last gaze sample (ms), or None for an empty span"""
+    span = last - first
+    return case((span > 0, gaze_count * 1000.0 / span), else_=None)
+
+def update_session_stats(db: Session, session_id: int, gaze: SampleBatch = None, cursor: SampleBatch = None):
+    """
+    Add a batch to the session's gaze/cursor counts, sample spans and gaze sample rate, and bump
+    data_version and updated_at, in a single UPDATE so concurrent writers can't lose
+    increments. Does not commit.
+    """
+    gaze_added = len(gaze) if gaze is not None else 0
+    cursor_added = len(cursor) if cursor is not None else 0
+    values = {
+        "gaze_count": SessionModel.gaze_count + gaze_added,
+        "cursor_count": SessionModel.cursor_count + cursor_added,
+        "data_version": SessionModel.data_version + 1,
+        "updated_at": datetime.now()
+    }
+
+    batches = [b for b in (gaze, cursor) if b is not None and len(b)]
+    if batches:
+        batch_first = min(float(b.timestamps.min()) for b in batches)
+        batch_last = max(float(b.timestamps.max()) for b in batches)
+        values["first_sample_time"] = func.min(func.coalesce(SessionModel.first_sample_time, batch_first), batch_first)
+        values["last_sample_time"] = func.max(func.coalesce(SessionModel.last_sample_time, batch_last), batch_last)
+
+    if gaze_added:
+        # The rate only covers the gaze span: cursor activity before or after gaze would understate it.
+        # SET expressions see the old column values, so the rate is computed from the new ones inline
+        gaze_first = float(gaze.timestamps.min())
+        gaze_last = float(gaze.timestamps.max())
+        first = func.min(func.coalesce(SessionModel.gaze_first_time, gaze_first), gaze_first)
+        last = func.max(func.coalesce(SessionModel.gaze_last_time, gaze_last), gaze_last)
+        values["gaze_first_time"] = first
+        values["gaze_last_time"] = last
+        values["sample_rate"] = _sample_rate(values["gaze_count"], first, last)
+
+    db.execute(update(SessionModel).where(SessionModel.id == session_id).values(**values))
+
+def sample_span(db, session_id, kind):
+    """(first, last) timestamp in ms of one kind of samples across both storage engines"""
+    model = SAMPLE_MODELS[kind]
+    row_first, row_last = db.execute(
+        select(func.min(model.timestamp), func.max(model.timestamp)).where(model.session_id == session_id)
+    ).one()
+    chunk_first, chunk_last = db.execute(
+        select(func.min(SampleChunk.start_time), func.max(SampleChunk.end_time))
+        .where(SampleChunk.session_id == session_id, SampleChunk.kind == kind)
+    ).one()
+    firsts = [t for t in (row_first and row_first.timestamp() * 1000.0, chunk_first) if t is not None]
+    lasts = [t for t in (row_last and row_last.timestamp() * 1000.0, chunk_last) if t is not None]
+    return (min(firsts) if firsts else None), (max(lasts) if lasts else None)
+
+def refresh_session_stats(db, session_id: int):
+    """
+    Recompute a session's counters from the stored samples. Used to backfill sessions
+    recorded before the counters existed. Works on a Session or a Connection. Does not commit.
+    """
+    gaze_count = count_samples(db, session_id, "gaze")
+    cursor_count = count_samples(db, session_id, "cursor")
+    spans = [sample_span(db, session_id, kind) for kind in ("gaze", "cursor")]
+    firsts = [first for first, _ in spans if first is not None]
+    lasts = [last for _, last in spans if last is not None]
+    first = min(firsts) if firsts else None
+    last = max(lasts) if lasts else None
+    gaze_first, gaze_last = spans[0]
+
+    sample_rate = None
+    if gaze_first is not None and gaze_last > gaze_first:
+        sample_rate = gaze_count * 1000.0 / (gaze_last - gaze_first)
+
+    db.execute(
+        update(SessionModel)
+        .where(SessionModel.id == session_id)
+        .values(gaze_count=gaze_count, cursor_count=cursor_count, first_sample_time=first,
+                last_sample_time=last, gaze_first_time=gaze_first, gaze_last_time=gaze_last,
+                sample_rate=sample_rate)
+    )
+
+def count_samples(db: Session, session_id: int, kind: str):
+    """Number of stored samples of one kind, across both storage engines"""
+    model = SAMPLE_MODELS[kind]
+    rows = db.execute(select(func.count()).select_from(model).where(model.session_id == session_id)).scalar()
+    chunked = db.execute(
+        select(func.coalesce(func.sum(SampleChunk.count), 0))
+        .where(SampleChunk.session_id == session_id, SampleChunk.kind == kind)
+    ).scalar()
+    return int(rows or 0) + int(chunked or 0)
+
+def _load_rows(db, session_id, kind, latest=False, limit=None):
+    model = SAMPLE_MODELS[kind]
+    query = select(model.timestamp, model.x, model.y).where(model.session_id == session_id)
+    query = query.order_by(model.timestamp.desc() if latest else model.timestamp)
+    if limit is not None:
+        query = query.limit(limit)
+    rows = db.execute(query).all()
+    if not rows:
+        return None
+
+    count = len(rows)
+    timestamps = np.fromiter((r[0].timestamp() * 1000.0 for r in rows), dtype=np.float64, count=count)
+    x = np.fromiter((r[1] for r in rows), dtype=np.float64, count=count)
+    y = np.fromiter((r[2] for r in rows), dtype=np.float64, count=count)
+    return sort_batch(SampleBatch(timestamps, x, y))
+
+def load_samples(db: Session, session_id: int, kind: str, latest=False, limit=None):
+    """
+    Load a session's samples of one kind as a time-ordered SampleBatch (or None if there are none).
+    With limit, returns the first limit samples, or the last limit samples when latest is True.
+    """
+    batch = concat_batches([
+        _load_rows(db, session_id, kind, latest=latest, limit=limit),
+        load_chunks(db, session_id, kind, latest=latest, limit=limit)
+    ])
+    if batch is None:
+        return None
+
+    batch = sort_batch(batch)
+    if limit is not None and len(batch) > limit:
+        batch = batch.take(slice(len(batch) - limit, None) if latest else slice(0, limit))
+    return batch
+
+def _column(values):
+    """Float column from a DB result column, NULL becoming NaN"""
+    return np.array(values, dtype=np.float64)
+
+def _row_blocks(db, session_id, kind, start_time, end_time, block_rows):
+    """
+    Row-stored samples as (lower bound, SampleBatch) pairs of at most block_rows samples, read
+    by keyset on (timestamp, id).
+    Each block is one short query whose cursor is closed before the block is yielded, so a
+    paused consumer (a slow download) holds no SQLite read lock and never blocks writers.
+    """
+    model = SAMPLE_MODELS[kind]
+    columns = [model.id, model.timestamp, model.x, model.y]
+    if kind == "gaze":
+        columns += [model.pupil_left, model.pupil_right]
+
+    query = select(*columns).where(model.session_id == session_id)
+    if end_time is not None:
+        query = query.where(model.timestamp <= datetime.fromtimestamp(end_time / 1000.0))
+    query = query.order_by(model.timestamp, model.id).limit(block_rows)
+
+    after = None
+    if start_time is not None:
+        after = (datetime.fromtimestamp(start_time / 1000.0), None)
+    while True:
+        block = query
+        if after is not None:
+            after_time, after_id = after
+            # timestamp >= after_time keeps the (session_id, timestamp) index range scan
+            block = block.where(model.timestamp >= after_time)
+            if after_id is not None:
+                block = block.where(or_(model.timestamp > after_time, model.id > after_id))
+        rows = db.execute(block).all()
+        if not rows:
+            return
+        after = (rows[-1][1], rows[-1][0])
+        values = list(zip(*rows))
+        timestamps = np.fromiter((t.timestamp() * 1000.0 for t in values[1]), dtype=np.float64, count=len(rows))
+        yield timestamps[0], SampleBatch(timestamps, *(_column(column) for column in values[2:]))
+        if len(rows) < block_rows:
+            return
+
+def _chunk_blocks(db, session_id, kind, start_time, end_time):
+    """
+    Chunk-stored samples overlapping the range, one decoded chunk at a time in (start_time, id)
+    order, as (lower bound, SampleBatch) pairs. Chunks may overlap in time; the bound is where
+    this and every later chunk start (within the range). Like _row_blocks, every chunk is its
+    own query, so nothing stays open between chunks.
+    """
+    query = select(SampleChunk.id, SampleChunk.start_time, SampleChunk.data).where(
+        SampleChunk.session_id == session_id, SampleChunk.kind == kind
+    )
+    if start_time is not None:
+        query = query.where(SampleChunk.end_time >= start_time)
+    if end_time is not None:
+        query = query.where(SampleChunk.start_time <= end_time)
+    query = query.order_by(SampleChunk.start_time, SampleChunk.id).limit(1)
+
+    after = None
+    while True:
+        block = query
+        if after is not None:
+            after_start, after_id = after
+            block = block.where(SampleChunk.start_time >= after_start).where(
+                or_(SampleChunk.start_time > after_start, SampleChunk.id > after_id)
+            )
+        chunk = db.execute(block).first()
+        if chunk is None:
+            return
+        after = (chunk.start_time, chunk.id)
+        batch = decode_chunk(chunk.data)
+        if start_time is not None or end_time is not None:
+            # Compare in whole microseconds, the precision both storage engines keep
+            micros = np.rint(batch.timestamps * 1000)
+            mask = np.ones(len(batch), dtype=bool)
+            if start_time is not None:
+                mask &= micros >= round(start_time * 1000)
+            if end_time is not None:
+                mask &= micros <= round(end_time * 1000)
+            batch = batch.take(np.flatnonzero(mask))
+        if len(batch):
+            # Decoded timestamps are rounded to whole microseconds, so the bounds are too
+            bound = chunk.start_time if start_time is None else max(chunk.start_time, round(start_time * 1000) / 1000)
+            yield min(bound, float(batch.timestamps[0])), batch
+
+def _merge_blocks(sources):
+    """
+    Merge block streams into one stream of time-ordered SampleBatches. Each source yields
+    (lower bound, sorted block) pairs with non-decreasing bounds, no sample of a block or of
+    any later block of that source being earlier than its bound. Everything pulled so far
+    that is earlier than the smallest bound of the sources' next blocks is final and yielded;
+    the rest waits, so only samples that may still interleave are held back.
+    """
+    heads = []
+    for source in sources:
+        head = next(source, None)
+        if head is not None:
+            heads.append([head, source])
+
+    pool = None
+    while heads:
+        item = min(heads, key=lambda head: head[0][0])
+        pool = sort_batch(concat_batches([pool, item[0][1]]))
+        item[0] = next(item[1], None)
+        if item[0] is None:
+            heads.remove(item)
+
+        bound = min(head[0][0] for head in heads) if heads else np.inf
+        ready = int(np.searchsorted(pool.timestamps, bound, side="left"))
+        if ready:
+            yield pool.take(slice(0, ready))
+            pool = pool.take(slice(ready, None)) if ready < len(pool) else None
+
+def iter_samples(db: Session, session_id: int, kind: str, start_time=None, end_time=None,
+                 block_rows=EXPORT_BLOCK_ROWS):
+    """
+    Yield a session's samples of one kind in timestamp order, as SampleBatches of about
+    block_rows (rows) or one chunk each, optionally limited to start_time <= t <= end_time
+    (ms since epoch). Row- and chunk-stored samples are merged by timestamp. Rows are read
+    block by block and chunks decoded one at a time, so memory stays flat however large the
+    session is, and no read cursor is held open while the caller works on a block. Gaze
+    batches include pupil sizes.
+    """
+    yield from _merge_blocks([
+        _row_blocks(db, session_id, kind, start_time, end_time, block_rows),
+        _chunk_blocks(db, session_id, kind, start_time, end_time)
+    ])
+
+def to_point_dicts(batch):
+    """Convert a SampleBatch into the list-of-dicts shape the heatmap functions take"""
+    if batch is None:
+        return []
+    return [
+        {'x': x, 'y': y, 'timestamp': t}
+        for t, x, y in zip(batch.timestamps.tolist(), batch.x.tolist(), batch.y.tolist())
+    ]
+
+def encode_page_token(state):
+    """Opaque continuation token for read_page (urlsafe base64 of a small JSON object)"""
+    return base64.urlsafe_b64encode(json.dumps(state, separators=(",", ":")).encode()).decode().rstrip("=")
+
+def decode_page_token(token):
+    """Inverse of encode_page_token; raises ValueError on anything that isn't one of our tokens"""
+    try:
+        state = json.loads(base64.urlsafe_b64decode(token + "=" * (-len(token) % 4)))
+        if not isinstance(state, dict) or not isinstance(state.get("p"), int):
+            raise ValueError("missing position")
+        if "r" in state:
+            state["r"] = (datetime.fromisoformat(state["r"][0]), int(state["r"][1]))
+        if "c" in state:
+            state["c"] = (int(state["c"][0]), int(state["c"][1]), int(state["c"][2]))
+        return state
+    except (TypeError, KeyError, IndexError, ValueError, binascii.Error) as e:
+        raise ValueError(f"Invalid page token: {e}")
+
+def read_page(db: Session, session_id: int, kind: str, offset=0, limit=DEFAULT_PAGE_SIZE, after=None):
+    """
+    One page of samples as dicts with id, timestamp (datetime), x and y, plus the token for
+    the next page (None after the last page). Row-stored samples come first, ordered by
+    (timestamp, id), then chunk-stored ones, merged across overlapping chunks by timestamp;
+    chunk samples have no row id, so their id is their position in the session.
+
+    With after (a token from a previous page) the page continues from that key instead of
+    skipping offset samples, so walking a whole session costs O(n) rather than O(n^2).
+    limit is clamped to MAX_PAGE_SIZE.
+    """
+    model = SAMPLE_MODELS[kind]
+    limit = max(1, min(int(limit), MAX_PAGE_SIZE))
+    state = decode_page_token(after) if after else None
+    position = state["p"] if state else max(0, int(offset))
+    points = []
+    chunk_skip = 0
+
+    if state is None or "c" not in state:
+        query = (
+            select(model.id, model.timestamp, model.x, model.y)
+            .where(model.session_id == session_id)
+            .order_by(model.timestamp, model.id)
+            .limit(limit)
+        )
+        if state is None:
+            query = query.offset(position)
+        elif "r" in state:
+            after_time, after_id = state["r"]
+            query = query.where(or_(
+                model.timestamp > after_time,
+                and_(model.timestamp == after_time, model.id > after_id)
+            ))
+        rows = db.execute(query).all()
+        points = [{"id": r.id, "timestamp": r.timestamp, "x": r.x, "y": r.y} for r in rows]
+        if len(points) == limit:
+            last = rows[-1]
+            return points, encode_page_token({"p": position + limit, "r": [last.timestamp.isoformat(), last.id]})
+
+        # Rows are exhausted; in offset mode the offset may reach into the chunks
+        if state is None and not points and position:
+            row_count = db.execute(
+                select(func.count()).select_from(model).where(model.session_id == session_id)
+            ).scalar() or 0
+            chunk_skip = max(0, position - row_count)
+
+    # Chunks may overlap in time (late samples get chunks of their own), so chunk samples are
+    # merged in (timestamp, chunk id, index) order. Walking the chunks by start_time, samples
+    # earlier than the next chunk's start are final; only the chunks the page needs are decoded.
+    query = (
+        select(SampleChunk.id, SampleChunk.start_time)
+        .where(SampleChunk.session_id == session_id, SampleChunk.kind == kind)
+        .order_by(SampleChunk.start_time, SampleChunk.id)
+    )
+    after_key = None
+    if state is not None and "c" in state:
+        # (timestamp in us, chunk id, index) of the last sample served; chunks ending before it
+        # hold nothing later (1 us of slack for the rounding of decoded timestamps)
+        after_key = state["c"]
+        query = query.where(SampleChunk.end_time >= (after_key[0] - 1) / 1000.0)
+    chunks = db.execute(query).all()
+
+    pool = None  # [us, chunk id, index, x, y] columns of samples not served yet, in page order
+    skip = chunk_skip
+    wanted = limit - len(points)
+    final = 0
+    for i in range(len(chunks) + 1):
+        bound = math.floor(chunks[i].start_time * 1000) if i < len(chunks) else math.inf
+        final = int(np.searchsorted(pool[0], bound, side="left")) if pool is not None else 0
+        if skip and final:
+            dropped = min(skip, final)
+            pool = [column[dropped:] for column in pool]
+            skip -= dropped
+            final -= dropped
+        if final >= wanted or i == len(chunks):
+            break
+
+        chunk = chunks[i]
+        batch = decode_chunk(db.execute(select(SampleChunk.data).where(SampleChunk.id == chunk.id)).scalar())
+        micros = np.rint(batch.timestamps * 1000).astype(np.int64)
+        index = np.arange(len(batch))
+        keep = slice(None)
+        if after_key is not None:
+            after_micros, after_id, after_index = after_key
+            later = (chunk.id > after_id) | ((chunk.id == after_id) & (index > after_index))
+            keep = (micros > after_micros) | ((micros == after_micros) & later)
+        columns = [micros[keep], np.full(len(index[keep]), chunk.id), index[keep], batch.x[keep], batch.y[keep]]
+        if pool is not None:
+            columns = [np.concatenate(pair) for pair in zip(pool, columns)]
+        order = np.lexsort((columns[2], columns[1], columns[0]))
+        pool = [column[order] for column in columns]
+
+    from_ts = datetime.fromtimestamp
+    served = min(final, wanted)
+    for i in range(served):
+        points.append({
+            "id": position + len(points) + 1,
+            "timestamp": from_ts(pool[0][i] / 1e6),
+            "x": float(pool[3][i]),
+            "y": float(pool[4][i])
+        })
+    if len(points) == limit:
+        last = [int(column[served - 1]) for column in pool[:3]]
+        return points, encode_page_token({"p": position + limit, "c": last})
+    return points, None
@@ -0,0 +1,110 @@
+from collections import OrderedDict
+from scipy.ndimage import gaussian_filter
+from .grids import fit_grid, coarsen, GRID_SCALE
+from .rendering import render_heatmap_png
+from .utils import HEATMAP_SIGMA
+import math
+import os
+import threading
+import cv2
+import numpy as np
+
+# Tiles are TILE_SIZE x TILE_SIZE PNGs. Zoom 0 fits the whole screen into one tile; each
+# zoom level doubles the resolution, up to TILE_OVERZOOM levels past native screen pixels.
+TILE_SIZE = int(os.environ.get("HEATGAZE_TILE_SIZE", "256"))
+TILE_OVERZOOM = int(os.environ.get("HEATGAZE_TILE_OVERZOOM", "2"))
+
+# Density pyramids kept in memory (one per session, kind and data version)
+PYRAMID_CACHE_SIZE = int(os.environ.get("HEATGAZE_TILE_PYRAMIDS", "8"))
+
+def max_zoom(width, height, tile_size=TILE_SIZE):
+    native = max(0, math.ceil(math.log2(max(width, height) / tile_size)))
+    return native + TILE_OVERZOOM
+
+def zoom_scale(z, width, height, tile_size=TILE_SIZE):
+    """Level pixels per screen pixel at zoom z"""
+    return tile_size * (2 ** z) / max(width, height)
+
+def tile_layout(width, height, tile_size=TILE_SIZE):
+    """Size and tile counts of every zoom level, for clients laying out a tiled view"""
+    levels = []
+    for z in range(max_zoom(width, height, tile_size) + 1):
+        scale = zoom_scale(z, width, height, tile_size)
+        level_width = math.ceil(width * scale)
+        level_height = math.ceil(height * scale)
+        levels.append({
+            "z": z,
+            "width": level_width,
+            "height": level_height,
+            "columns": -(-level_width // tile_size),
+            "rows": -(-level_height // tile_size)
+        })
+    return levels
+
+def build_pyramid(counts, width, height, sigma=HEATMAP_SIGMA):
+    """
+    Smoothed density of a stored count grid, normalized to 0..1, followed by successive 2x
+    downsamples. Level i has one cell per GRID_SCALE * 2**i screen pixels, aligned at the
+    top-left corner. Returns a list of float32 arrays, finest first.
+    """
+    counts = fit_grid(counts, width, height)
+    density = gaussian_filter(counts, sigma=sigma / GRID_SCALE, output=np.float32)
+    peak = float(density.max())
+    if peak > 0:
+        density /= peak
+
+    levels = [density]
+    while max(levels[-1].shape) > TILE_SIZE // 2:
+        levels.append(coarsen(levels[-1], 2) * np.float32(0.25))
+    for level in levels:
+        level.setflags(write=False)
+    return levels
+
+def render_tile(pyramid, z, x, y, width, height, tile_size=TILE_SIZE):
+    """
+    PNG bytes of tile (x, y) at zoom z. Samples the coarsest pyramid level that is still at
+    least as fine as the tile, with bilinear interpolation; area outside the screen is transparent.
+    """
+    scale = zoom_scale(z, width, height, tile_size)
+    level = 0
+    while level + 1 < len(pyramid) and scale * GRID_SCALE * 2 ** (level + 1) <= 1:
+        level += 1
+    source = pyramid[level]
+    cell = GRID_SCALE * 2 ** level  # screen pixels per source cell
+
+    # Tile pixel (u, v) centers map to source coordinates (u + x*T + 0.5) / (scale*cell) - 0.5
+    step = 1.0 / (scale * cell)
+    transform = np.array([
+        [step, 0, (x * tile_size + 0.5) * step - 0.5],
+        [0, step, (y * tile_size + 0.5) * step - 0.5]
+    ])
+    tile = cv2.warpAffine(
+        source, transform, (tile_size, tile_size),
+        flags=cv2.INTER_LINEAR | cv2.WARP_INVERSE_MAP, borderMode=cv2.BORDER_CONSTANT, borderValue=0
+    )
+    # Every tile shares the pyramid's 0..1 color scale so neighbouring tiles line up
+    return render_heatmap_png(tile, low=0.0, high=1.0)
+
+class PyramidCache:
+    """Small LRU of density pyramids; built pyramids are read-only and shared between requests"""
+
+    def __init__(self, size=PYRAMID_CACHE_SIZE):
+        self.size = size
+        self._pyramids = OrderedDict()
+        self._lock = threading.Lock()
+
+    def get(self, key, build):
+        with self._lock:
+            pyramid = self._pyramids.get(key)
+            if pyramid is not None:
+                self._pyramids.move_to_end(key)
+                return pyramid
+        # Built outside the lock; two concurrent builds of the same pyramid are harmless
+        pyramid = build()
+        with self._lock:
+            self._pyramids[key] = pyramid
+            while len(self._pyramids) > self.size:
+                self._pyramids.popitem(last=False)
+        return pyramid
+
+pyramid_cache = PyramidCache()
@@ -0,0 +1,233 @@
+from collections import OrderedDict
+from sqlalchemy import select, insert, update
+from sqlalchemy.exc import IntegrityError
+from .models import SessionTimeBucket
+from .grids import encode_grid, decode_grid, grid_shape, GRID_WIDTH, GRID_HEIGHT
+from .utils import accumulate_points
+import os
+import threading
+import zlib
+import numpy as np
+
+# Temporal density index: every session keeps one coarse count grid per TIMELINE_BUCKET_MS
+# of samples, one cell per TIMELINE_SCALE x TIMELINE_SCALE pixels. Prefix sums over the
+# buckets turn the heatmap of any time window into two grid subtractions, plus the raw
+# samples of the partial buckets at the window's edges.
+TIMELINE_BUCKET_MS = int(os.environ.get("HEATGAZE_TIMELINE_BUCKET_MS", "5000"))
+TIMELINE_SCALE = int(os.environ.get("HEATGAZE_TIMELINE_SCALE", "16"))
+
+# Prefix-sum arrays kept in memory, by total size
+TIMELINE_CACHE_BYTES = int(os.environ.get("HEATGAZE_TIMELINE_CACHE_BYTES", str(128 * 1024 * 1024)))
+
+def timeline_shape():
+    return grid_shape(GRID_WIDTH, GRID_HEIGHT, TIMELINE_SCALE)
+
+def _count(batch):
+    return accumulate_points(batch.x, batch.y, GRID_WIDTH, GRID_HEIGHT, scale=TIMELINE_SCALE)
+
+def _geometry():
+    return (
+        (SessionTimeBucket.bucket_ms == TIMELINE_BUCKET_MS) & (SessionTimeBucket.width == GRID_WIDTH)
+        & (SessionTimeBucket.height == GRID_HEIGHT) & (SessionTimeBucket.scale == TIMELINE_SCALE)
+    )
+
+def _bucket_batches(batch):
+    """Split a SampleBatch by time bucket. Yields (bucket, sub-batch)."""
+    buckets = np.floor(batch.timestamps / TIMELINE_BUCKET_MS).astype(np.int64)
+    for bucket in np.unique(buckets):
+        yield int(bucket), batch.select(buckets == bucket)
+
+def _build_buckets(db, session_id, kind):
+    """Per-bucket count grids over every stored sample of one kind. Returns {bucket: (counts, n)}."""
+    from .storage import iter_samples
+
+    buckets = {}
+    for batch in iter_samples(db, session_id, kind):
+        for bucket, part in _bucket_batches(batch):
+            counts, counted = _count(part)
+            if bucket in buckets:
+                previous, total = buckets[bucket]
+                buckets[bucket] = (previous + counts, total + counted)
+            else:
+                buckets[bucket] = (counts, counted)
+    return buckets
+
+def _insert_buckets(db, session_id, kind, buckets):
+    if not buckets:
+        return
+    db.execute(insert(SessionTimeBucket), [
+        {"session_id": session_id, "kind": kind, "bucket": bucket, "bucket_ms": TIMELINE_BUCKET_MS,
+         "width": GRID_WIDTH, "height": GRID_HEIGHT, "scale": TIMELINE_SCALE,
+         "count": counted, "data": encode_grid(counts)}
+        for bucket, (counts, counted) in sorted(buckets.items())
+    ])
+
+def _has_index(db, session_id, kind):
+    return db.execute(
+        select(SessionTimeBucket.id)
+        .where(SessionTimeBucket.session_id == session_id, SessionTimeBucket.kind == kind, _geometry())
+        .limit(1)
+    ).first() is not None
+
+def rebuild_time_buckets(db, session_id, kind):
+    """Replace a session's bucket grids of one kind with ones built from storage. Does not commit."""
+    db.execute(SessionTimeBucket.__table__.delete().where(
+        SessionTimeBucket.session_id == session_id, SessionTimeBucket.kind == kind
+    ))
+    _insert_buckets(db, session_id, kind, _build_buckets(db, session_id, kind))
+
+def update_time_buckets(db, session_id, kind, batch):
+    """
+    Add samples that are already stored (the session's claimed backlog, or None) to its bucket
+    grids. Sessions without an index (recorded before it existed, or under another bucket
+    geometry) get theirs rebuilt from storage instead. Does not commit.
+    """
+    if not _has_index(db, session_id, kind):
+        rebuild_time_buckets(db, session_id, kind)
+        return
+    if batch is None or len(batch) == 0:
+        return
+
+    parts = dict(_bucket_batches(batch))
+    rows = {row.bucket: row for row in db.execute(
+        select(SessionTimeBucket.id, SessionTimeBucket.bucket, SessionTimeBucket.count, SessionTimeBucket.data)
+        .where(SessionTimeBucket.session_id == session_id, SessionTimeBucket.kind == kind,
+               SessionTimeBucket.bucket.in_(list(parts)), _geometry())
+    )}
+    new = {}
+    for bucket, part in parts.items():
+        counts, counted = _count(part)
+        row = rows.get(bucket)
+        if row is None:
+            new[bucket] = (counts, counted)
+            continue
+        db.execute(
+            update(SessionTimeBucket).where(SessionTimeBucket.id == row.id)
+            .values(data=encode_grid(decode_grid(row.data, counts.shape) + counts), count=row.count + counted)
+        )
+    _insert_buckets(db, session_id, kind, new)
+
+class TimelineIndex:
+    """
+    Prefix sums over a session's bucket grids: prefix[i] is the count grid of buckets[:i].
+    Read-only once built, so one instance is shared between requests.
+    """
+
+    def __init__(self, buckets, counts, prefix):
+        self.buckets = buckets  # Sorted bucket numbers (int64)
+        self.counts = counts  # Samples per bucket
+        self.prefix = prefix  # (len(buckets) + 1, rows, cols) uint32
+
+    @property
+    def nbytes(self):
+        return self.prefix.nbytes + self.buckets.nbytes + self.counts.nbytes
+
+    def range_counts(self, first_bucket=None, last_bucket=None):
+        """Count grid and sample count of the buckets first_bucket..last_bucket (inclusive, None = open)"""
+        start = 0 if first_bucket is None else int(np.searchsorted(self.buckets, first_bucket, side="left"))
+        stop = len(self.buckets) if last_bucket is None else int(np.searchsorted(self.buckets, last_bucket, side="right"))
+        if stop <= start:
+            return np.zeros(self.prefix.shape[1:], dtype=np.float64), 0
+        counts = self.prefix[stop].astype(np.float64) - self.prefix[start]
+        return counts, int(self.counts[start:stop].sum())
+
+def build_index(db, session_id, kind):
+    rows = db.execute(
+        select(SessionTimeBucket.bucket, SessionTimeBucket.count, SessionTimeBucket.data)
+        .where(SessionTimeBucket.session_id == session_id, SessionTimeBucket.kind == kind, _geometry())
+        .order_by(SessionTimeBucket.bucket)
+    ).all()
+    shape = timeline_shape()
+    prefix = np.zeros((len(rows) + 1,) + shape, dtype=np.uint32)
+    for i, row in enumerate(rows):
+        prefix[i + 1] = prefix[i] + np.frombuffer(zlib.decompress(row.data), dtype="<u4").reshape(shape)
+    buckets = np.array([row.bucket for row in rows], dtype=np.int64)
+    counts = np.array([row.count for row in rows], dtype=np.int64)
+    for array in (prefix, buckets, counts):
+        array.setflags(write=False)
+    return TimelineIndex(buckets, counts, prefix)
+
+class IndexCache:
+    """LRU of TimelineIndex objects bounded by their total size"""
+
+    def __init__(self, max_bytes=TIMELINE_CACHE_BYTES):
+        self.max_bytes = max_bytes
+        self._indexes = OrderedDict()
+        self._bytes = 0
+        self._lock = threading.Lock()
+
+    def get(self, key, build):
+        with self._lock:
+            index = self._indexes.get(key)
+            if index is not None:
+                self._indexes.move_to_end(key)
+                return index
+        index = build()
+        with self._lock:
+            if key not in self._indexes:
+                self._indexes[key] = index
+                self._bytes += index.nbytes
+            while self._bytes > self.max_bytes and len(self._indexes) > 1:
+                _, evicted = self._indexes.popitem(last=False)
+                self._bytes -= evicted.nbytes
+        return index
+
+index_cache = IndexCache()
+
+def load_index(db, session_id, kind, version):
+    """
+    The session's TimelineIndex for one kind, cached per data version. Samples written since
+    the last read are folded into the bucket grids first, and sessions without bucket grids get
+    them built (both committed).
+    """
+    from .backlog import has_backlog, fold_backlog
+
+    def build():
+        if not _has_index(db, session_id, kind) or has_backlog(db, session_id, kind):
+            try:
+                fold_backlog(db, session_id, kind)
+            except IntegrityError:
+                # Another reader rebuilt them meanwhile; their copy is at least as recent
+                db.rollback()
+        return build_index(db, session_id, kind)
+
+    key = (session_id, kind, version, TIMELINE_BUCKET_MS, GRID_WIDTH, GRID_HEIGHT, TIMELINE_SCALE)
+    return index_cache.get(key, build)
+
+def window_counts(db, session_id, kind, index, start_time=None, end_time=None):
+    """
+    Count grid (at TIMELINE_SCALE) and sample count of the samples with
+    start_time <= t <= end_time (ms since epoch, None = open). Whole buckets come from the
+    prefix sums; the partial buckets at either edge are read from storage.
+    """
+    from .storage import iter_samples
+
+    # Whole buckets inside the window: bucket b spans b*B .. (b+1)*B - 1us
+    first = None if start_time is None else int(np.ceil(start_time / TIMELINE_BUCKET_MS))
+    last = None if end_time is None else int(np.floor((end_time + 0.001) / TIMELINE_BUCKET_MS)) - 1
+
+    edges = []
+    if first is not None and last is not None and first > last:
+        # Too short to contain a whole bucket
+        counts = np.zeros(timeline_shape(), dtype=np.float64)
+        total = 0
+        edges.append((start_time, end_time))
+    else:
+        counts, total = index.range_counts(first, last)
+        if first is not None:
+            edges.append((start_time, first * TIMELINE_BUCKET_MS - 0.001))
+        if last is not None:
+            edges.append(((last + 1) * TIMELINE_BUCKET_MS, end_time))
+
+    for edge_start, edge_end in edges:
+        if edge_start > edge_end:
+            continue
+        for batch in iter_samples(db, session_id, kind, start_time=edge_start, end_time=edge_end):
+            edge_counts, counted = _count(batch)
+            counts += edge_counts
+            total += counted
+    return counts, total
+
+def bucket_activity(index):
+    """Per-bucket sample counts as (bucket start time in ms, count) pairs"""
+    return [(int(bucket) * TIMELINE_BUCKET_MS, int(count)) for bucket, count in zip(index.buckets, index.counts)]
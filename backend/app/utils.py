@@ -4,13 +4,70 @@ import base64
 from sqlalchemy.orm import Session
 import numpy as np
 import cv2
-import matplotlib.pyplot as plt
-from matplotlib.colors import LinearSegmentedColormap
-import io
+from .rendering import render_heatmap_base64
 from scipy.ndimage import gaussian_filter
 from scipy import stats
 from sklearn.metrics import roc_curve, auc
 import math
+import os
+
+# Heatmap quality levels: density is computed on a grid downscaled by this factor, with the
+# kernel scaled to match, and upsampled to the requested size afterwards
+HEATMAP_QUALITY_SCALES = {"full": 1, "high": 2, "medium": 4, "low": 8}
+DEFAULT_HEATMAP_QUALITY = os.environ.get("HEATGAZE_HEATMAP_QUALITY", "medium")
+
+# Gaussian smoothing radius in full-resolution pixels
+HEATMAP_SIGMA = 30
+
+# Densities and the stats computed from them are float32 (a 1920x1080 map is 8 MB)
+HEATMAP_DTYPE = np.float32
+
+# Working memory one heatmap request may use, checked against heatmap_memory_estimate
+# before anything is allocated
+HEATMAP_MEMORY_BUDGET = int(os.environ.get("HEATGAZE_HEATMAP_MEMORY_BUDGET", str(128 * 1024 * 1024)))
+
+# Full-resolution reductions (stats, correlation) walk a map in row blocks with
+# temporaries of about this size instead of allocating whole-map intermediates
+SCRATCH_BLOCK_BYTES = 1024 * 1024
+
+class MemoryBudgetExceeded(Exception):
+    """A heatmap request would need more working memory than HEATMAP_MEMORY_BUDGET"""
+
+def heatmap_memory_estimate(width, height, scale=1, maps=1):
+    """
+    Peak working memory in bytes for rendering maps heatmaps of width x height, with stats,
+    at a density scale: per pixel the float32 density, one float32 working copy (upsampling,
+    median), int32 component labels and uint8 masks/color indices, plus the float64 count
+    grid and its float32 copy at 1/scale resolution
+    """
+    per_pixel = 4 + 4 + 4 + 2 + 12 / (scale * scale)
+    return int(width * height * per_pixel * maps)
+
+def check_memory_budget(width, height, scale=1, maps=1, budget=None):
+    """Raise MemoryBudgetExceeded when a heatmap request would not fit the memory budget"""
+    budget = HEATMAP_MEMORY_BUDGET if budget is None else budget
+    needed = heatmap_memory_estimate(width, height, scale, maps)
+    if budget > 0 and needed > budget:
+        raise MemoryBudgetExceeded(
+            f"{maps} heatmap(s) of {width}x{height} need about {needed // (1024 * 1024)} MB, "
+            f"the budget is {budget // (1024 * 1024)} MB"
+        )
+    return needed
+
+def _row_blocks(shape, block_bytes=SCRATCH_BLOCK_BYTES, itemsize=4):
+    """Row slices covering a 2D array of this shape, block_bytes of itemsize cells each"""
+    rows = max(1, block_bytes // max(1, shape[1] * itemsize))
+    for start in range(0, shape[0], rows):
+        yield slice(start, min(start + rows, shape[0]))
+
+def _mean_std(array):
+    """Mean and standard deviation of an array, accumulated in float64 over row blocks"""
+    mean = float(np.mean(array, dtype=np.float64))
+    squares = 0.0
+    for rows in _row_blocks(array.shape):
+        deviation = array[rows] - np.float32(mean)
+        squares += float(np.dot(deviation.ravel(), deviation.ravel()))
+    return mean, math.sqrt(squares / array.size)
 
 # Database session dependency
 def get_db():
@@ -20,73 +77,120 @@ def get_db():
     finally:
         db.close()
 
+def _coordinate(point, key):
+    """A point's coordinate as a float, NaN when it is missing or not a number"""
+    try:
+        return float(point[key])
+    except (ValueError, TypeError, KeyError):
+        return np.nan
+
+def point_arrays(points):
+    """
+    Coordinates of a point collection as two float64 arrays.
+    Accepts a list of {'x', 'y', ...} dicts or anything with x and y arrays (e.g. a SampleBatch).
+    Invalid points become NaN and are dropped by accumulate_points.
+    """
+    if hasattr(points, "x") and hasattr(points, "y"):
+        return np.asarray(points.x, dtype=np.float64), np.asarray(points.y, dtype=np.float64)
+    count = len(points)
+    x = np.fromiter((_coordinate(p, 'x') for p in points), dtype=np.float64, count=count)
+    y = np.fromiter((_coordinate(p, 'y') for p in points), dtype=np.float64, count=count)
+    return x, y
+
+def accumulate_points(x, y, width, height, scale=1):
+    """
+    Count points per pixel (or per scale x scale block of pixels) in one vectorized pass.
+    Coordinates are truncated toward zero like int(); non-finite and out-of-bounds points are dropped.
+    Returns: (counts as a float64 (ceil(height/scale), ceil(width/scale)) array, number of points counted)
+    """
+    x = np.asarray(x, dtype=np.float64)
+    y = np.asarray(y, dtype=np.float64)
+    # int() maps (-1, width) onto [0, width); NaN fails every comparison
+    valid = (x > -1) & (x < width) & (y > -1) & (y < height)
+
+    grid_width = -(-width // scale)
+    grid_height = -(-height // scale)
+    xi = x[valid].astype(np.int64)
+    yi = y[valid].astype(np.int64)
+    if scale > 1:
+        xi //= scale
+        yi //= scale
+    index = yi * grid_width + xi
+    counts = np.bincount(index, minlength=grid_width * grid_height).astype(np.float64)
+    return counts.reshape(grid_height, grid_width), int(index.size)
+
+def smooth_density(counts, width, height, sigma=HEATMAP_SIGMA, scale=1):
+    """
+    Blur a count grid from accumulate_points with a Gaussian of sigma full-resolution pixels
+    and return it as a (height, width) array. Coarse grids are blurred with sigma / scale and
+    bilinearly upsampled, with values rescaled to per-pixel density.
+    """
+    density = gaussian_filter(np.asarray(counts, dtype=HEATMAP_DTYPE), sigma=sigma / scale, output=HEATMAP_DTYPE)
+    if scale == 1:
+        return density
+    density /= scale * scale
+    upsampled = cv2.resize(
+        density, (counts.shape[1] * scale, counts.shape[0] * scale), interpolation=cv2.INTER_LINEAR
+    )
+    return upsampled[:height, :width]
+
 # Function to generate a simple heatmap
-def generate_heatmap(gaze_data, width, height):
+def generate_heatmap(gaze_data, width, height, quality="full"):
     """
-    Generate a heatmap from gaze data
+    Generate a heatmap from gaze data (a list of point dicts or a SampleBatch)
+    quality picks the density grid resolution (see HEATMAP_QUALITY_SCALES)
     Returns colored heatmap and raw heatmap as base64 encoded strings
     """
     print(f"generate_heatmap called with {len(gaze_data)} points, width={width}, height={height}")
     
     # Validate inputs
-    if not gaze_data:
+    if gaze_data is None or len(gaze_data) == 0:
         print("Warning: No gaze data provided for heatmap generation")
-        empty_heatmap = np.zeros((height, width))
+        empty_heatmap = np.zeros((height, width), dtype=HEATMAP_DTYPE)
         return "", empty_heatmap
     
     if not isinstance(width, int) or not isinstance(height, int) or width <= 0 or height <= 0:
         print(f"Error: Invalid dimensions for heatmap: width={width}, height={height}")
-        return "", np.zeros((100, 100))
-    
-    # Create an empty heatmap
-    heatmap = np.zeros((height, width))
-    
-    # Sigma for Gaussian filter (adjust as needed for smoothness)
-    sigma = 30
+        return "", np.zeros((100, 100), dtype=HEATMAP_DTYPE)
     
-    # Maximum number of points to process to avoid timeouts
-    max_points = 5000
-    if len(gaze_data) > max_points:
-        # Take a sample of points if there are too many
-        import random
-        print(f"Sampling {max_points} points from {len(gaze_data)} total points")
-        gaze_data = random.sample(gaze_data, max_points)
+    if quality not in HEATMAP_QUALITY_SCALES:
+        print(f"Unknown heatmap quality {quality}, using full")
+        quality = "full"
+    scale = HEATMAP_QUALITY_SCALES[quality]
     
-    # Count valid points actually used
-    valid_points = 0
-    
-    # Process gaze points - just mark their positions on the heatmap
-    for point in gaze_data:
-        try:
-            x, y = int(point['x']), int(point['y'])
-            # Skip points outside the screen
-            if 0 <= x < width and 0 <= y < height:
-                heatmap[y, x] += 1
-                valid_points += 1
-            else:
-                print(f"Skipping out-of-bounds point: ({x}, {y})")
-        except (ValueError, TypeError, KeyError) as e:
-            # Skip invalid points
-            print(f"Skipping invalid point: {point}, error: {str(e)}")
-            continue
+    # Mark every point's position on the (possibly coarse) density grid in one pass
+    x, y = point_arrays(gaze_data)
+    heatmap, valid_points = accumulate_points(x, y, width, height, scale=scale)
     
+    skipped = len(x) - valid_points
+    if skipped:
+        print(f"Skipped {skipped} invalid or out-of-bounds points")
     print(f"Added {valid_points} valid points to heatmap")
     
     if valid_points == 0:
         print("Warning: No valid points for heatmap generation")
-        return "", heatmap
+        return "", np.zeros((height, width), dtype=HEATMAP_DTYPE)
     
-    # Apply Gaussian filter for smoothing (much faster than manual calculation)
+    return density_heatmap(heatmap, width, height, scale=scale)
+
+def density_heatmap(counts, width, height, scale=1, sigma=HEATMAP_SIGMA):
+    """
+    Smooth, normalize and render a count grid from accumulate_points (one cell per
+    scale x scale pixels) as a (height, width) heatmap.
+    Returns colored heatmap as a base64 string and the normalized raw (float32) heatmap
+    """
+    # Apply Gaussian filter for smoothing, upsampling coarse grids to full size
     try:
-        heatmap = gaussian_filter(heatmap, sigma=sigma)
-        print(f"Applied Gaussian filter with sigma={sigma}")
+        heatmap = smooth_density(counts, width, height, sigma=sigma, scale=scale)
+        print(f"Applied Gaussian filter with sigma={sigma} at 1/{scale} scale")
     except Exception as e:
         print(f"Error applying Gaussian filter: {str(e)}")
+        heatmap = np.array(counts, dtype=HEATMAP_DTYPE)
     
-    # Normalize the heatmap
-    heatmap_max = np.max(heatmap)
+    # Normalize the heatmap (in place: the density is this function's own array)
+    heatmap_max = float(np.max(heatmap))
     if heatmap_max > 0:
-        heatmap = heatmap / heatmap_max
+        heatmap /= heatmap_max
         print(f"Normalized heatmap. Max value: {heatmap_max}, new max: {np.max(heatmap)}")
     else:
         print("Warning: Empty heatmap (max value is 0)")
@@ -96,26 +200,9 @@ def generate_heatmap(gaze_data, width, height):
     print(f"Heatmap shape: {heatmap.shape}")
     print(f"Non-zero elements: {np.count_nonzero(heatmap)}")
     
-    # Create a custom colormap (transparent blue to red)
-    colors = [(0, 0, 0, 0), (0, 0, 1, 0.3), (0, 1, 1, 0.5), (0, 1, 0, 0.7), (1, 1, 0, 0.8), (1, 0, 0, 0.9)]
-    cmap = LinearSegmentedColormap.from_list('heatmap_cmap', colors)
-    
     try:
-        # Create the plot with transparent background
-        plt.figure(figsize=(width/100, height/100), dpi=100)
-        plt.imshow(heatmap, cmap=cmap)
-        plt.axis('off')
-        
-        # Save the colored heatmap to a BytesIO object
-        buf = io.BytesIO()
-        plt.savefig(buf, format='png', bbox_inches='tight', pad_inches=0, transparent=True)
-        buf.seek(0)
-        
-        # Encode as base64
-        heatmap_colored = base64.b64encode(buf.getvalue()).decode('utf-8')
-        
-        # Close the plot to free memory
-        plt.close()
+        # Map the grid through the cached colormap LUT and encode it at the requested size
+        heatmap_colored = render_heatmap_base64(heatmap)
         
         print(f"Successfully generated heatmap image, size: {len(heatmap_colored)} bytes")
         
@@ -155,30 +242,32 @@ def calculate_kld(P, Q):
     kld = np.sum(P * np.log(P / Q))
     return float(kld)
 
+def _fixation_indices(fixation_points, shape):
+    """Integer (x, y) index arrays of the fixation points that fall inside a map of this shape"""
+    points = np.asarray(fixation_points, dtype=np.float64).reshape(-1, 2)
+    x = np.trunc(points[:, 0])
+    y = np.trunc(points[:, 1])
+    inside = (x >= 0) & (x < shape[1]) & (y >= 0) & (y < shape[0])
+    return x[inside].astype(np.intp), y[inside].astype(np.intp)
+
 # Calculate Normalized Scanpath Saliency
 def calculate_nss(saliency_map, fixation_points):
     """
     Calculate Normalized Scanpath Saliency
     saliency_map: Predicted saliency map
-    fixation_points: List of (x,y) fixation points
+    fixation_points: List (or N x 2 array) of (x,y) fixation points
     
     Returns: NSS value (higher is better)
     """
-    # Normalize saliency map to have zero mean and unit std
-    norm_map = (saliency_map - np.mean(saliency_map)) / (np.std(saliency_map) + 1e-10)
+    # Normalize saliency map to have zero mean and unit std (only at the fixations)
+    mean, std = _mean_std(saliency_map)
     
     # Extract values at fixation points
-    nss_values = []
-    height, width = norm_map.shape
-    
-    for point in fixation_points:
-        x, y = int(point[0]), int(point[1])
-        if 0 <= x < width and 0 <= y < height:
-            nss_values.append(norm_map[y, x])
+    x, y = _fixation_indices(fixation_points, saliency_map.shape)
     
     # Average NSS over all fixation points
-    if len(nss_values) > 0:
-        return float(np.mean(nss_values))
+    if x.size > 0:
+        return float(np.mean((saliency_map[y, x] - mean) / (std + 1e-10)))
     return 0.0
 
 # Calculate Similarity metric
@@ -218,28 +307,27 @@ def calculate_auc(saliency_map, fixation_points, num_samples=10000):
     """
     Calculate Area Under ROC Curve
     saliency_map: Predicted saliency map
-    fixation_points: List of (x,y) fixation points
+    fixation_points: List (or N x 2 array) of (x,y) fixation points
     
     Returns: AUC value (higher is better, range [0,1])
     """
     height, width = saliency_map.shape
+    size = height * width
     
-    # Create fixation map with ones at fixation points
-    fixation_map = np.zeros((height, width))
-    for point in fixation_points:
-        x, y = int(point[0]), int(point[1])
-        if 0 <= x < width and 0 <= y < height:
-            fixation_map[y, x] = 1
-    
-    # Flatten maps
-    sal_flat = saliency_map.flatten()
-    fix_flat = fixation_map.flatten()
+    # Flat indices of the fixated pixels (instead of a full-size fixation map)
+    x, y = _fixation_indices(fixation_points, saliency_map.shape)
+    fixated = np.unique(y * width + x)
     
     # If there are too many pixels, take a random sample for efficiency
-    if len(sal_flat) > num_samples:
-        indices = np.random.choice(len(sal_flat), num_samples, replace=False)
-        sal_flat = sal_flat[indices]
-        fix_flat = fix_flat[indices]
+    if size > num_samples:
+        # Generator.choice draws without replacement without permuting every pixel index
+        indices = np.random.default_rng().choice(size, num_samples, replace=False)
+        sal_flat = saliency_map.ravel()[indices]
+        fix_flat = np.isin(indices, fixated)
+    else:
+        sal_flat = saliency_map.ravel()
+        fix_flat = np.zeros(size, dtype=bool)
+        fix_flat[fixated] = True
     
     # Calculate AUC
     fpr, tpr, _ = roc_curve(fix_flat, sal_flat)
@@ -252,8 +340,8 @@ def calculate_focus_areas(heatmap, threshold=0.5):
     
     Returns: Integer count of focus areas
     """
-    # Threshold the heatmap to find high-density regions
-    binary = (heatmap > threshold * np.max(heatmap)).astype(np.uint8)
+    # Threshold the heatmap to find high-density regions (a bool mask viewed as uint8, no copy)
+    binary = np.greater(heatmap, threshold * np.max(heatmap)).view(np.uint8)
     
     # Find connected components (focus areas)
     num_labels, _ = cv2.connectedComponents(binary)
@@ -268,11 +356,11 @@ def calculate_coverage(heatmap, threshold=0.2):
     
     Returns: Coverage value (0-1)
     """
-    # Threshold the heatmap to find regions with any significant activity
-    binary = (heatmap > threshold * np.max(heatmap)).astype(np.uint8)
+    # Count the pixels with any significant activity
+    covered = np.count_nonzero(heatmap > threshold * np.max(heatmap))
     
     # Calculate the percentage of covered area
-    return float(np.sum(binary) / binary.size)
+    return float(covered / heatmap.size)
 
 # Calculate Attention Score
 def calculate_attention_score(heatmap, point_count):
@@ -284,12 +372,13 @@ def calculate_attention_score(heatmap, point_count):
     # Measures how focused or dispersed attention is based on the entropy of the heatmap
     # Lower entropy means more focused attention
     
-    # Normalize heatmap
-    p = heatmap / (np.sum(heatmap) + 1e-10)
-    
-    # Calculate entropy (avoid log(0))
-    p_positive = p[p > 0]
-    entropy = -np.sum(p_positive * np.log2(p_positive))
+    # Normalize heatmap and calculate entropy (avoid log(0)), one row block at a time
+    total = float(np.sum(heatmap, dtype=np.float64)) + 1e-10
+    entropy = 0.0
+    for rows in _row_blocks(heatmap.shape):
+        p = heatmap[rows] / np.float32(total)
+        p = p[p > 0]
+        entropy -= float(np.dot(p, np.log2(p)))
     
     # Map entropy to a score (0-100), lower entropy = higher score
     max_entropy = math.log2(heatmap.size)  # Maximum possible entropy
@@ -310,31 +399,40 @@ def calculate_intensity_metrics(heatmap):
     
     Returns: Dictionary of intensity metrics
     """
-    # Ensure heatmap is normalized to [0,1] range
-    if np.max(heatmap) > 0:
-        normalized_heatmap = heatmap / np.max(heatmap)
-    else:
-        normalized_heatmap = heatmap
+    # Metrics of the heatmap normalized to [0,1], computed from the heatmap and its peak
+    # (heatmaps from density_heatmap already are, so no normalized copy is made)
+    peak = float(np.max(heatmap))
+    factor = 1.0 / peak if peak > 0 else 1.0
     
     # Calculate basic statistics
-    mean_intensity = float(np.mean(normalized_heatmap))
-    median_intensity = float(np.median(normalized_heatmap))
-    std_dev = float(np.std(normalized_heatmap))
-    max_intensity = float(np.max(normalized_heatmap))
-    min_intensity = float(np.min(normalized_heatmap))
+    mean, std = _mean_std(heatmap)
+    mean_intensity = mean * factor
+    median_intensity = float(np.median(heatmap)) * factor
+    std_dev = std * factor
+    max_intensity = peak * factor
+    min_intensity = float(np.min(heatmap)) * factor
     
     # Calculate proportion of high and low activity zones
     high_threshold = 0.7  # 70% of maximum intensity
     low_threshold = 0.2   # 20% of maximum intensity
     
-    high_activity = float(np.sum(normalized_heatmap > high_threshold) / normalized_heatmap.size)
-    low_activity = float(np.sum(normalized_heatmap < low_threshold) / normalized_heatmap.size)
-    
-    # Calculate gradient magnitude (Sobel operator)
-    gradient_x = cv2.Sobel(normalized_heatmap, cv2.CV_64F, 1, 0, ksize=3)
-    gradient_y = cv2.Sobel(normalized_heatmap, cv2.CV_64F, 0, 1, ksize=3)
-    gradient_magnitude = np.sqrt(gradient_x**2 + gradient_y**2)
-    mean_gradient = float(np.mean(gradient_magnitude))
+    high_activity = float(np.count_nonzero(heatmap > high_threshold / factor) / heatmap.size)
+    low_activity = float(np.count_nonzero(heatmap < low_threshold / factor) / heatmap.size)
+    
+    # Calculate gradient magnitude (Sobel operator) over row blocks with a one-row halo, so
+    # block edges see their real neighbours; Sobel is linear, so scale by factor afterwards
+    source = np.asarray(heatmap, dtype=HEATMAP_DTYPE)
+    rows_total = source.shape[0]
+    gradient_sum = 0.0
+    for rows in _row_blocks(source.shape):
+        top = max(rows.start - 1, 0)
+        bottom = min(rows.stop + 1, rows_total)
+        block = source[top:bottom]
+        gradient_x = cv2.Sobel(block, cv2.CV_32F, 1, 0, ksize=3)
+        gradient_y = cv2.Sobel(block, cv2.CV_32F, 0, 1, ksize=3)
+        cv2.magnitude(gradient_x, gradient_y, gradient_x)
+        gradient_sum += float(np.sum(gradient_x[rows.start - top:rows.stop - top], dtype=np.float64))
+    mean_gradient = gradient_sum / source.size * factor
     
     return {
         "mean_intensity": round(mean_intensity, 3),
@@ -347,20 +445,51 @@ def calculate_intensity_metrics(heatmap):
         "mean_gradient": round(mean_gradient, 3)
     }
 
+def _uniform_baseline_metrics(heatmap):
+    """
+    calculate_kld, calculate_similarity and calculate_cc of a heatmap against a uniform map,
+    with the uniform map as a constant instead of a full-size array. Returns (kld, sim, cc).
+    """
+    size = heatmap.size
+    uniform = 1.0 / size
+    
+    # KLD: P is the heatmap clipped at 1e-10 and normalized, Q is uniform
+    clipped_total = 0.0
+    for rows in _row_blocks(heatmap.shape):
+        clipped_total += float(np.sum(np.maximum(heatmap[rows], np.float32(1e-10)), dtype=np.float64))
+    total = float(np.sum(heatmap, dtype=np.float64))
+    kld = 0.0
+    sim = 0.0
+    uniform_share = np.float32(uniform / (1.0 + 1e-10))
+    for rows in _row_blocks(heatmap.shape):
+        block = heatmap[rows]
+        p = np.maximum(block, np.float32(1e-10))
+        p /= np.float32(clipped_total)
+        kld += float(np.dot(p.ravel(), np.log(p * np.float32(size)).ravel()))
+        # SIM: histogram intersection of the normalized heatmap and the uniform map
+        p = block / np.float32(total + 1e-10)
+        sim += float(np.sum(np.minimum(p, uniform_share), dtype=np.float64))
+    
+    # CC: a uniform map has no variance, so the correlation is undefined (NaN, as from np.corrcoef)
+    return kld, sim, float("nan")
+
 # Function to calculate heatmap statistics
-def calculate_heatmap_stats(heatmap, gaze_points=None):
+def calculate_heatmap_stats(heatmap, gaze_points=None, point_count=None):
     """
     Calculate comprehensive statistics for heatmap analysis
     
     Args:
         heatmap: The heatmap as a numpy array
-        gaze_points: List of gaze points with x,y coordinates (optional)
+        gaze_points: List of gaze points with x,y coordinates, or an N x 2 array of
+            (x, y) fixation positions (optional)
+        point_count: Number of points behind the heatmap (defaults to len(gaze_points))
         
     Returns:
         Dictionary of statistics
     """
     try:
-        point_count = len(gaze_points) if gaze_points else 0
+        if point_count is None:
+            point_count = len(gaze_points) if gaze_points is not None else 0
         
         # Handle empty heatmap
         if np.sum(heatmap) == 0:
@@ -394,22 +523,22 @@ def calculate_heatmap_stats(heatmap, gaze_points=None):
         intensity_metrics = calculate_intensity_metrics(heatmap)
         
         # Advanced statistics (only if we have gaze points)
-        if gaze_points and len(gaze_points) > 5:
-            # Create a uniform distribution as the baseline for comparison
-            uniform_map = np.ones_like(heatmap) / heatmap.size
-            
+        if gaze_points is not None and len(gaze_points) > 5:
             # Extract (x,y) coordinates from gaze points
-            coords = [(p['x'], p['y']) for p in gaze_points 
-                      if 'x' in p and 'y' in p and 
-                      0 <= p['x'] < heatmap.shape[1] and 
-                      0 <= p['y'] < heatmap.shape[0]]
+            if isinstance(gaze_points, np.ndarray):
+                x, y = _fixation_indices(gaze_points, heatmap.shape)
+                coords = np.column_stack((x, y))
+            else:
+                coords = [(p['x'], p['y']) for p in gaze_points 
+                          if 'x' in p and 'y' in p and 
+                          0 <= p['x'] < heatmap.shape[1] and 
+                          0 <= p['y'] < heatmap.shape[0]]
             
             # Calculate advanced metrics if we have enough points
             if len(coords) > 5:
-                kld = calculate_kld(heatmap, uniform_map)
+                # Compare against a uniform distribution as the baseline
+                kld, sim, cc = _uniform_baseline_metrics(heatmap)
                 nss = calculate_nss(heatmap, coords)
-                sim = calculate_similarity(heatmap, uniform_map)
-                cc = calculate_cc(heatmap, uniform_map)
                 auc_score = calculate_auc(heatmap, coords, num_samples=5000)
                 
                 # Ensure values are within expected ranges
@@ -502,43 +631,59 @@ def calculate_correlation_metrics(gaze_heatmap, cursor_heatmap):
         }
     
     try:
-        # Normalize both heatmaps
-        gaze_norm = normalize_heatmap(gaze_heatmap)
-        cursor_norm = normalize_heatmap(cursor_heatmap)
+        # Normalize both heatmaps to sum to 1 (as factors; the normalized maps are only
+        # formed one row block at a time)
+        gaze_total = float(np.sum(gaze_heatmap, dtype=np.float64))
+        cursor_total = float(np.sum(cursor_heatmap, dtype=np.float64))
+        gaze_factor = np.float32(1.0 / gaze_total if gaze_total != 0 else 1.0)
+        cursor_factor = np.float32(1.0 / cursor_total if cursor_total != 0 else 1.0)
+        size = gaze_heatmap.size
+        gaze_mean = float(np.mean(gaze_heatmap, dtype=np.float64)) * float(gaze_factor)
+        cursor_mean = float(np.mean(cursor_heatmap, dtype=np.float64)) * float(cursor_factor)
         
-        print(f"Normalized heatmaps - gaze: min={gaze_norm.min()}, max={gaze_norm.max()}, mean={gaze_norm.mean()}")
-        print(f"Normalized heatmaps - cursor: min={cursor_norm.min()}, max={cursor_norm.max()}, mean={cursor_norm.mean()}")
+        print(f"Normalized heatmaps - gaze: min={float(np.min(gaze_heatmap)) * gaze_factor}, max={float(np.max(gaze_heatmap)) * gaze_factor}, mean={gaze_mean}")
+        print(f"Normalized heatmaps - cursor: min={float(np.min(cursor_heatmap)) * cursor_factor}, max={float(np.max(cursor_heatmap)) * cursor_factor}, mean={cursor_mean}")
         
-        # Calculate Pearson's Correlation Coefficient
-        cc = np.corrcoef(gaze_norm.flatten(), cursor_norm.flatten())[0, 1]
+        # Pearson's Correlation Coefficient, Histogram Intersection and KL Divergence
+        # (with small epsilon to avoid log(0)), accumulated in float64 per row block
+        epsilon = np.float32(1e-10)
+        covariance = gaze_square = cursor_square = 0.0
+        hi = kl = 0.0
+        for rows in _row_blocks(gaze_heatmap.shape):
+            gaze_norm = np.multiply(gaze_heatmap[rows], gaze_factor, dtype=HEATMAP_DTYPE).ravel()
+            cursor_norm = np.multiply(cursor_heatmap[rows], cursor_factor, dtype=HEATMAP_DTYPE).ravel()
+            hi += float(np.sum(np.minimum(gaze_norm, cursor_norm), dtype=np.float64))
+            ratio = (gaze_norm + epsilon) / (cursor_norm + epsilon)
+            kl += float(np.dot(gaze_norm, np.log(ratio, out=ratio)))
+            gaze_norm -= np.float32(gaze_mean)
+            cursor_norm -= np.float32(cursor_mean)
+            covariance += float(np.dot(gaze_norm, cursor_norm))
+            gaze_square += float(np.dot(gaze_norm, gaze_norm))
+            cursor_square += float(np.dot(cursor_norm, cursor_norm))
+        cc = covariance / math.sqrt(gaze_square * cursor_square) if gaze_square > 0 and cursor_square > 0 else float("nan")
         print(f"Calculated correlation coefficient: {cc}")
-        
-        # Calculate Histogram Intersection
-        hi = np.sum(np.minimum(gaze_norm, cursor_norm))
         print(f"Calculated histogram intersection: {hi}")
-        
-        # Calculate KL Divergence (with small epsilon to avoid log(0))
-        epsilon = 1e-10
-        kl = np.sum(gaze_norm * np.log((gaze_norm + epsilon) / (cursor_norm + epsilon)))
         print(f"Calculated KL divergence: {kl}")
         
-        # Calculate IoU for hotspots (using 90th percentile threshold)
+        # Calculate IoU for hotspots (using 90th percentile threshold; normalizing by a
+        # positive factor doesn't change which cells are above it)
         threshold = 0.9
         try:
-            t1 = np.percentile(gaze_norm, threshold * 100)
-            t2 = np.percentile(cursor_norm, threshold * 100)
-            print(f"Percentile thresholds - gaze: {t1}, cursor: {t2}")
+            t1 = np.percentile(gaze_heatmap, threshold * 100)
+            t2 = np.percentile(cursor_heatmap, threshold * 100)
+            print(f"Percentile thresholds - gaze: {t1 * gaze_factor}, cursor: {t2 * cursor_factor}")
             
-            mask1 = gaze_norm >= t1
-            mask2 = cursor_norm >= t2
+            mask1 = gaze_heatmap >= t1
+            mask2 = cursor_heatmap >= t2
             
-            intersection = np.logical_and(mask1, mask2).sum()
-            union = np.logical_or(mask1, mask2).sum()
+            intersection = np.count_nonzero(mask1 & mask2)
+            union = np.count_nonzero(mask1 | mask2)
             iou = intersection / union if union != 0 else 0
             print(f"IoU calculation - intersection: {intersection}, union: {union}, iou: {iou}")
             
             # Find common hotspots
-            common_hotspots = np.argwhere(np.logical_and(mask1, mask2))
+            mask1 &= mask2
+            common_hotspots = np.argwhere(mask1)
             hotspot_count = len(common_hotspots)
             print(f"Found {hotspot_count} common hotspots")
         except Exception as iou_error:
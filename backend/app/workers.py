@@ -0,0 +1,80 @@
+from concurrent.futures import ThreadPoolExecutor
+from functools import partial, wraps
+from .database import SessionLocal
+import asyncio
+import os
+import threading
+
+# CPU-heavy analytics (density smoothing, stats, image rendering) run on this pool instead of
+# the event loop, so ingestion and other requests keep being served while reports render.
+# NumPy, SciPy, OpenCV and zlib release the GIL in their inner loops, so threads scale here.
+ANALYTICS_WORKERS = int(os.environ.get("HEATGAZE_ANALYTICS_WORKERS", str(min(4, os.cpu_count() or 1))))
+
+# Seconds a route waits for an analytics task before giving up with a 504
+ANALYTICS_TIMEOUT = float(os.environ.get("HEATGAZE_ANALYTICS_TIMEOUT", "60"))
+
+class AnalyticsTimeout(Exception):
+    """An analytics task did not finish within its timeout"""
+
+class AnalyticsPool:
+    """
+    Bounded thread pool for analytics tasks, created on first use. Tasks that time out keep
+    running to completion in their thread (threads can't be interrupted); only their result
+    is discarded, so size the pool for the slowest reports.
+    """
+
+    def __init__(self, workers=ANALYTICS_WORKERS, timeout=ANALYTICS_TIMEOUT):
+        self.workers = max(1, workers)
+        self.timeout = timeout
+        self._executor = None
+        self._lock = threading.Lock()
+
+    def _get_executor(self):
+        with self._lock:
+            if self._executor is None:
+                self._executor = ThreadPoolExecutor(max_workers=self.workers, thread_name_prefix="analytics")
+            return self._executor
+
+    async def run(self, func, *args, timeout=None, **kwargs):
+        """Run func(*args, **kwargs) on the pool and await its result"""
+        timeout = self.timeout if timeout is None else timeout
+        loop = asyncio.get_running_loop()
+        future = loop.run_in_executor(self._get_executor(), partial(func, *args, **kwargs))
+        try:
+            return await asyncio.wait_for(future, timeout=timeout if timeout > 0 else None)
+        except asyncio.TimeoutError:
+            name = getattr(func, "__name__", "task")
+            print(f"Analytics task {name} timed out after {timeout}s")
+            raise AnalyticsTimeout(f"{name} did not finish within {timeout} seconds")
+
+    def submit(self, func, *args, **kwargs):
+        """Queue func(*args, **kwargs) without waiting for it (background jobs). Returns a Future."""
+        return self._get_executor().submit(func, *args, **kwargs)
+
+    def shutdown(self, wait=True):
+        with self._lock:
+            executor, self._executor = self._executor, None
+        if executor is not None:
+            executor.shutdown(wait=wait)
+
+def with_db_session(func):
+    """
+    Wrap func(db, *args) into a pool task that opens and closes its own database session.
+    Tasks can outlive the request that started them (timeouts), so they must never use the
+    request's Session or its ORM instances: pass ids and plain values instead.
+    """
+    @wraps(func)
+    def task(*args, **kwargs):
+        db = SessionLocal()
+        try:
+            return func(db, *args, **kwargs)
+        finally:
+            db.close()
+    return task
+
+# Shared pool for the heatmap and cursor visualization routes
+analytics_pool = AnalyticsPool()
+
+async def run_analytics(func, *args, timeout=None, **kwargs):
+    """Await func(*args, **kwargs) on the shared analytics pool"""
+    return await analytics_pool.run(func, *args, timeout=timeout, **kwargs)
@@ -0,0 +1,101 @@
+"""
+Benchmark for the working memory of one heatmap request
+Renders what GET /api/sessions/{id}/heatmap computes (gaze and cursor heatmaps from count
+grids, their stats and the correlation metrics) at each quality level, each in a fresh
+process, and reports the peak RSS growth over the process baseline, the peak of traced
+allocations (tracemalloc: NumPy arrays and Python objects, including the response's
+hotspot list) and the budget estimate from app.utils.heatmap_memory_estimate
+Run this script directly: python bench_heatmap_memory.py [num_points] [width] [height]
+"""
+import sys
+import os
+import json
+import time
+import resource
+import subprocess
+import tracemalloc
+import contextlib
+import numpy as np
+
+from app.grids import count_grid, grid_heatmap, fit_grid, fixation_cells
+from app.ingest import batch_from_points
+from app.utils import (
+    calculate_heatmap_stats, calculate_correlation_metrics, heatmap_memory_estimate,
+    HEATMAP_QUALITY_SCALES, HEATMAP_MEMORY_BUDGET
+)
+
+def peak_rss_bytes():
+    """Peak resident set size of this process so far (ru_maxrss is KiB on Linux, bytes on macOS)"""
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    return peak if sys.platform == "darwin" else peak * 1024
+
+def make_counts(num_points, seed):
+    """Count grid of normally distributed points around the screen center"""
+    rng = np.random.default_rng(seed)
+    points = [{
+        "timestamp": i * 16.7,
+        "x": float(rng.normal(960, 350)),
+        "y": float(rng.normal(540, 250))
+    } for i in range(num_points)]
+    return count_grid(batch_from_points(points))
+
+def render_request(gaze, cursor, width, height, quality):
+    """The heatmap route's work for one session, without the database"""
+    results = []
+    for counts, total in (gaze, cursor):
+        image, raw = grid_heatmap(counts, width, height, quality=quality)
+        stats = calculate_heatmap_stats(raw, fixation_cells(fit_grid(counts, width, height)), point_count=total)
+        results.append((image, raw, stats))
+    metrics = calculate_correlation_metrics(results[0][1], results[1][1])
+    return results, metrics
+
+def run_case(quality, num_points, width, height):
+    """Child process: measure one request at one quality level and print a JSON line"""
+    gaze = make_counts(num_points, 1)
+    cursor = make_counts(num_points, 2)
+    baseline = peak_rss_bytes()
+    started = time.perf_counter()
+    with contextlib.redirect_stdout(open(os.devnull, "w")):
+        render_request(gaze, cursor, width, height, quality)
+    elapsed = time.perf_counter() - started
+    rss_growth = max(0, peak_rss_bytes() - baseline)
+
+    # Traced separately: tracemalloc slows down the Python-object-heavy parts a lot
+    tracemalloc.start()
+    with contextlib.redirect_stdout(open(os.devnull, "w")):
+        render_request(gaze, cursor, width, height, quality)
+    _, traced_peak = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+    print(json.dumps({
+        "quality": quality,
+        "rss_growth": rss_growth,
+        "traced_peak": traced_peak,
+        "seconds": elapsed
+    }))
+
+def run(quality, num_points, width, height):
+    """Run one case in a fresh process (ru_maxrss can't be reset) and return its measurements"""
+    output = subprocess.run(
+        [sys.executable, __file__, "--case", quality, str(num_points), str(width), str(height)],
+        capture_output=True, text=True, check=True
+    ).stdout
+    return json.loads(output.strip().splitlines()[-1])
+
+if __name__ == "__main__":
+    if len(sys.argv) > 1 and sys.argv[1] == "--case":
+        run_case(sys.argv[2], int(sys.argv[3]), int(sys.argv[4]), int(sys.argv[5]))
+        sys.exit(0)
+
+    num_points = int(sys.argv[1]) if len(sys.argv) > 1 else 50000
+    width = int(sys.argv[2]) if len(sys.argv) > 2 else 1920
+    height = int(sys.argv[3]) if len(sys.argv) > 3 else 1080
+    mb = 1024 * 1024
+
+    print(f"Combined gaze + cursor heatmap request, {num_points} points each, {width}x{height}")
+    print(f"Budget: {HEATMAP_MEMORY_BUDGET / mb:.0f} MB (HEATGAZE_HEATMAP_MEMORY_BUDGET)")
+    for quality, scale in HEATMAP_QUALITY_SCALES.items():
+        result = run(quality, num_points, width, height)
+        estimate = heatmap_memory_estimate(width, height, scale, maps=2)
+        print(f"{quality:>7}: peak RSS +{result['rss_growth'] / mb:6.1f} MB, "
+              f"traced peak {result['traced_peak'] / mb:6.1f} MB, "
+              f"estimate {estimate / mb:6.1f} MB, {result['seconds'] * 1000:7.1f} ms")
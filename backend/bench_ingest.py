@@ -0,0 +1,127 @@
+"""
+Benchmark for batch ingestion of gaze points
+Compares the per-object ORM loop with the bulk Core insert path in app/ingest.py,
+and the size/decode cost of the JSON, columnar JSON and packed binary payloads
+Run this script directly: python bench_ingest.py [num_points] [batch_size]
+"""
+import sys
+import time
+import random
+from datetime import datetime
+from sqlalchemy import create_engine
+from sqlalchemy.orm import sessionmaker
+
+from app.database import Base
+from app.models import Session as SessionModel, GazeData
+from app.ingest import batch_from_points
+from app.storage import write_samples
+from app.columnar import decode_payload, encode_binary, BINARY_CONTENT_TYPE
+from app.schemas import GazeDataCreate
+import json
+
+def make_db():
+    """Create a fresh in-memory database with one session"""
+    engine = create_engine("sqlite://")
+    Base.metadata.create_all(bind=engine)
+    db = sessionmaker(bind=engine)()
+    session = SessionModel(name="bench", device_info="bench")
+    db.add(session)
+    db.commit()
+    return db, session.id
+
+def generate_batches(num_points, batch_size):
+    """Generate gaze batches shaped like the frontend payload"""
+    start = time.time() * 1000
+    points = [{
+        "timestamp": start + i * 16.7,
+        "x": random.uniform(0, 1920),
+        "y": random.uniform(0, 1080),
+        "pupilLeftSize": random.uniform(2, 6),
+        "pupilRightSize": random.uniform(2, 6)
+    } for i in range(num_points)]
+    return [points[i:i + batch_size] for i in range(0, num_points, batch_size)]
+
+def ingest_orm(db, session_id, batch):
+    """The original per-object loop"""
+    session = db.query(SessionModel).filter(SessionModel.id == session_id).first()
+    for point in batch:
+        db.add(GazeData(
+            session_id=session_id,
+            timestamp=datetime.fromtimestamp(point['timestamp'] / 1000.0),
+            x=point['x'],
+            y=point['y'],
+            pupil_left=None,
+            pupil_right=None
+        ))
+    session.updated_at = datetime.now()
+    db.commit()
+
+def ingest_bulk(db, session_id, batch):
+    """The bulk Core insert path used by the batch endpoints"""
+    sample_batch = batch_from_points(batch, with_pupils=True)
+    write_samples(db, session_id, gaze=sample_batch)
+    db.commit()
+
+def run(name, ingest, batches):
+    db, session_id = make_db()
+    total = sum(len(b) for b in batches)
+    started = time.perf_counter()
+    for batch in batches:
+        ingest(db, session_id, batch)
+    elapsed = time.perf_counter() - started
+    stored = db.query(GazeData).count()
+    db.close()
+    print(f"{name:>5}: {total} points in {elapsed:.3f}s -> {total / elapsed:,.0f} points/sec (stored {stored})")
+    return total / elapsed
+
+def compare_payloads(batches, repeat=5):
+    """Payload size and decode time for each accepted batch format"""
+    payloads = []
+    for batch in batches:
+        sample_batch = batch_from_points(batch, with_pupils=True)
+        payloads.append({
+            "points": json.dumps(batch).encode(),
+            "columns": json.dumps({
+                "t": sample_batch.timestamps.tolist(),
+                "x": sample_batch.x.tolist(),
+                "y": sample_batch.y.tolist(),
+                "pupil_left": sample_batch.pupil_left.tolist(),
+                "pupil_right": sample_batch.pupil_right.tolist()
+            }).encode(),
+            "binary": encode_binary(sample_batch)
+        })
+
+    def timed(decode):
+        started = time.perf_counter()
+        for _ in range(repeat):
+            for payload in payloads:
+                decode(payload)
+        return (time.perf_counter() - started) / repeat
+
+    formats = [
+        ("pydantic", "points", lambda p: GazeDataCreate(gazeData=json.loads(p["points"]))),
+        ("points", "points", lambda p: decode_payload(p["points"], "application/json", with_pupils=True)),
+        ("columns", "columns", lambda p: decode_payload(p["columns"], "application/json", with_pupils=True)),
+        ("binary", "binary", lambda p: decode_payload(p["binary"], BINARY_CONTENT_TYPE, with_pupils=True)),
+    ]
+    baseline_size = baseline_time = None
+    for name, key, decode in formats:
+        size = sum(len(p[key]) for p in payloads)
+        elapsed = timed(decode)
+        baseline_size = baseline_size or size
+        baseline_time = baseline_time or elapsed
+        print(f"{name:>8}: {size:>10,} bytes ({baseline_size / size:4.1f}x smaller), "
+              f"decode {elapsed * 1000:8.1f} ms ({baseline_time / elapsed:5.1f}x faster)")
+
+if __name__ == "__main__":
+    num_points = int(sys.argv[1]) if len(sys.argv) > 1 else 100000
+    batch_size = int(sys.argv[2]) if len(sys.argv) > 2 else 500
+    batches = generate_batches(num_points, batch_size)
+
+    print(f"Ingesting {num_points} gaze points in batches of {batch_size}")
+    orm_rate = run("orm", ingest_orm, batches)
+    bulk_rate = run("bulk", ingest_bulk, batches)
+    print(f"Speedup: {bulk_rate / orm_rate:.1f}x")
+
+    print("\nPayload formats (gaze points with pupil sizes)")
+    compare_payloads(batches)
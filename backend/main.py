@@ -7,16 +7,21 @@ from fastapi.security import OAuth2PasswordBearer, OAuth2PasswordRequestForm
 import uvicorn
 import os
 from app.database import engine, Base
+from app.migrations import upgrade_schema
 from app.models import User
 from app.utils import get_db
+from app.ingest_queue import ingest_queue
+from app.workers import analytics_pool
+from app.jobs import resume_heatmap_jobs
 from sqlalchemy.orm import Session
 from pydantic import BaseModel
 from datetime import datetime, timedelta
 from typing import Optional
 from routes.auth import get_password_hash  # Import the proper password hashing function
 
-# Create tables if they don't exist yet
+# Create tables if they don't exist yet, then apply schema changes to existing ones
 Base.metadata.create_all(bind=engine)
+upgrade_schema(engine)
 
 app = FastAPI(title="HeatGaze - Анализ тепловых карт в реальном времени")
 
@@ -42,7 +47,7 @@ app.mount("/static", StaticFiles(directory="static"), name="static")
 templates = Jinja2Templates(directory="templates")
 
 # Import routes after app is created to avoid circular imports
-from routes import gaze_data, auth, heatmap, pages, cursor_data
+from routes import gaze_data, auth, heatmap, pages, cursor_data, stream, export
 
 # Include routers
 app.include_router(auth.router, prefix="/api", tags=["Auth"])
@@ -50,6 +55,8 @@ app.include_router(gaze_data.router, prefix="/api", tags=["Gaze Data"])
 app.include_router(cursor_data.router, prefix="/api", tags=["Cursor Data"])
 app.include_router(heatmap.router, prefix="/api", tags=["Heatmap"])
 app.include_router(pages.router, prefix="/api", tags=["Demo Pages"])
+app.include_router(stream.router, prefix="/api", tags=["Streaming"])
+app.include_router(export.router, prefix="/api", tags=["Export"])
 
 # OAuth2 scheme
 oauth2_scheme = OAuth2PasswordBearer(tokenUrl="/api/token")
@@ -89,6 +96,42 @@ async def add_test_user():
         # Log error but don't crash the app
         print(f"Error creating test user: {e}")
 
+# Replay ingestion journal segments that were accepted but never committed (e.g. after a crash)
+@app.on_event("startup")
+async def recover_ingest_journal():
+    try:
+        replayed = ingest_queue.recover()
+        if replayed:
+            print(f"Recovered {replayed} samples from the ingestion journal")
+    except Exception as e:
+        # Keep the segments on disk so the next start can try again
+        print(f"Error recovering ingestion journal: {e}")
+
+# Requeue heatmap jobs interrupted by the last shutdown
+@app.on_event("startup")
+async def resume_heatmap_generation():
+    try:
+        resumed = resume_heatmap_jobs()
+        if resumed:
+            print(f"Resumed {resumed} heatmap generation jobs")
+    except Exception as e:
+        print(f"Error resuming heatmap jobs: {e}")
+
+# Start the write-behind ingestion queue
+@app.on_event("startup")
+async def start_ingest_queue():
+    await ingest_queue.start()
+
+# Drain queued samples before the worker exits
+@app.on_event("shutdown")
+async def stop_ingest_queue():
+    await ingest_queue.stop()
+
+# Let running analytics tasks finish before the worker exits
+@app.on_event("shutdown")
+async def stop_analytics_pool():
+    analytics_pool.shutdown()
+
 # Remove the duplicate authentication endpoints
 # We will use the ones from routes/auth.py instead
 # This means we need to delete the login, register, and users/me endpoints
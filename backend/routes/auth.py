@@ -114,6 +114,19 @@ def get_current_user_from_token(token: str):
         
     return user
 
+# Resolve a user from a raw JWT using an existing DB session (WebSocket handshakes can't use Depends(oauth2_scheme))
+def get_user_from_token(db, token: str):
+    if not token:
+        return None
+    try:
+        payload = jwt.decode(token, SECRET_KEY, algorithms=[ALGORITHM])
+    except JWTError:
+        return None
+    username = payload.get("sub")
+    if username is None:
+        return None
+    return get_user(db, username=username)
+
 # Routes
 @router.post("/register", response_model=UserOut)
 def register_user(user: UserCreate, db: Session = Depends(get_db)):
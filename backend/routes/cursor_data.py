@@ -1,12 +1,21 @@
-from fastapi import APIRouter, Depends, HTTPException, status, Body
+from fastapi import APIRouter, Depends, HTTPException, status, Body, Request, Header
 from sqlalchemy.orm import Session
 from app.utils import get_db
 from app.models import Session as SessionModel, CursorData, User
 from app.schemas import SessionResponse, CursorDataCreate, CursorDataResponse
-from typing import List, Dict, Any
+from app.ingest_queue import ingest_queue, QueueFullError
+from app.columnar import decode_payload
+from app.ingest import batch_from_points
+from app.storage import write_samples, load_samples, read_page, DEFAULT_PAGE_SIZE
+from app.workers import run_analytics, AnalyticsTimeout
+from app.cache import heatmap_cache, cache_key
+from app.etags import make_etag, etag_matches, not_modified, image_response, IMAGE_MEDIA_TYPES
+from app.rendering import convert_image
+from typing import List, Dict, Any, Optional
 from datetime import datetime, timedelta
 from routes.auth import get_current_user, create_access_token
 from fastapi.responses import JSONResponse, HTMLResponse
+import base64
 import sys
 import os
 import importlib.util
@@ -17,7 +26,7 @@ sys.path.append(os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
 # Try different approaches to import the mouse_heatmap module
 try:
     # First approach: direct import
-    from utils.mouse_heatmap import create_mouse_heatmap, create_time_based_heatmap, create_trajectory_plot
+    from utils.mouse_heatmap import create_mouse_heatmap, create_time_based_heatmap, create_trajectory_plot, RENDERERS, DEFAULT_RENDERER, FAST_RENDER_VERSION
 except ImportError:
     try:
         # Second approach: absolute import with sys.path modification
@@ -29,7 +38,7 @@ except ImportError:
             sys.path.insert(0, utils_dir)
             
         # Try to import after path modification
-        from mouse_heatmap import create_mouse_heatmap, create_time_based_heatmap, create_trajectory_plot
+        from mouse_heatmap import create_mouse_heatmap, create_time_based_heatmap, create_trajectory_plot, RENDERERS, DEFAULT_RENDERER, FAST_RENDER_VERSION
     except ImportError:
         # Third approach: manual module loading
         try:
@@ -44,6 +53,9 @@ except ImportError:
             create_mouse_heatmap = mouse_heatmap.create_mouse_heatmap
             create_time_based_heatmap = mouse_heatmap.create_time_based_heatmap
             create_trajectory_plot = mouse_heatmap.create_trajectory_plot
+            RENDERERS = mouse_heatmap.RENDERERS
+            DEFAULT_RENDERER = mouse_heatmap.DEFAULT_RENDERER
+            FAST_RENDER_VERSION = mouse_heatmap.FAST_RENDER_VERSION
         except Exception as e:
             print(f"Failed to import mouse_heatmap module: {e}")
             # Define stub functions as fallback
@@ -56,23 +68,50 @@ except ImportError:
             def create_trajectory_plot(*args, **kwargs):
                 return None, {"error": "Module not available"}
 
+            RENDERERS = ("fast",)
+            DEFAULT_RENDERER = "fast"
+            FAST_RENDER_VERSION = 0
+
 # Router
 router = APIRouter()
 
+def _renderer(name):
+    """Requested mouse_heatmap renderer, falling back to the default"""
+    return name if name in RENDERERS else DEFAULT_RENDERER
+
+def _plot_response(result, stats, count, renderer):
+    """JSON body for a mouse_heatmap result: a base64 PNG, or the Plotly figure for renderer=plotly"""
+    key = "figure" if _renderer(renderer) == "plotly" else "image"
+    return {
+        key: result,
+        "stats": stats,
+        "count": count
+    }
+
+def format_cursor_points(batch):
+    """Convert loaded cursor samples into the dicts the mouse_heatmap functions take"""
+    if batch is None:
+        return []
+    return [
+        {"x": x, "y": y, "timestamp": int(t)}  # Timestamp in milliseconds
+        for t, x, y in zip(batch.timestamps.tolist(), batch.x.tolist(), batch.y.tolist())
+    ]
+
 @router.post("/sessions/{session_id}/cursor/batch")
 async def save_cursor_data_batch(
     session_id: int,
-    data: List[dict] = Body(...),
+    request: Request,
     current_user: User = Depends(get_current_user),
     db: Session = Depends(get_db)
 ):
-    """Save a batch of cursor data points for a specific session"""
-    print(f"Received batch of {len(data)} gaze points for session {session_id}")
-    print(f"User: {current_user.username} (ID: {current_user.id})")
-    print(f"Data sample: {data[0] if data else 'No data'}")
-    
+    """
+    Save a batch of cursor data points for a specific session.
+    The body is either a JSON list of points, a columnar JSON object
+    ({"t": [...], "x": [...], "y": [...]}) or the packed binary format sent as
+    application/x-heatgaze-columnar.
+    """
     # Check if session exists and belongs to user
-    session = db.query(SessionModel).filter(
+    session = db.query(SessionModel.id).filter(
         SessionModel.id == session_id,
         SessionModel.user_id == current_user.id
     ).first()
@@ -81,60 +120,25 @@ async def save_cursor_data_batch(
         print(f"Session {session_id} not found or doesn't belong to user {current_user.id}")
         raise HTTPException(status_code=404, detail="Session not found")
     
-    print(f"Found session: {session.name}")
-    
-    # Print sample data for debugging
-    if data and len(data) > 0:
-        sample_point = data[0]
-        print(f"Sample cursor point: {sample_point}")
-        print(f"Timestamp type: {type(sample_point.get('timestamp'))}")
-        print(f"X value: {sample_point.get('x')}, Y value: {sample_point.get('y')}")
-    
-    # Process the batch of cursor data
-    points_added = 0
+    # Decode and validate the whole batch at once.
+    # Non-numeric timestamps are parsed as ISO strings, falling back to the arrival time.
     try:
-        for point in data:
-            try:
-                # Handle timestamp conversion more robustly
-                timestamp = point.get('timestamp')
-                if isinstance(timestamp, (int, float)):
-                    # Convert milliseconds to seconds for datetime.fromtimestamp
-                    timestamp_seconds = timestamp / 1000.0
-                    timestamp_dt = datetime.fromtimestamp(timestamp_seconds)
-                else:
-                    # If it's already a string or other format, try parsing it
-                    try:
-                        timestamp_dt = datetime.fromisoformat(str(timestamp))
-                    except:
-                        # Fallback to current time if parsing fails
-                        timestamp_dt = datetime.now()
-                        print(f"Warning: Could not parse timestamp '{timestamp}', using current time instead")
-                
-                cursor_data = CursorData(
-                    session_id=session_id,
-                    timestamp=timestamp_dt,
-                    x=float(point['x']),
-                    y=float(point['y'])
-                )
-                db.add(cursor_data)
-                points_added += 1
-            except Exception as e:
-                print(f"Error adding cursor point: {e}")
-                print(f"Point data: {point}")
-                import traceback
-                print(traceback.format_exc())
-        
-        # Update session last updated time
-        session.updated_at = datetime.now()
-        
-        db.commit()
-        print(f"Successfully added {points_added} cursor points to session {session_id}")
-    except Exception as e:
-        print(f"Error committing cursor data: {e}")
-        import traceback
-        print(traceback.format_exc())
-        db.rollback()
-        raise HTTPException(status_code=500, detail=f"Failed to save cursor data: {str(e)}")
+        batch = decode_payload(
+            await request.body(),
+            request.headers.get("content-type"),
+            parse_string_timestamps=True
+        )
+    except ValueError as e:
+        raise HTTPException(status_code=422, detail=f"Invalid cursor batch: {str(e)}")
+    # Hand the batch to the write-behind queue; it is committed with the next group commit
+    try:
+        await ingest_queue.submit(session_id, cursor=batch)
+    except QueueFullError as e:
+        raise HTTPException(status_code=503, detail=str(e), headers={"Retry-After": "1"})
+    points_added = len(batch)
+    
+    if batch.rejected:
+        print(f"Skipped {batch.rejected} invalid cursor points for session {session_id}")
     
     return {"status": "success", "points_added": points_added}
 
@@ -161,25 +165,10 @@ async def add_cursor_data(
     
     print(f"Found session: {session.name}")
     
-    # Add all cursor data points
-    points_added = 0
-    for point in data.cursorData:
-        try:
-            cursor_data = CursorData(
-                session_id=session_id,
-                timestamp=datetime.fromtimestamp(point.timestamp / 1000.0),
-                x=point.x,
-                y=point.y
-            )
-            db.add(cursor_data)
-            points_added += 1
-        except Exception as e:
-            print(f"Error adding cursor point: {e}")
-            print(f"Point data: {point}")
-    
-    # Update session last updated time
-    session.updated_at = datetime.now()
+    # Add all cursor data points (this also updates the session's counters and last updated time)
+    batch = batch_from_points([point.model_dump() for point in data.cursorData])
     try:
+        _, points_added = write_samples(db, session_id, cursor=batch)
         db.commit()
         print(f"Successfully added {points_added} cursor points to session {session_id}")
     except Exception as e:
@@ -193,31 +182,21 @@ async def add_cursor_data(
 async def get_cursor_points(
     session_id: int,
     offset: int = 0,
-    limit: int = 1000,
+    limit: int = DEFAULT_PAGE_SIZE,
+    after: Optional[str] = None,
     db: Session = Depends(get_db),
     current_user: User = Depends(get_current_user)
 ):
-    """Get cursor data points for a session with pagination"""
+    """
+    Get cursor data points for a session with pagination.
+    Pass the nextPage token of the previous response as after to page by key instead of offset.
+    """
     try:
-        # Get total count
-        total = db.query(CursorData).filter(CursorData.session_id == session_id).count()
+        # Total is maintained at ingest time
+        total = db.query(SessionModel.cursor_count).filter(SessionModel.id == session_id).scalar() or 0
         
-        # Get paginated cursor points
-        cursor_points = db.query(CursorData).filter(CursorData.session_id == session_id)\
-            .order_by(CursorData.timestamp)\
-            .offset(offset)\
-            .limit(limit)\
-            .all()
-        
-        # Format points for frontend
-        formatted_points = []
-        for point in cursor_points:
-            formatted_points.append({
-                "id": point.id,
-                "timestamp": point.timestamp,
-                "x": point.x,
-                "y": point.y
-            })
+        # Get paginated cursor points from whichever storage engine holds them
+        formatted_points, next_page = read_page(db, session_id, "cursor", offset=offset, limit=limit, after=after)
         
         # Return as dictionary with points and metadata to match frontend expectations
         return {
@@ -226,8 +205,11 @@ async def get_cursor_points(
             "count": len(formatted_points),
             "offset": offset,
             "limit": limit,
-            "hasMore": (offset + limit) < total
+            "hasMore": next_page is not None,
+            "nextPage": next_page
         }
+    except ValueError as e:
+        raise HTTPException(status_code=400, detail=str(e))
     except Exception as e:
         raise HTTPException(
             status_code=status.HTTP_500_INTERNAL_SERVER_ERROR,
@@ -238,7 +220,8 @@ async def get_cursor_points(
 async def get_cursor_data_points(
     session_id: int,
     offset: int = 0,
-    limit: int = 1000,
+    limit: int = DEFAULT_PAGE_SIZE,
+    after: Optional[str] = None,
     db: Session = Depends(get_db),
     current_user: User = Depends(get_current_user)
 ):
@@ -248,6 +231,7 @@ async def get_cursor_data_points(
         session_id=session_id,
         offset=offset,
         limit=limit,
+        after=after,
         db=db,
         current_user=current_user
     )
@@ -269,18 +253,15 @@ async def get_cursor_heatmap(
         raise HTTPException(status_code=404, detail="Session not found")
     
     # Get all cursor points for this session
-    cursor_points = db.query(CursorData).filter(
-        CursorData.session_id == session_id
-    ).all()
+    cursor_points = load_samples(db, session_id, "cursor")
     
     # Format data for heatmap generation
     heatmap_data = []
-    for point in cursor_points:
-        heatmap_data.append({
-            "x": point.x,
-            "y": point.y,
-            "value": 1  # Each point has equal weight
-        })
+    if cursor_points is not None:
+        heatmap_data = [
+            {"x": x, "y": y, "value": 1}  # Each point has equal weight
+            for x, y in zip(cursor_points.x.tolist(), cursor_points.y.tolist())
+        ]
     
     return {
         "points": heatmap_data,
@@ -293,10 +274,11 @@ async def get_cursor_plotly_heatmap(
     width: int = 1920,
     height: int = 1080,
     bin_size: int = 50,
+    renderer: str = DEFAULT_RENDERER,  # fast (PNG) or plotly (interactive figure JSON)
     db: Session = Depends(get_db),
     current_user: User = Depends(get_current_user)
 ):
-    """Generate a plotly heatmap for cursor data"""
+    """Generate a heatmap for cursor data"""
     # Check if session exists and belongs to user
     session = db.query(SessionModel).filter(
         SessionModel.id == session_id,
@@ -307,18 +289,10 @@ async def get_cursor_plotly_heatmap(
         raise HTTPException(status_code=404, detail="Session not found")
     
     # Get all cursor points for this session
-    cursor_points = db.query(CursorData).filter(
-        CursorData.session_id == session_id
-    ).all()
+    cursor_points = load_samples(db, session_id, "cursor")
     
     # Format data for heatmap generation
-    formatted_points = []
-    for point in cursor_points:
-        formatted_points.append({
-            "x": float(point.x),
-            "y": float(point.y),
-            "timestamp": int(point.timestamp.timestamp() * 1000)  # Convert to milliseconds
-        })
+    formatted_points = format_cursor_points(cursor_points)
     
     if not formatted_points:
         return JSONResponse(
@@ -328,11 +302,13 @@ async def get_cursor_plotly_heatmap(
     
     # Generate heatmap
     try:
-        heatmap_img, stats = create_mouse_heatmap(
+        heatmap_img, stats = await run_analytics(
+            create_mouse_heatmap,
             formatted_points, 
             width=width, 
             height=height, 
-            bin_size=bin_size
+            bin_size=bin_size,
+            renderer=_renderer(renderer)
         )
         
         if not heatmap_img:
@@ -341,11 +317,9 @@ async def get_cursor_plotly_heatmap(
                 content={"message": "Failed to generate heatmap - insufficient data"}
             )
         
-        return {
-            "image": heatmap_img,
-            "stats": stats,
-            "count": len(formatted_points)
-        }
+        return _plot_response(heatmap_img, stats, len(formatted_points), renderer)
+    except AnalyticsTimeout as e:
+        raise HTTPException(status_code=status.HTTP_504_GATEWAY_TIMEOUT, detail=str(e))
     except Exception as e:
         raise HTTPException(
             status_code=status.HTTP_500_INTERNAL_SERVER_ERROR,
@@ -357,6 +331,7 @@ async def get_cursor_time_based_heatmap(
     session_id: int,
     width: int = 1920,
     height: int = 1080,
+    renderer: str = DEFAULT_RENDERER,
     db: Session = Depends(get_db),
     current_user: User = Depends(get_current_user)
 ):
@@ -371,18 +346,10 @@ async def get_cursor_time_based_heatmap(
         raise HTTPException(status_code=404, detail="Session not found")
     
     # Get all cursor points for this session
-    cursor_points = db.query(CursorData).filter(
-        CursorData.session_id == session_id
-    ).all()
+    cursor_points = load_samples(db, session_id, "cursor")
     
     # Format data for heatmap generation
-    formatted_points = []
-    for point in cursor_points:
-        formatted_points.append({
-            "x": float(point.x),
-            "y": float(point.y),
-            "timestamp": int(point.timestamp.timestamp() * 1000)  # Convert to milliseconds
-        })
+    formatted_points = format_cursor_points(cursor_points)
     
     if not formatted_points:
         return JSONResponse(
@@ -392,10 +359,12 @@ async def get_cursor_time_based_heatmap(
     
     # Generate time-based heatmap
     try:
-        heatmap_img, stats = create_time_based_heatmap(
+        heatmap_img, stats = await run_analytics(
+            create_time_based_heatmap,
             formatted_points, 
             width=width, 
-            height=height
+            height=height,
+            renderer=_renderer(renderer)
         )
         
         if not heatmap_img:
@@ -404,11 +373,9 @@ async def get_cursor_time_based_heatmap(
                 content={"message": "Failed to generate time-based heatmap - insufficient data"}
             )
         
-        return {
-            "image": heatmap_img,
-            "stats": stats,
-            "count": len(formatted_points)
-        }
+        return _plot_response(heatmap_img, stats, len(formatted_points), renderer)
+    except AnalyticsTimeout as e:
+        raise HTTPException(status_code=status.HTTP_504_GATEWAY_TIMEOUT, detail=str(e))
     except Exception as e:
         raise HTTPException(
             status_code=status.HTTP_500_INTERNAL_SERVER_ERROR,
@@ -420,6 +387,7 @@ async def get_cursor_trajectory(
     session_id: int,
     width: int = 1920,
     height: int = 1080,
+    renderer: str = DEFAULT_RENDERER,
     db: Session = Depends(get_db),
     current_user: User = Depends(get_current_user)
 ):
@@ -434,18 +402,10 @@ async def get_cursor_trajectory(
         raise HTTPException(status_code=404, detail="Session not found")
     
     # Get all cursor points for this session
-    cursor_points = db.query(CursorData).filter(
-        CursorData.session_id == session_id
-    ).all()
+    cursor_points = load_samples(db, session_id, "cursor")
     
     # Format data for trajectory generation
-    formatted_points = []
-    for point in cursor_points:
-        formatted_points.append({
-            "x": float(point.x),
-            "y": float(point.y),
-            "timestamp": int(point.timestamp.timestamp() * 1000)  # Convert to milliseconds
-        })
+    formatted_points = format_cursor_points(cursor_points)
     
     if not formatted_points:
         return JSONResponse(
@@ -455,10 +415,12 @@ async def get_cursor_trajectory(
     
     # Generate trajectory plot
     try:
-        trajectory_img, stats = create_trajectory_plot(
+        trajectory_img, stats = await run_analytics(
+            create_trajectory_plot,
             formatted_points, 
             width=width, 
-            height=height
+            height=height,
+            renderer=_renderer(renderer)
         )
         
         if not trajectory_img:
@@ -467,17 +429,107 @@ async def get_cursor_trajectory(
                 content={"message": "Failed to generate trajectory plot - insufficient data"}
             )
         
-        return {
-            "image": trajectory_img,
-            "stats": stats,
-            "count": len(formatted_points)
-        }
+        return _plot_response(trajectory_img, stats, len(formatted_points), renderer)
+    except AnalyticsTimeout as e:
+        raise HTTPException(status_code=status.HTTP_504_GATEWAY_TIMEOUT, detail=str(e))
     except Exception as e:
         raise HTTPException(
             status_code=status.HTTP_500_INTERNAL_SERVER_ERROR,
             detail=f"Error generating trajectory plot: {str(e)}"
         )
 
+# Renderers behind the cursor image endpoints, by view name
+CURSOR_IMAGE_VIEWS = {
+    "heatmap": create_mouse_heatmap,
+    "time-based": create_time_based_heatmap,
+    "trajectory": create_trajectory_plot
+}
+
+async def _cursor_image(view, session_id, format, if_none_match, db, current_user, **params):
+    """
+    One of the cursor visualizations as image bytes. The ETag comes from the session's data
+    version and the parameters, so a matching If-None-Match is answered without loading samples.
+    """
+    session = db.query(SessionModel).filter(
+        SessionModel.id == session_id,
+        SessionModel.user_id == current_user.id
+    ).first()
+
+    if not session:
+        raise HTTPException(status_code=404, detail="Session not found")
+    if format not in IMAGE_MEDIA_TYPES:
+        format = "png"
+
+    key = cache_key("cursor_image", view, session.id, session.data_version or 0, format,
+                    f"fast-{FAST_RENDER_VERSION}",
+                    *(f"{name}={value}" for name, value in sorted(params.items())))
+    etag = make_etag(key)
+    if etag_matches(if_none_match, etag):
+        return not_modified(etag)
+
+    image = await heatmap_cache.fetch_bytes(key)
+    if image is None:
+        formatted_points = format_cursor_points(load_samples(db, session_id, "cursor"))
+        if not formatted_points:
+            raise HTTPException(status_code=404, detail="No cursor data found for this session")
+        try:
+            encoded, stats = await run_analytics(CURSOR_IMAGE_VIEWS[view], formatted_points,
+                                                 renderer="fast", **params)
+        except AnalyticsTimeout as e:
+            raise HTTPException(status_code=status.HTTP_504_GATEWAY_TIMEOUT, detail=str(e))
+        if not encoded:
+            raise HTTPException(
+                status_code=status.HTTP_500_INTERNAL_SERVER_ERROR,
+                detail=f"Error generating {view} image: {stats.get('error', 'insufficient data')}"
+            )
+        image = convert_image(base64.b64decode(encoded), format)
+        await heatmap_cache.store_bytes(key, image)
+
+    return image_response(image, IMAGE_MEDIA_TYPES[format], etag)
+
+@router.get("/sessions/{session_id}/cursor/heatmap/plotly/image")
+async def get_cursor_plotly_heatmap_image(
+    session_id: int,
+    width: int = 1920,
+    height: int = 1080,
+    bin_size: int = 50,
+    format: str = "png",  # png or webp
+    if_none_match: Optional[str] = Header(None),
+    db: Session = Depends(get_db),
+    current_user: User = Depends(get_current_user)
+):
+    """The cursor heatmap as a cacheable image (see get_cursor_plotly_heatmap for the JSON version)"""
+    return await _cursor_image("heatmap", session_id, format, if_none_match, db, current_user,
+                               width=width, height=height, bin_size=bin_size)
+
+@router.get("/sessions/{session_id}/cursor/heatmap/time-based/image")
+async def get_cursor_time_based_heatmap_image(
+    session_id: int,
+    width: int = 1920,
+    height: int = 1080,
+    format: str = "png",
+    if_none_match: Optional[str] = Header(None),
+    db: Session = Depends(get_db),
+    current_user: User = Depends(get_current_user)
+):
+    """The dwell time heatmap as a cacheable image"""
+    return await _cursor_image("time-based", session_id, format, if_none_match, db, current_user,
+                               width=width, height=height)
+
+@router.get("/sessions/{session_id}/cursor/trajectory/image")
+async def get_cursor_trajectory_image(
+    session_id: int,
+    width: int = 1920,
+    height: int = 1080,
+    format: str = "png",
+    if_none_match: Optional[str] = Header(None),
+    db: Session = Depends(get_db),
+    current_user: User = Depends(get_current_user)
+):
+    """The trajectory plot as a cacheable image"""
+    return await _cursor_image("trajectory", session_id, format, if_none_match, db, current_user,
+                               width=width, height=height)
+
 @router.get("/cursor/debug")
 async def debug_cursor_heatmap():
     """Debugging endpoint to check if the mouse_heatmap module is correctly loaded"""
@@ -862,25 +914,10 @@ async def save_cursor_data_batch_no_auth(
     
     print(f"Found session: {session.name}")
     
-    # Process the batch of cursor data
-    points_added = 0
-    for point in data:
-        try:
-            cursor_data = CursorData(
-                session_id=session_id,
-                timestamp=datetime.fromtimestamp(point['timestamp'] / 1000.0),
-                x=point['x'],
-                y=point['y']
-            )
-            db.add(cursor_data)
-            points_added += 1
-        except Exception as e:
-            print(f"Error adding cursor point: {e}")
-            print(f"Point data: {point}")
-    
-    # Update session last updated time
-    session.updated_at = datetime.now()
+    # Process the batch of cursor data (this also updates the session's counters and last updated time)
+    batch = batch_from_points(data)
     try:
+        _, points_added = write_samples(db, session_id, cursor=batch)
         db.commit()
         print(f"Successfully added {points_added} cursor points to session {session_id}")
     except Exception as e:
@@ -0,0 +1,95 @@
+from fastapi import APIRouter, Depends, HTTPException
+from fastapi.responses import StreamingResponse
+from sqlalchemy.orm import Session
+from app.utils import get_db
+from app.database import SessionLocal
+from app.models import Session as SessionModel, User
+from app.storage import iter_samples
+from app.columnar import encode_binary, BINARY_CONTENT_TYPE
+from routes.auth import get_current_user
+from typing import Optional
+import json
+import math
+
+# Router
+router = APIRouter()
+
+NDJSON_CONTENT_TYPE = "application/x-ndjson"
+EXPORT_KINDS = {"gaze": ["gaze"], "cursor": ["cursor"], "all": ["gaze", "cursor"]}
+
+def _nullable(value):
+    return None if math.isnan(value) else value
+
+def _ndjson_lines(kind, batch):
+    """One JSON object per sample: type, t (ms since epoch), x, y and, for gaze, pupil sizes"""
+    rows = [batch.timestamps.tolist(), batch.x.tolist(), batch.y.tolist()]
+    if kind == "gaze":
+        for column in (batch.pupil_left, batch.pupil_right):
+            rows.append(column.tolist() if column is not None else [math.nan] * len(batch))
+
+    lines = []
+    for values in zip(*rows):
+        record = {"type": kind, "t": values[0], "x": values[1], "y": values[2]}
+        if kind == "gaze":
+            record["pupil_left"] = _nullable(values[3])
+            record["pupil_right"] = _nullable(values[4])
+        lines.append(json.dumps(record))
+    return ("\n".join(lines) + "\n").encode()
+
+def _export_stream(session_id, kinds, export_format, start_time, end_time):
+    """
+    Generator behind the export response. It opens its own database session because the
+    request's session is closed before the body is streamed.
+    """
+    db = SessionLocal()
+    try:
+        for kind in kinds:
+            for batch in iter_samples(db, session_id, kind, start_time=start_time, end_time=end_time):
+                if export_format == "binary":
+                    yield encode_binary(batch, cursor=(kind == "cursor"))
+                else:
+                    yield _ndjson_lines(kind, batch)
+    finally:
+        db.close()
+
+@router.get("/sessions/{session_id}/export")
+async def export_session(
+    session_id: int,
+    format: str = "ndjson",
+    kind: str = "all",
+    start_time: Optional[float] = None,
+    end_time: Optional[float] = None,
+    current_user: User = Depends(get_current_user),
+    db: Session = Depends(get_db)
+):
+    """
+    Stream every sample of a session, optionally limited to start_time..end_time (ms since epoch),
+    with chunked transfer encoding. kind is gaze, cursor or all (gaze first, then cursor).
+
+    format=ndjson sends one JSON object per line. format=binary sends a sequence of packed
+    columnar blocks (the HGC1 batch format, FLAG_CURSOR set on cursor blocks), each holding
+    one fetch of up to HEATGAZE_EXPORT_BLOCK_ROWS samples.
+    """
+    if format not in ("ndjson", "binary"):
+        raise HTTPException(status_code=400, detail="format must be ndjson or binary")
+    if kind not in EXPORT_KINDS:
+        raise HTTPException(status_code=400, detail="kind must be gaze, cursor or all")
+    if start_time is not None and end_time is not None and start_time > end_time:
+        raise HTTPException(status_code=400, detail="start_time must not be after end_time")
+
+    # Check if session exists and belongs to user
+    session = db.query(SessionModel.id).filter(
+        SessionModel.id == session_id,
+        SessionModel.user_id == current_user.id
+    ).first()
+
+    if not session:
+        raise HTTPException(status_code=404, detail="Session not found")
+
+    media_type = BINARY_CONTENT_TYPE if format == "binary" else NDJSON_CONTENT_TYPE
+    extension = "bin" if format == "binary" else "ndjson"
+    return StreamingResponse(
+        _export_stream(session_id, EXPORT_KINDS[kind], format, start_time, end_time),
+        media_type=media_type,
+        headers={"Content-Disposition": f'attachment; filename="session-{session_id}-{kind}.{extension}"'}
+    )
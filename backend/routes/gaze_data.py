@@ -1,8 +1,12 @@
-from fastapi import APIRouter, Depends, HTTPException, status, Body
+from fastapi import APIRouter, Depends, HTTPException, status, Body, Request, Response
 from sqlalchemy.orm import Session
 from app.utils import get_db
 from app.models import Session as SessionModel, GazeData, User, Screenshot
 from app.schemas import SessionCreate, SessionResponse, GazeDataCreate, ScreenshotCreate, ScreenshotResponse
+from app.ingest_queue import ingest_queue, QueueFullError, IngestCommitError
+from app.storage import write_samples, read_page, DEFAULT_PAGE_SIZE
+from app.ingest import batch_from_points
+from app.columnar import decode_payload
 from pydantic import BaseModel
 from typing import List, Optional, Dict, Any
 from datetime import datetime
@@ -101,8 +105,8 @@ async def get_sessions(
     # Enhance session data with additional fields
     enhanced_sessions = []
     for session in sessions:
-        # Count gaze data points
-        gaze_count = db.query(GazeData).filter(GazeData.session_id == session.id).count()
+        # Gaze data point count is maintained at ingest time
+        gaze_count = session.gaze_count or 0
         
         # Calculate duration
         duration = 0
@@ -118,6 +122,8 @@ async def get_sessions(
             "updated_at": session.updated_at,
             "has_recording": gaze_count > 0,
             "recording_count": gaze_count,
+            "cursor_count": session.cursor_count or 0,
+            "sample_rate": session.sample_rate,
             "duration": duration,
             "username": current_user.username
         }
@@ -141,8 +147,8 @@ async def get_session(
     if not session:
         raise HTTPException(status_code=404, detail="Session not found")
     
-    # Count gaze data points
-    gaze_count = db.query(GazeData).filter(GazeData.session_id == session.id).count()
+    # Gaze data point count is maintained at ingest time
+    gaze_count = session.gaze_count or 0
     
     # Calculate duration
     duration = 0
@@ -165,6 +171,8 @@ async def get_session(
         "updated_at": session.updated_at,
         "has_recording": gaze_count > 0,
         "recording_count": gaze_count,
+        "cursor_count": session.cursor_count or 0,
+        "sample_rate": session.sample_rate,
         "duration": duration,
         "username": current_user.username,
         "video_url": video_url,  # Always provide a video URL
@@ -196,27 +204,10 @@ async def add_gaze_data(
     
     print(f"Found session: {session.name}")
     
-    # Add all gaze data points
-    points_added = 0
-    for point in data.gazeData:
-        try:
-            gaze_data = GazeData(
-                session_id=session_id,
-                timestamp=datetime.fromtimestamp(point.timestamp / 1000.0),
-                x=point.x,
-                y=point.y,
-                pupil_left=point.pupilLeftSize,
-                pupil_right=point.pupilRightSize
-            )
-            db.add(gaze_data)
-            points_added += 1
-        except Exception as e:
-            print(f"Error adding gaze point: {e}")
-            print(f"Point data: {point}")
-    
-    # Update session last updated time
-    session.updated_at = datetime.now()
+    # Add all gaze data points (this also updates the session's counters and last updated time)
+    batch = batch_from_points([point.model_dump() for point in data.gazeData], with_pupils=True)
     try:
+        points_added, _ = write_samples(db, session_id, gaze=batch)
         db.commit()
         print(f"Successfully added {points_added} gaze points to session {session_id}")
     except Exception as e:
@@ -229,15 +220,18 @@ async def add_gaze_data(
 @router.post("/sessions/{session_id}/gaze/batch")
 async def save_gaze_data_batch(
     session_id: int,
-    data: List[dict] = Body(...),
+    request: Request,
     current_user: User = Depends(get_current_user),
     db: Session = Depends(get_db)
 ):
-    """Save a batch of gaze data points for a specific session"""
-    print(f"Received batch of {len(data)} gaze points for session {session_id}")
-    
+    """
+    Save a batch of gaze data points for a specific session.
+    The body is either a JSON list of points, a columnar JSON object
+    ({"t": [...], "x": [...], "y": [...], "pupil_left": [...], "pupil_right": [...]})
+    or the packed binary format sent as application/x-heatgaze-columnar.
+    """
     # Check if session exists and belongs to user
-    session = db.query(SessionModel).filter(
+    session = db.query(SessionModel.id).filter(
         SessionModel.id == session_id,
         SessionModel.user_id == current_user.id
     ).first()
@@ -246,35 +240,20 @@ async def save_gaze_data_batch(
         print(f"Session {session_id} not found or doesn't belong to user {current_user.id}")
         raise HTTPException(status_code=404, detail="Session not found")
     
-    print(f"Found session: {session.name}")
-    
-    # Process the batch of gaze data
-    points_added = 0
-    for point in data:
-        try:
-            gaze_data = GazeData(
-                session_id=session_id,
-                timestamp=datetime.fromtimestamp(point['timestamp'] / 1000.0),
-                x=point['x'],
-                y=point['y'],
-                pupil_left=None,  # These fields might not be in the data
-                pupil_right=None  # These fields might not be in the data
-            )
-            db.add(gaze_data)
-            points_added += 1
-        except Exception as e:
-            print(f"Error adding gaze point: {e}")
-            print(f"Point data: {point}")
-    
-    # Update session last updated time
-    session.updated_at = datetime.now()
+    # Decode and validate the whole batch at once
     try:
-        db.commit()
-        print(f"Successfully added {points_added} gaze points to session {session_id}")
-    except Exception as e:
-        print(f"Error committing gaze data: {e}")
-        db.rollback()
-        raise HTTPException(status_code=500, detail=f"Failed to save gaze data: {str(e)}")
+        batch = decode_payload(await request.body(), request.headers.get("content-type"), with_pupils=True)
+    except ValueError as e:
+        raise HTTPException(status_code=422, detail=f"Invalid gaze batch: {str(e)}")
+    # Hand the batch to the write-behind queue; it is committed with the next group commit
+    try:
+        await ingest_queue.submit(session_id, gaze=batch)
+    except QueueFullError as e:
+        raise HTTPException(status_code=503, detail=str(e), headers={"Retry-After": "1"})
+    points_added = len(batch)
+    
+    if batch.rejected:
+        print(f"Skipped {batch.rejected} invalid gaze points for session {session_id}")
     
     return {"status": "success", "points_added": points_added}
 
@@ -334,30 +313,33 @@ async def add_gaze_point(
 @router.get("/sessions/{session_id}/gaze")
 async def get_gaze_points(
     session_id: int,
+    response: Response,
     offset: int = 0,
-    limit: int = 1000,
+    limit: int = DEFAULT_PAGE_SIZE,
+    after: Optional[str] = None,
     db: Session = Depends(get_db),
     current_user: User = Depends(get_current_user)
 ):
+    """
+    Get gaze data points for a session with pagination.
+    The body stays a plain list; the total is sent in X-Total-Count and the token for the
+    next page in X-Next-Page. Pass that token as after to page by key instead of offset.
+    """
     try:
-        # Get total count
-        total = db.query(GazeData).filter(GazeData.session_id == session_id).count()
+        # Get paginated gaze points from whichever storage engine holds them
+        gaze_points, next_page = read_page(db, session_id, "gaze", offset=offset, limit=limit, after=after)
         
-        # Get paginated gaze points
-        gaze_points = db.query(GazeData).filter(GazeData.session_id == session_id)\
-            .order_by(GazeData.timestamp)\
-            .offset(offset)\
-            .limit(limit)\
-            .all()
+        # Total is maintained at ingest time
+        total = db.query(SessionModel.gaze_count).filter(SessionModel.id == session_id).scalar() or 0
+        response.headers["X-Total-Count"] = str(total)
+        if next_page:
+            response.headers["X-Next-Page"] = next_page
         
         # Format points for frontend
         formatted_points = []
         for point in gaze_points:
             formatted_points.append({
-                "id": point.id,
-                "timestamp": point.timestamp,
-                "x": point.x,
-                "y": point.y,
+                **point,
                 "state": "default",  # Default state since it's not in the model
                 "url": ""  # Default URL since it's not in the model
             })
@@ -365,6 +347,8 @@ async def get_gaze_points(
         # Return data in the expected format based on the frontend's SessionPlayer component
         # Return points directly instead of wrapping them in an object
         return formatted_points
+    except ValueError as e:
+        raise HTTPException(status_code=400, detail=str(e))
     except Exception as e:
         raise HTTPException(
             status_code=status.HTTP_500_INTERNAL_SERVER_ERROR,
@@ -375,8 +359,10 @@ async def get_gaze_points(
 @router.get("/sessions/{session_id}/gaze-data")
 async def get_gaze_data_points(
     session_id: int,
+    response: Response,
     offset: int = 0,
-    limit: int = 1000,
+    limit: int = DEFAULT_PAGE_SIZE,
+    after: Optional[str] = None,
     db: Session = Depends(get_db),
     current_user: User = Depends(get_current_user)
 ):
@@ -384,8 +370,10 @@ async def get_gaze_data_points(
     # Simply call the existing implementation
     return await get_gaze_points(
         session_id=session_id,
+        response=response,
         offset=offset,
         limit=limit,
+        after=after,
         db=db,
         current_user=current_user
     )
@@ -482,6 +470,13 @@ async def end_session(
     if not session:
         raise HTTPException(status_code=404, detail="Session not found")
     
+    # Make sure every queued sample of this session is committed before it is reported finished
+    try:
+        await ingest_queue.flush(session_id)
+    except IngestCommitError as e:
+        raise HTTPException(status_code=500, detail=f"Session samples could not be saved: {str(e)}")
+    db.expire(session)
+    
     # Update session with end time
     session.updated_at = datetime.now()
     db.commit()
@@ -1,15 +1,30 @@
-from fastapi import APIRouter, Depends, HTTPException, status, Body, Query
+from fastapi import APIRouter, Depends, HTTPException, status, Body, Query, Response, Header
 from sqlalchemy.orm import Session
-from app.utils import get_db, generate_heatmap, img_to_base64, calculate_heatmap_stats, calculate_correlation_metrics
-from app.models import Session as SessionModel, User, Heatmap, GazeData, CursorData
+from app.utils import get_db, calculate_heatmap_stats, calculate_correlation_metrics, check_memory_budget, MemoryBudgetExceeded, HEATMAP_QUALITY_SCALES, DEFAULT_HEATMAP_QUALITY
+from app.models import Session as SessionModel, User, Heatmap
+from app.grids import load_grid, grid_heatmap, grid_density, grid_image, fit_grid, fixation_cells, GRID_WIDTH, GRID_HEIGHT, GRID_SCALE
+from app.rawgrid import encode_density_grid, GRID_CONTENT_TYPE, GRID_DTYPES
+from app.cache import heatmap_cache, cache_key
+from app.etags import make_etag, etag_matches, not_modified, image_response, IMAGE_MEDIA_TYPES, IMMUTABLE
+from app.workers import run_analytics, with_db_session, AnalyticsTimeout
+from app.jobs import submit_heatmap_job
+from app.aggregate import select_sessions, chunk_sessions, reduce_chunk, combine, NORMALIZATIONS, AGGREGATE_MAX_SESSIONS
+from app.frames import iter_frame_counts, render_frame, frame_count, FRAME_MODES, MAX_FRAMES
+from app.database import SessionLocal
+from app.storage import sample_span
+from app.timeline import load_index, window_counts, bucket_activity, TIMELINE_BUCKET_MS, TIMELINE_SCALE
+from app.rendering import RENDER_VERSION, WEBP_QUALITY
+from app.tiles import pyramid_cache, build_pyramid, render_tile, tile_layout, max_zoom, TILE_SIZE
 from routes.auth import get_current_user
 from pydantic import BaseModel
 from typing import List, Optional
 import numpy as np
+import asyncio
 import os
 import io
 import base64
-from fastapi.responses import FileResponse
+import json
+from fastapi.responses import FileResponse, StreamingResponse
 from datetime import datetime
 
 # Router
@@ -21,6 +36,8 @@ class HeatmapRequest(BaseModel):
     url: Optional[str] = None
     start_time: Optional[float] = None
     end_time: Optional[float] = None
+    type: Optional[str] = "gaze"  # gaze or cursor
+    quality: Optional[str] = None  # full, high, medium or low (default HEATGAZE_HEATMAP_QUALITY)
 
 class HeatmapResponse(BaseModel):
     image: str
@@ -36,13 +53,70 @@ class HeatmapFilterRequest(BaseModel):
     filter_type: str
     parameters: Optional[dict] = None
 
+def _heatmap_cache_key(name, session, width, height, *params):
+    """Cache key for a session's heatmap result: changes whenever its data, the grid geometry or the renderer does"""
+    return cache_key(name, session.id, session.data_version or 0, width, height,
+                     GRID_WIDTH, GRID_HEIGHT, GRID_SCALE, f"render-{RENDER_VERSION}-{WEBP_QUALITY}", *params)
+
+def _job_response(heatmap):
+    """Status document for a heatmap generation job"""
+    response = {
+        "job_id": heatmap.id,
+        "session_id": heatmap.session_id,
+        "status": heatmap.status,
+        "type": heatmap.kind,
+        "quality": heatmap.quality,
+        "url": heatmap.url or None,
+        "start_time": heatmap.start_time,
+        "end_time": heatmap.end_time,
+        "created_at": heatmap.created_at.isoformat() if heatmap.created_at else None,
+        "completed_at": heatmap.completed_at.isoformat() if heatmap.completed_at else None,
+        "status_url": f"/api/heatmap/jobs/{heatmap.id}"
+    }
+    if heatmap.status == "completed":
+        response["pointCount"] = heatmap.point_count
+        response["stats"] = heatmap.stats
+        response["image_url"] = f"/api/heatmap/image/{heatmap.id}" if heatmap.image_path else None
+    if heatmap.status == "failed":
+        response["error"] = heatmap.error
+    return response
+
+def _user_heatmap(db, heatmap_id, user):
+    """A heatmap row whose session belongs to the user (404 / 403 otherwise)"""
+    heatmap = db.query(Heatmap).filter(Heatmap.id == heatmap_id).first()
+    
+    if not heatmap:
+        raise HTTPException(status_code=404, detail="Heatmap not found")
+    
+    # Check if the associated session belongs to the user
+    session = db.query(SessionModel.id).filter(
+        SessionModel.id == heatmap.session_id,
+        SessionModel.user_id == user.id
+    ).first()
+    
+    if not session:
+        raise HTTPException(status_code=403, detail="Access denied")
+    return heatmap
+
+def _check_memory_budget(width, height, quality, maps=1):
+    """413 when a request's heatmaps would not fit in HEATGAZE_HEATMAP_MEMORY_BUDGET"""
+    try:
+        check_memory_budget(width, height, HEATMAP_QUALITY_SCALES.get(quality, 1), maps)
+    except MemoryBudgetExceeded as e:
+        raise HTTPException(status_code=413, detail=str(e))
+
 # Routes
-@router.post("/heatmap", response_model=HeatmapResponse)
+@router.post("/heatmap", status_code=status.HTTP_202_ACCEPTED)
 async def generate_session_heatmap(
     request: HeatmapRequest,
     current_user: User = Depends(get_current_user),
     db: Session = Depends(get_db)
 ):
+    """
+    Queue a heatmap for a session's samples, optionally limited to start_time..end_time
+    (ms since epoch) and to the periods the session's screenshots show url on screen.
+    Returns the job id at once; poll status_url, then fetch the PNG from image_url.
+    """
     # Check if session exists and belongs to user
     session = db.query(SessionModel).filter(
         SessionModel.id == request.session_id,
@@ -51,21 +125,59 @@ async def generate_session_heatmap(
     
     if not session:
         raise HTTPException(status_code=404, detail="Session not found")
-    
-    # For now, return a placeholder response since we're still developing this endpoint
-    return {
-        "image": "iVBORw0KGgoAAAANSUhEUgAAAAEAAAABCAYAAAAfFcSJAAAADUlEQVR42mNk+P+/HgAFdwI2QOYcNQAAAABJRU5ErkJggg==",
-        "stats": {
-            "focus_areas": 3,
-            "attention_score": 75,
-            "coverage": 0.65,
-            "kld": 0.42,
-            "nss": 1.85,
-            "similarity": 0.65,
-            "cc": 0.78,
-            "auc": 0.82
-        }
-    }
+    if request.start_time is not None and request.end_time is not None and request.start_time > request.end_time:
+        raise HTTPException(status_code=400, detail="start_time must not be after end_time")
+
+    kind = request.type if request.type in ["gaze", "cursor"] else "gaze"
+    quality = request.quality if request.quality in HEATMAP_QUALITY_SCALES else DEFAULT_HEATMAP_QUALITY
+    width, height = _screen_size(session)
+    _check_memory_budget(width, height, quality)
+
+    heatmap = Heatmap(
+        session_id=session.id,
+        url=request.url or "",
+        status="pending",
+        kind=kind,
+        quality=quality,
+        start_time=request.start_time,
+        end_time=request.end_time,
+        width=width,
+        height=height
+    )
+    db.add(heatmap)
+    db.commit()
+    db.refresh(heatmap)
+
+    submit_heatmap_job(heatmap.id)
+    return _job_response(heatmap)
+
+@router.get("/heatmap/jobs/{job_id}")
+async def get_heatmap_job(
+    job_id: int,
+    current_user: User = Depends(get_current_user),
+    db: Session = Depends(get_db)
+):
+    """Status of a heatmap generation job, with its stats once completed"""
+    return _job_response(_user_heatmap(db, job_id, current_user))
+
+@router.get("/heatmap/image/{heatmap_id}")
+async def get_heatmap_image(
+    heatmap_id: int,
+    if_none_match: Optional[str] = Header(None),
+    current_user: User = Depends(get_current_user),
+    db: Session = Depends(get_db)
+):
+    """The rendered PNG of a completed heatmap (never changes once completed, so cached for good)"""
+    heatmap = _user_heatmap(db, heatmap_id, current_user)
+    if heatmap.status != "completed":
+        raise HTTPException(status_code=409, detail=f"Heatmap is {heatmap.status}")
+    etag = make_etag("heatmap_image", heatmap.id, heatmap.completed_at.isoformat() if heatmap.completed_at else None)
+    if etag_matches(if_none_match, etag):
+        return not_modified(etag, IMMUTABLE)
+    if not heatmap.image_path or not os.path.exists(heatmap.image_path):
+        raise HTTPException(status_code=404, detail="Heatmap image not found")
+    return FileResponse(heatmap.image_path, media_type="image/png",
+                        headers={"ETag": etag, "Cache-Control": IMMUTABLE})
 
 @router.get("/placeholder.jpg")
 async def get_placeholder_image():
@@ -84,34 +196,194 @@ async def get_heatmap(
     db: Session = Depends(get_db)
 ):
     """Get a specific heatmap by ID if it belongs to the user"""
-    # Find the heatmap
-    heatmap = db.query(Heatmap).filter(Heatmap.id == heatmap_id).first()
-    
-    if not heatmap:
-        raise HTTPException(status_code=404, detail="Heatmap not found")
-    
-    # Check if the associated session belongs to the user
-    session = db.query(SessionModel).filter(
-        SessionModel.id == heatmap.session_id,
-        SessionModel.user_id == current_user.id
-    ).first()
-    
-    if not session:
-        raise HTTPException(status_code=403, detail="Access denied")
+    heatmap = _user_heatmap(db, heatmap_id, current_user)
     
     # Return the heatmap data
     return {
         "id": heatmap_id,
         "title": f"Heatmap {heatmap_id}",
         "created_at": heatmap.created_at.isoformat(),
-        "data_points": 1240,
+        "status": heatmap.status,
+        "data_points": heatmap.point_count or 0,
+        "stats": heatmap.stats,
         "image_url": f"/api/heatmap/image/{heatmap_id}"
     }
 
+@with_db_session
+def _render_session_heatmap(db, session_id, gaze_count, cursor_count, video_url, type, quality, screen_width, screen_height):
+    """Gaze and cursor heatmaps, stats and correlation for a session (runs on the analytics pool)"""
+
+    # Initialize variables for both heatmaps
+    gaze_heatmap_image = None
+    gaze_raw_heatmap = None
+    gaze_stats = None
+    cursor_heatmap_image = None
+    cursor_raw_heatmap = None
+    cursor_stats = None
+    correlation_metrics = None
+
+    print(f"Session {session_id} has {gaze_count} gaze points and {cursor_count} cursor points")
+
+    # Process gaze data if available
+    if gaze_count > 0:
+        gaze_counts, gaze_counted = load_grid(db, session_id, "gaze")
+
+        if gaze_counted:
+            print(f"Generating gaze heatmap from {gaze_counted} points")
+            gaze_heatmap_image, gaze_raw_heatmap = grid_heatmap(gaze_counts, screen_width, screen_height, quality=quality)
+            gaze_stats = calculate_heatmap_stats(
+                gaze_raw_heatmap, fixation_cells(fit_grid(gaze_counts, screen_width, screen_height)), point_count=gaze_count
+            )
+
+    # Process cursor data if available
+    if cursor_count > 0:
+        cursor_counts, cursor_counted = load_grid(db, session_id, "cursor")
+
+        if cursor_counted:
+            print(f"Generating cursor heatmap from {cursor_counted} points")
+            cursor_heatmap_image, cursor_raw_heatmap = grid_heatmap(cursor_counts, screen_width, screen_height, quality=quality)
+            cursor_stats = calculate_heatmap_stats(
+                cursor_raw_heatmap, fixation_cells(fit_grid(cursor_counts, screen_width, screen_height)), point_count=cursor_count
+            )
+
+    # Calculate correlation metrics if both heatmaps are available
+    if gaze_raw_heatmap is not None and cursor_raw_heatmap is not None:
+        print(f"Calculating correlation metrics for session {session_id}")
+
+        # Check if heatmaps have different shapes and resize if needed
+        if gaze_raw_heatmap.shape != cursor_raw_heatmap.shape:
+            print(f"Heatmap shapes don't match! Gaze: {gaze_raw_heatmap.shape}, Cursor: {cursor_raw_heatmap.shape}")
+
+            # Resize cursor heatmap to match gaze heatmap
+            import cv2
+            cursor_raw_heatmap = cv2.resize(cursor_raw_heatmap, 
+                                          (gaze_raw_heatmap.shape[1], gaze_raw_heatmap.shape[0]), 
+                                          interpolation=cv2.INTER_AREA)
+            print(f"Resized cursor heatmap to {cursor_raw_heatmap.shape}")
+
+        correlation_metrics = calculate_correlation_metrics(gaze_raw_heatmap, cursor_raw_heatmap)
+        print(f"Correlation metrics calculated: {correlation_metrics}")
+
+    # Create a base response with basic info
+    response = {
+        "correlationMetrics": correlation_metrics
+    }
+
+    # Prepare the response based on requested type
+    if type == "cursor":
+        if not cursor_heatmap_image:
+            print("No cursor heatmap available")
+            response.update({
+                "image": "",
+                "stats": {
+                    "pointCount": 0,
+                    "focus_areas": 0,
+                    "attention_score": 0,
+                    "coverage": 0,
+                    "kld": 0,
+                    "nss": 0,
+                    "similarity": 0,
+                    "cc": 0,
+                    "auc": 0
+                }
+            })
+        else:
+            response.update({
+                "image": cursor_heatmap_image,
+                "stats": cursor_stats,
+            })
+    else:
+        # For gaze or combined view
+        if not gaze_heatmap_image:
+            print("No gaze heatmap available")
+            response.update({
+                "image": "",
+                "stats": {
+                    "pointCount": 0,
+                    "focus_areas": 0,
+                    "attention_score": 0,
+                    "coverage": 0,
+                    "kld": 0,
+                    "nss": 0,
+                    "similarity": 0,
+                    "cc": 0,
+                    "auc": 0
+                }
+            })
+        else:
+            response.update({
+                "image": gaze_heatmap_image,
+                "stats": gaze_stats,
+            })
+
+    # Add cursor data if available, regardless of view type
+    if cursor_heatmap_image:
+        response.update({
+            "cursorHeatmapUrl": cursor_heatmap_image,
+            "cursorStats": cursor_stats
+        })
+
+    # Add gaze data if available, regardless of view type
+    if gaze_heatmap_image and type == "cursor":
+        response.update({
+            "gazeHeatmapUrl": gaze_heatmap_image,
+            "gazeStats": gaze_stats
+        })
+
+    # Add video URL if available
+    if video_url:
+        response["videoUrl"] = video_url
+
+    # Add server URL if needed
+    response["serverUrl"] = None
+
+    # Log the final response structure
+    print(f"Response structure keys: {list(response.keys())}")
+    if correlation_metrics:
+        print(f"Correlation metrics in response: {list(correlation_metrics.keys())}")
+
+    return response
+
+@with_db_session
+def _render_session_grid(db, session_id, kind, quality, width, height, dtype, compress):
+    """The session's density grid in the binary grid format, or None without samples (runs on the analytics pool)"""
+    counts, total = load_grid(db, session_id, kind)
+    if not total:
+        return None
+    density, scale = grid_density(counts, width, height, quality=quality)
+    return encode_density_grid(density, scale, width, height, points=total, dtype=dtype, compress=compress)
+
+async def _session_grid_response(session, type, quality, dtype, compress):
+    """Response for format=grid: one raw density grid (gaze for the combined view)"""
+    kind = "cursor" if type == "cursor" else "gaze"
+    if quality not in HEATMAP_QUALITY_SCALES:
+        quality = DEFAULT_HEATMAP_QUALITY
+    if dtype not in GRID_DTYPES:
+        dtype = "uint8"
+    width, height = _screen_size(session)
+
+    key = _heatmap_cache_key("session_grid", session, width, height, kind, quality, dtype, compress)
+    payload = await heatmap_cache.fetch_bytes(key)
+    if payload is None:
+        try:
+            payload = await run_analytics(
+                _render_session_grid, session.id, kind, quality, width, height, dtype, compress
+            )
+        except AnalyticsTimeout as e:
+            raise HTTPException(status_code=504, detail=str(e))
+        if payload is None:
+            raise HTTPException(status_code=404, detail=f"Session has no {kind} samples")
+        await heatmap_cache.store_bytes(key, payload)
+    return Response(content=payload, media_type=GRID_CONTENT_TYPE)
+
 @router.get("/sessions/{session_id}/heatmap", response_model=HeatmapResponse)
 async def get_session_heatmap(
     session_id: int,
     type: str = "combined",  # Changed default from "gaze" to "combined"
+    quality: str = DEFAULT_HEATMAP_QUALITY,  # full, high, medium or low density resolution
+    format: str = "json",  # json (rendered PNGs and stats) or grid (raw density, see app/rawgrid.py)
+    dtype: str = "uint8",  # format=grid cell type: uint8 or float16
+    compress: bool = True,  # format=grid: zlib-compress the cells
     current_user: User = Depends(get_current_user),
     db: Session = Depends(get_db)
 ):
@@ -123,172 +395,108 @@ async def get_session_heatmap(
     
     if not session:
         raise HTTPException(status_code=404, detail="Session not found")
+    if format == "grid":
+        return await _session_grid_response(session, type, quality, dtype, compress)
+    # Gaze and cursor heatmaps are both rendered (and compared) whatever the type
+    _check_memory_budget(*_screen_size(session), quality, maps=2)
     
     try:
         # Check if type is valid
         if type not in ["gaze", "cursor", "combined"]:
             type = "combined"  # Default to combined if invalid
+        if quality not in HEATMAP_QUALITY_SCALES:
+            quality = DEFAULT_HEATMAP_QUALITY
 
         # Get screen dimensions from the session if available, or use defaults
         screen_width = session.screen_width if hasattr(session, 'screen_width') and session.screen_width else 1920
         screen_height = session.screen_height if hasattr(session, 'screen_height') and session.screen_height else 1080
 
-        # Initialize variables for both heatmaps
-        gaze_heatmap_image = None
-        gaze_raw_heatmap = None
-        gaze_stats = None
-        cursor_heatmap_image = None
-        cursor_raw_heatmap = None
-        cursor_stats = None
-        correlation_metrics = None
+        # Unchanged sessions are served from the cache
+        key = _heatmap_cache_key("session_heatmap", session, screen_width, screen_height, type, quality)
+        cached = await heatmap_cache.fetch(key)
+        if cached is not None:
+            print(f"Serving cached heatmap for session {session_id} (version {session.data_version})")
+            return cached
 
-        # Always fetch both gaze and cursor data if available
-        gaze_count = db.query(GazeData).filter(GazeData.session_id == session_id).count()
-        cursor_count = db.query(CursorData).filter(CursorData.session_id == session_id).count()
-
-        print(f"Session {session_id} has {gaze_count} gaze points and {cursor_count} cursor points")
-
-        # Process gaze data if available
-        if gaze_count > 0:
-            gaze_data = db.query(GazeData).filter(
-                GazeData.session_id == session_id
-            ).order_by(GazeData.timestamp.desc()).limit(10000).all()
-            
-            gaze_points = [{
-                'x': point.x,
-                'y': point.y,
-                'timestamp': point.timestamp.timestamp() * 1000
-            } for point in gaze_data if point.x is not None and point.y is not None]
-            
-            if gaze_points:
-                print(f"Generating gaze heatmap with {len(gaze_points)} points")
-                gaze_heatmap_image, gaze_raw_heatmap = generate_heatmap(gaze_points, screen_width, screen_height)
-                gaze_stats = calculate_heatmap_stats(gaze_raw_heatmap, gaze_points)
-
-        # Process cursor data if available
-        if cursor_count > 0:
-            cursor_data = db.query(CursorData).filter(
-                CursorData.session_id == session_id
-            ).order_by(CursorData.timestamp.desc()).limit(10000).all()
-            
-            cursor_points = [{
-                'x': point.x,
-                'y': point.y,
-                'timestamp': point.timestamp.timestamp() * 1000
-            } for point in cursor_data if point.x is not None and point.y is not None]
-            
-            if cursor_points:
-                print(f"Generating cursor heatmap with {len(cursor_points)} points")
-                cursor_heatmap_image, cursor_raw_heatmap = generate_heatmap(cursor_points, screen_width, screen_height)
-                cursor_stats = calculate_heatmap_stats(cursor_raw_heatmap, cursor_points)
-
-        # Calculate correlation metrics if both heatmaps are available
-        if gaze_raw_heatmap is not None and cursor_raw_heatmap is not None:
-            print(f"Calculating correlation metrics for session {session_id}")
-            
-            # Check if heatmaps have different shapes and resize if needed
-            if gaze_raw_heatmap.shape != cursor_raw_heatmap.shape:
-                print(f"Heatmap shapes don't match! Gaze: {gaze_raw_heatmap.shape}, Cursor: {cursor_raw_heatmap.shape}")
-                
-                # Resize cursor heatmap to match gaze heatmap
-                import cv2
-                cursor_raw_heatmap = cv2.resize(cursor_raw_heatmap, 
-                                              (gaze_raw_heatmap.shape[1], gaze_raw_heatmap.shape[0]), 
-                                              interpolation=cv2.INTER_AREA)
-                print(f"Resized cursor heatmap to {cursor_raw_heatmap.shape}")
-            
-            correlation_metrics = calculate_correlation_metrics(gaze_raw_heatmap, cursor_raw_heatmap)
-            print(f"Correlation metrics calculated: {correlation_metrics}")
-
-        # Create a base response with basic info
-        response = {
-            "correlationMetrics": correlation_metrics
-        }
-
-        # Prepare the response based on requested type
-        if type == "cursor":
-            if not cursor_heatmap_image:
-                print("No cursor heatmap available")
-                response.update({
-                    "image": "",
-                    "stats": {
-                        "pointCount": 0,
-                        "focus_areas": 0,
-                        "attention_score": 0,
-                        "coverage": 0,
-                        "kld": 0,
-                        "nss": 0,
-                        "similarity": 0,
-                        "cc": 0,
-                        "auc": 0
-                    }
-                })
-            else:
-                response.update({
-                    "image": cursor_heatmap_image,
-                    "stats": cursor_stats,
-                })
-        else:
-            # For gaze or combined view
-            if not gaze_heatmap_image:
-                print("No gaze heatmap available")
-                response.update({
-                    "image": "",
-                    "stats": {
-                        "pointCount": 0,
-                        "focus_areas": 0,
-                        "attention_score": 0,
-                        "coverage": 0,
-                        "kld": 0,
-                        "nss": 0,
-                        "similarity": 0,
-                        "cc": 0,
-                        "auc": 0
-                    }
-                })
-            else:
-                response.update({
-                    "image": gaze_heatmap_image,
-                    "stats": gaze_stats,
-                })
-
-        # Add cursor data if available, regardless of view type
-        if cursor_heatmap_image:
-            response.update({
-                "cursorHeatmapUrl": cursor_heatmap_image,
-                "cursorStats": cursor_stats
-            })
-
-        # Add gaze data if available, regardless of view type
-        if gaze_heatmap_image and type == "cursor":
-            response.update({
-                "gazeHeatmapUrl": gaze_heatmap_image,
-                "gazeStats": gaze_stats
-            })
-
-        # Add video URL if available
-        if hasattr(session, 'video_url') and session.video_url:
-            response["videoUrl"] = session.video_url
-            
-        # Add server URL if needed
-        response["serverUrl"] = None
-
-        # Log the final response structure
-        print(f"Response structure keys: {list(response.keys())}")
-        if correlation_metrics:
-            print(f"Correlation metrics in response: {list(correlation_metrics.keys())}")
-        
+        response = await run_analytics(
+            _render_session_heatmap, session.id, session.gaze_count or 0, session.cursor_count or 0,
+            getattr(session, 'video_url', None), type, quality, screen_width, screen_height
+        )
+        await heatmap_cache.store(key, response)
         return response
 
+    except AnalyticsTimeout as e:
+        raise HTTPException(status_code=504, detail=str(e))
     except Exception as e:
         print(f"Error generating heatmap: {str(e)}")
         import traceback
         traceback.print_exc()
         raise HTTPException(status_code=500, detail=f"Error generating heatmap: {str(e)}")
 
+@with_db_session
+def _render_correlation(db, session_id, quality, screen_width, screen_height):
+    """Gaze/cursor correlation metrics for a session (runs on the analytics pool)"""
+    # Get gaze data
+    gaze_counts, gaze_counted = load_grid(db, session_id, "gaze")
+
+    if not gaze_counted:
+        return {"error": "No valid gaze points found"}
+
+    print(f"Found {gaze_counted} valid gaze points")
+
+    # Get cursor data
+    cursor_counts, cursor_counted = load_grid(db, session_id, "cursor")
+
+    if not cursor_counted:
+        return {"error": "No valid cursor points found"}
+
+    print(f"Found {cursor_counted} valid cursor points")
+
+    # Generate both heatmaps
+    print(f"Generating gaze heatmap for correlation metrics")
+    gaze_heatmap_image, gaze_raw_heatmap = grid_heatmap(gaze_counts, screen_width, screen_height, quality=quality)
+
+    print(f"Generating cursor heatmap for correlation metrics")
+    cursor_heatmap_image, cursor_raw_heatmap = grid_heatmap(cursor_counts, screen_width, screen_height, quality=quality)
+
+    # Log raw heatmap info
+    print(f"Gaze heatmap shape: {gaze_raw_heatmap.shape}, min: {np.min(gaze_raw_heatmap)}, max: {np.max(gaze_raw_heatmap)}")
+    print(f"Cursor heatmap shape: {cursor_raw_heatmap.shape}, min: {np.min(cursor_raw_heatmap)}, max: {np.max(cursor_raw_heatmap)}")
+
+    # Check if shapes match and resize if needed
+    if gaze_raw_heatmap.shape != cursor_raw_heatmap.shape:
+        print(f"Heatmap shapes don't match! Resizing...")
+        import cv2
+        cursor_raw_heatmap = cv2.resize(cursor_raw_heatmap, 
+                                    (gaze_raw_heatmap.shape[1], gaze_raw_heatmap.shape[0]), 
+                                    interpolation=cv2.INTER_AREA)
+
+    # Calculate correlation metrics
+    correlation_metrics = calculate_correlation_metrics(gaze_raw_heatmap, cursor_raw_heatmap)
+
+    # Print out the raw data of correlation metrics to help debug
+    print("RAW CORRELATION METRICS:")
+    for metric, value in correlation_metrics.items():
+        print(f"  {metric}: {value} (type: {type(value)})")
+
+    # Return the metrics with additional debug info
+    result = {
+        **correlation_metrics,
+        "_debug": {
+            "gaze_points_count": gaze_counted,
+            "cursor_points_count": cursor_counted,
+            "gaze_heatmap_shape": gaze_raw_heatmap.shape,
+            "cursor_heatmap_shape": cursor_raw_heatmap.shape,
+            "gaze_heatmap_max": float(np.max(gaze_raw_heatmap)),
+            "cursor_heatmap_max": float(np.max(cursor_raw_heatmap))
+        }
+    }
+    return result
+
 @router.get("/sessions/{session_id}/correlation_metrics")
 async def get_correlation_metrics(
     session_id: int,
+    quality: str = DEFAULT_HEATMAP_QUALITY,
     current_user: User = Depends(get_current_user),
     db: Session = Depends(get_db)
 ):
@@ -305,15 +513,23 @@ async def get_correlation_metrics(
     
     if not session:
         raise HTTPException(status_code=404, detail="Session not found")
+    _check_memory_budget(*_screen_size(session), quality, maps=2)
     
     try:
         # Get screen dimensions from the session if available, or use defaults
         screen_width = session.screen_width if hasattr(session, 'screen_width') and session.screen_width else 1920
         screen_height = session.screen_height if hasattr(session, 'screen_height') and session.screen_height else 1080
+        if quality not in HEATMAP_QUALITY_SCALES:
+            quality = DEFAULT_HEATMAP_QUALITY
+
+        key = _heatmap_cache_key("correlation_metrics", session, screen_width, screen_height, quality)
+        cached = await heatmap_cache.fetch(key)
+        if cached is not None:
+            return cached
 
         # Check if both gaze and cursor data exist
-        gaze_count = db.query(GazeData).filter(GazeData.session_id == session_id).count()
-        cursor_count = db.query(CursorData).filter(CursorData.session_id == session_id).count()
+        gaze_count = session.gaze_count or 0
+        cursor_count = session.cursor_count or 0
         
         print(f"Session {session_id} has {gaze_count} gaze points and {cursor_count} cursor points")
         
@@ -324,79 +540,396 @@ async def get_correlation_metrics(
                 "cursor_count": cursor_count
             }
 
-        # Get gaze data
-        gaze_data = db.query(GazeData).filter(
-            GazeData.session_id == session_id
-        ).order_by(GazeData.timestamp.desc()).limit(10000).all()
-        
-        gaze_points = [{
-            'x': point.x,
-            'y': point.y,
-            'timestamp': point.timestamp.timestamp() * 1000
-        } for point in gaze_data if point.x is not None and point.y is not None]
-        
-        if not gaze_points:
-            return {"error": "No valid gaze points found"}
-            
-        print(f"Found {len(gaze_points)} valid gaze points")
-
-        # Get cursor data
-        cursor_data = db.query(CursorData).filter(
-            CursorData.session_id == session_id
-        ).order_by(CursorData.timestamp.desc()).limit(10000).all()
-        
-        cursor_points = [{
-            'x': point.x,
-            'y': point.y,
-            'timestamp': point.timestamp.timestamp() * 1000
-        } for point in cursor_data if point.x is not None and point.y is not None]
-        
-        if not cursor_points:
-            return {"error": "No valid cursor points found"}
-            
-        print(f"Found {len(cursor_points)} valid cursor points")
-
-        # Generate both heatmaps
-        print(f"Generating gaze heatmap for correlation metrics")
-        gaze_heatmap_image, gaze_raw_heatmap = generate_heatmap(gaze_points, screen_width, screen_height)
-        
-        print(f"Generating cursor heatmap for correlation metrics")
-        cursor_heatmap_image, cursor_raw_heatmap = generate_heatmap(cursor_points, screen_width, screen_height)
-        
-        # Log raw heatmap info
-        print(f"Gaze heatmap shape: {gaze_raw_heatmap.shape}, min: {np.min(gaze_raw_heatmap)}, max: {np.max(gaze_raw_heatmap)}")
-        print(f"Cursor heatmap shape: {cursor_raw_heatmap.shape}, min: {np.min(cursor_raw_heatmap)}, max: {np.max(cursor_raw_heatmap)}")
-            
-        # Check if shapes match and resize if needed
-        if gaze_raw_heatmap.shape != cursor_raw_heatmap.shape:
-            print(f"Heatmap shapes don't match! Resizing...")
-            import cv2
-            cursor_raw_heatmap = cv2.resize(cursor_raw_heatmap, 
-                                        (gaze_raw_heatmap.shape[1], gaze_raw_heatmap.shape[0]), 
-                                        interpolation=cv2.INTER_AREA)
-        
-        # Calculate correlation metrics
-        correlation_metrics = calculate_correlation_metrics(gaze_raw_heatmap, cursor_raw_heatmap)
-        
-        # Print out the raw data of correlation metrics to help debug
-        print("RAW CORRELATION METRICS:")
-        for key, value in correlation_metrics.items():
-            print(f"  {key}: {value} (type: {type(value)})")
-        
-        # Return the metrics with additional debug info
-        return {
-            **correlation_metrics,
-            "_debug": {
-                "gaze_points_count": len(gaze_points),
-                "cursor_points_count": len(cursor_points),
-                "gaze_heatmap_shape": gaze_raw_heatmap.shape,
-                "cursor_heatmap_shape": cursor_raw_heatmap.shape,
-                "gaze_heatmap_max": float(np.max(gaze_raw_heatmap)),
-                "cursor_heatmap_max": float(np.max(cursor_raw_heatmap))
-            }
-        }
+        result = await run_analytics(_render_correlation, session_id, quality, screen_width, screen_height)
+        if "error" not in result:
+            await heatmap_cache.store(key, result)
+        return result
+    except AnalyticsTimeout as e:
+        raise HTTPException(status_code=504, detail=str(e))
     except Exception as e:
         print(f"Error calculating correlation metrics: {str(e)}")
         import traceback
         traceback.print_exc()
-        return {"error": str(e)} 
\ No newline at end of file
+        return {"error": str(e)}
+
+@router.get("/heatmap/cache/stats")
+async def get_heatmap_cache_stats(current_user: User = Depends(get_current_user)):
+    """Hit, miss and eviction counters of the heatmap result cache"""
+    return heatmap_cache.stats()
+
+def _screen_size(session):
+    width = session.screen_width if hasattr(session, 'screen_width') and session.screen_width else 1920
+    height = session.screen_height if hasattr(session, 'screen_height') and session.screen_height else 1080
+    return width, height
+
+def _user_session(db, session_id, user):
+    session = db.query(SessionModel).filter(
+        SessionModel.id == session_id,
+        SessionModel.user_id == user.id
+    ).first()
+    if not session:
+        raise HTTPException(status_code=404, detail="Session not found")
+    return session
+
+@router.get("/sessions/{session_id}/heatmap/tiles")
+async def get_heatmap_tile_layout(
+    session_id: int,
+    type: str = "gaze",
+    current_user: User = Depends(get_current_user),
+    db: Session = Depends(get_db)
+):
+    """Zoom levels and tile counts of a session's tiled heatmap"""
+    session = _user_session(db, session_id, current_user)
+    if type not in ["gaze", "cursor"]:
+        type = "gaze"
+    width, height = _screen_size(session)
+    return {
+        "tileSize": TILE_SIZE,
+        "width": width,
+        "height": height,
+        "minZoom": 0,
+        "maxZoom": max_zoom(width, height),
+        "levels": tile_layout(width, height),
+        "version": session.data_version or 0,
+        "urlTemplate": f"/api/sessions/{session_id}/heatmap/tiles/{{z}}/{{x}}/{{y}}.png?type={type}"
+    }
+
+@router.get("/sessions/{session_id}/heatmap/tiles/{z}/{x}/{y}.png")
+async def get_heatmap_tile(
+    session_id: int,
+    z: int,
+    x: int,
+    y: int,
+    type: str = "gaze",
+    if_none_match: Optional[str] = Header(None),
+    current_user: User = Depends(get_current_user),
+    db: Session = Depends(get_db)
+):
+    """
+    One TILE_SIZE x TILE_SIZE PNG of a session's heatmap at zoom z. Tiles are rendered on
+    first request from a density pyramid built from the session's count grid, and cached.
+    """
+    session = _user_session(db, session_id, current_user)
+    if type not in ["gaze", "cursor"]:
+        type = "gaze"
+    width, height = _screen_size(session)
+
+    levels = tile_layout(width, height)
+    if not 0 <= z < len(levels) or not 0 <= x < levels[z]["columns"] or not 0 <= y < levels[z]["rows"]:
+        raise HTTPException(status_code=404, detail="Tile not found")
+
+    key = _heatmap_cache_key("heatmap_tile", session, width, height, type, TILE_SIZE, z, x, y)
+    etag = make_etag(key)
+    if etag_matches(if_none_match, etag):
+        return not_modified(etag)
+    png = await heatmap_cache.fetch_bytes(key)
+    if png is None:
+        version = session.data_version or 0
+
+        @with_db_session
+        def render(db):
+            def build():
+                counts, _ = load_grid(db, session_id, type)
+                return build_pyramid(counts, width, height)
+
+            pyramid = pyramid_cache.get((session_id, version, type, width, height), build)
+            return render_tile(pyramid, z, x, y, width, height)
+
+        try:
+            png = await run_analytics(render)
+        except AnalyticsTimeout as e:
+            raise HTTPException(status_code=504, detail=str(e))
+        await heatmap_cache.store_bytes(key, png)
+
+    return image_response(png, "image/png", etag)
+
+@router.get("/sessions/{session_id}/heatmap/image")
+async def get_session_heatmap_image(
+    session_id: int,
+    type: str = "gaze",
+    quality: str = DEFAULT_HEATMAP_QUALITY,
+    format: str = "png",  # png or webp
+    if_none_match: Optional[str] = Header(None),
+    current_user: User = Depends(get_current_user),
+    db: Session = Depends(get_db)
+):
+    """
+    The session's gaze or cursor heatmap as image bytes, with an ETag from the session's
+    data version: clients revalidate with If-None-Match and get a 304 until new samples arrive
+    """
+    session = _user_session(db, session_id, current_user)
+    if type not in ["gaze", "cursor"]:
+        type = "gaze"
+    if quality not in HEATMAP_QUALITY_SCALES:
+        quality = DEFAULT_HEATMAP_QUALITY
+    if format not in IMAGE_MEDIA_TYPES:
+        format = "png"
+    width, height = _screen_size(session)
+
+    key = _heatmap_cache_key("heatmap_image", session, width, height, type, quality, format)
+    etag = make_etag(key)
+    if etag_matches(if_none_match, etag):
+        return not_modified(etag)
+    _check_memory_budget(width, height, quality)
+
+    image = await heatmap_cache.fetch_bytes(key)
+    if image is None:
+        @with_db_session
+        def render(db):
+            counts, total = load_grid(db, session_id, type)
+            return grid_image(counts, width, height, quality=quality, format=format) if total else None
+
+        try:
+            image = await run_analytics(render)
+        except AnalyticsTimeout as e:
+            raise HTTPException(status_code=504, detail=str(e))
+        if image is None:
+            raise HTTPException(status_code=404, detail=f"Session has no {type} samples")
+        await heatmap_cache.store_bytes(key, image)
+
+    return image_response(image, IMAGE_MEDIA_TYPES[format], etag)
+
+@with_db_session
+def _render_window(db, session_id, version, kind, quality, start_time, end_time, width, height):
+    """Heatmap and stats of the samples in start_time..end_time (runs on the analytics pool)"""
+    index = load_index(db, session_id, kind, version)
+    counts, total = window_counts(db, session_id, kind, index, start_time, end_time)
+    print(f"Window heatmap for session {session_id}: {total} {kind} points in {start_time}..{end_time}")
+    if not total:
+        return "", {"pointCount": 0}, 0
+    image, raw = grid_heatmap(counts, width, height, quality=quality, grid_scale=TIMELINE_SCALE)
+    stats = calculate_heatmap_stats(
+        raw, fixation_cells(fit_grid(counts, width, height, TIMELINE_SCALE), TIMELINE_SCALE), point_count=total
+    )
+    return image, stats, total
+
+@router.get("/sessions/{session_id}/heatmap/window")
+async def get_window_heatmap(
+    session_id: int,
+    start_time: Optional[float] = None,
+    end_time: Optional[float] = None,
+    type: str = "gaze",
+    quality: str = DEFAULT_HEATMAP_QUALITY,
+    current_user: User = Depends(get_current_user),
+    db: Session = Depends(get_db)
+):
+    """
+    Heatmap of the samples with start_time <= t <= end_time (ms since epoch, open-ended when
+    omitted), computed from the session's time-bucket index
+    """
+    session = _user_session(db, session_id, current_user)
+    if type not in ["gaze", "cursor"]:
+        type = "gaze"
+    if quality not in HEATMAP_QUALITY_SCALES:
+        quality = DEFAULT_HEATMAP_QUALITY
+    if start_time is not None and end_time is not None and start_time > end_time:
+        raise HTTPException(status_code=400, detail="start_time must not be after end_time")
+    width, height = _screen_size(session)
+    _check_memory_budget(width, height, quality)
+
+    key = _heatmap_cache_key("window_heatmap", session, width, height, type, quality, start_time, end_time,
+                             TIMELINE_BUCKET_MS, TIMELINE_SCALE)
+    cached = await heatmap_cache.fetch(key)
+    if cached is not None:
+        return cached
+
+    try:
+        image, stats, total = await run_analytics(
+            _render_window, session.id, session.data_version or 0, type, quality, start_time, end_time, width, height
+        )
+    except AnalyticsTimeout as e:
+        raise HTTPException(status_code=504, detail=str(e))
+
+    response = {
+        "image": image,
+        "stats": stats,
+        "pointCount": total,
+        "type": type,
+        "start_time": start_time,
+        "end_time": end_time
+    }
+    await heatmap_cache.store(key, response)
+    return response
+
+@router.get("/sessions/{session_id}/timeline")
+async def get_session_timeline(
+    session_id: int,
+    type: str = "gaze",
+    current_user: User = Depends(get_current_user),
+    db: Session = Depends(get_db)
+):
+    """Samples per time bucket over the session, for drawing a scrubbable activity timeline"""
+    session = _user_session(db, session_id, current_user)
+    if type not in ["gaze", "cursor"]:
+        type = "gaze"
+
+    try:
+        index = await run_analytics(with_db_session(load_index), session_id, type, session.data_version or 0)
+    except AnalyticsTimeout as e:
+        raise HTTPException(status_code=504, detail=str(e))
+
+    return {
+        "type": type,
+        "bucket_ms": TIMELINE_BUCKET_MS,
+        "start_time": session.first_sample_time,
+        "end_time": session.last_sample_time,
+        "buckets": [{"start_time": start, "count": count} for start, count in bucket_activity(index)]
+    }
+
+FRAME_BOUNDARY = "heatgaze-frame"
+
+def _frame_stream(session_id, kind, start_time, end_time, step_ms, mode, window_ms, width, height, scale, format):
+    """
+    Generator behind the frames response: renders each frame as soon as the pass over the
+    samples reaches its end. Opens its own database session (the request's is closed by then).
+    """
+    db = SessionLocal()
+    try:
+        frames = iter_frame_counts(db, session_id, kind, start_time, end_time, step_ms, width, height,
+                                   scale=scale, mode=mode, window_ms=window_ms)
+        for frame, frame_time, counts, points in frames:
+            png = render_frame(counts, width, height, scale)
+            if format == "multipart":
+                yield (f"--{FRAME_BOUNDARY}\r\nContent-Type: image/png\r\nContent-Length: {len(png)}\r\n"
+                       f"X-Frame-Index: {frame}\r\nX-Frame-Time: {frame_time}\r\n\r\n").encode() + png + b"\r\n"
+            else:
+                yield (json.dumps({
+                    "frame": frame,
+                    "t": frame_time,
+                    "pointCount": points,
+                    "image": base64.b64encode(png).decode("utf-8")
+                }) + "\n").encode()
+    finally:
+        db.close()
+
+@router.get("/sessions/{session_id}/heatmap/frames")
+async def get_heatmap_frames(
+    session_id: int,
+    type: str = "gaze",
+    step_ms: float = 5000,
+    mode: str = "cumulative",  # cumulative or sliding
+    window_ms: Optional[float] = None,  # sliding window length (defaults to one step)
+    start_time: Optional[float] = None,
+    end_time: Optional[float] = None,
+    quality: str = "low",
+    format: str = "ndjson",  # ndjson or multipart
+    current_user: User = Depends(get_current_user),
+    db: Session = Depends(get_db)
+):
+    """
+    Stream heatmap frames showing how attention builds up over a session, one every step_ms
+    from start_time to end_time (default: the first and last sample of that type).
+
+    format=ndjson sends one JSON object per line with the frame index, its end time t, the
+    points it covers and a base64 PNG. format=multipart sends the PNGs as a
+    multipart/x-mixed-replace stream that browsers play back as an animation.
+    """
+    session = _user_session(db, session_id, current_user)
+    if type not in ["gaze", "cursor"]:
+        type = "gaze"
+    if mode not in FRAME_MODES:
+        mode = "cumulative"
+    if quality not in HEATMAP_QUALITY_SCALES:
+        quality = "low"
+    if format not in ("ndjson", "multipart"):
+        raise HTTPException(status_code=400, detail="format must be ndjson or multipart")
+    if step_ms <= 0 or (window_ms is not None and window_ms <= 0):
+        raise HTTPException(status_code=400, detail="step_ms and window_ms must be positive")
+
+    if start_time is None or end_time is None:
+        # Default to the span of this kind of samples (the session's span covers both kinds)
+        first, last = sample_span(db, session_id, type)
+        start_time = first if start_time is None else start_time
+        end_time = last if end_time is None else end_time
+    if start_time is None or end_time is None:
+        raise HTTPException(status_code=404, detail="Session has no samples")
+    if start_time > end_time:
+        raise HTTPException(status_code=400, detail="start_time must not be after end_time")
+    frames = frame_count(start_time, end_time, step_ms)
+    if frames > MAX_FRAMES:
+        raise HTTPException(status_code=400, detail=f"{frames} frames requested, the limit is {MAX_FRAMES}; use a larger step_ms")
+
+    width, height = _screen_size(session)
+    _check_memory_budget(width, height, quality)
+    media_type = f"multipart/x-mixed-replace; boundary={FRAME_BOUNDARY}" if format == "multipart" else "application/x-ndjson"
+    return StreamingResponse(
+        _frame_stream(session_id, type, start_time, end_time, step_ms, mode, window_ms, width, height,
+                      HEATMAP_QUALITY_SCALES[quality], format),
+        media_type=media_type,
+        headers={"X-Frame-Count": str(frames)}
+    )
+
+def _render_aggregate(partials, width, height, quality):
+    """Combine chunk sums into one heatmap (runs on the analytics pool)"""
+    grid, points, used = combine(partials)
+    if not points:
+        return {"image": "", "stats": {"pointCount": 0}, "pointCount": 0, "sessionCount": 0}
+    image, raw = grid_heatmap(grid, width, height, quality=quality)
+    stats = calculate_heatmap_stats(raw, fixation_cells(fit_grid(grid, width, height)), point_count=points)
+    return {"image": image, "stats": stats, "pointCount": points, "sessionCount": used}
+
+@router.get("/heatmap/aggregate")
+async def get_aggregate_heatmap(
+    type: str = "gaze",
+    url: Optional[str] = None,  # only sessions that showed this page, and only while it was on screen
+    start_date: Optional[datetime] = None,  # sessions created from ...
+    end_date: Optional[datetime] = None,  # ... until
+    session_ids: Optional[List[int]] = Query(None),
+    normalize: str = "global",  # global (every sample counts the same) or session (every session does)
+    quality: str = DEFAULT_HEATMAP_QUALITY,
+    width: int = GRID_WIDTH,
+    height: int = GRID_HEIGHT,
+    current_user: User = Depends(get_current_user),
+    db: Session = Depends(get_db)
+):
+    """
+    One heatmap over all of the user's sessions matching the filter. Per-session grids are
+    summed in chunks on the analytics pool; results are cached by the sessions' data versions.
+    """
+    if type not in ["gaze", "cursor"]:
+        type = "gaze"
+    if normalize not in NORMALIZATIONS:
+        normalize = "global"
+    if quality not in HEATMAP_QUALITY_SCALES:
+        quality = DEFAULT_HEATMAP_QUALITY
+    width = width if width > 0 else GRID_WIDTH
+    height = height if height > 0 else GRID_HEIGHT
+    _check_memory_budget(width, height, quality)
+
+    sessions = select_sessions(db, current_user.id, type, start_date, end_date, url, session_ids)
+    if not sessions:
+        raise HTTPException(status_code=404, detail="No sessions with data match the filter")
+    if len(sessions) > AGGREGATE_MAX_SESSIONS:
+        raise HTTPException(status_code=400, detail=f"{len(sessions)} sessions match, the limit is {AGGREGATE_MAX_SESSIONS}")
+
+    try:
+        key = cache_key("aggregate_heatmap", type, url or "", normalize, quality, width, height,
+                        GRID_WIDTH, GRID_HEIGHT, GRID_SCALE, f"render-{RENDER_VERSION}-{WEBP_QUALITY}",
+                        *(f"{session_id}:{version}" for session_id, version in sessions))
+        cached = await heatmap_cache.fetch(key)
+        if cached is not None:
+            print(f"Serving cached aggregate heatmap over {len(sessions)} sessions")
+            return cached
+
+        chunks = chunk_sessions(sessions)
+        print(f"Aggregating {type} heatmap over {len(sessions)} sessions in {len(chunks)} chunks")
+        partials = await asyncio.gather(*(
+            run_analytics(reduce_chunk, chunk, type, url, normalize) for chunk in chunks
+        ))
+        response = await run_analytics(_render_aggregate, partials, width, height, quality)
+        response.update({
+            "type": type,
+            "url": url,
+            "normalize": normalize,
+            "sessionIds": [session_id for session_id, _ in sessions]
+        })
+        await heatmap_cache.store(key, response)
+        return response
+
+    except AnalyticsTimeout as e:
+        raise HTTPException(status_code=504, detail=str(e))
+    except Exception as e:
+        print(f"Error generating aggregate heatmap: {str(e)}")
+        import traceback
+        traceback.print_exc()
+        raise HTTPException(status_code=500, detail=f"Error generating aggregate heatmap: {str(e)}")
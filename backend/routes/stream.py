@@ -0,0 +1,185 @@
+from fastapi import APIRouter, WebSocket, WebSocketDisconnect, status
+from app.database import SessionLocal
+from app.models import Session as SessionModel
+from app.ingest import batch_from_points, concat_batches
+from app.ingest_queue import ingest_queue, QueueFullError, IngestCommitError
+from app.columnar import batch_from_columns, decode_binary, is_cursor_payload
+from routes.auth import get_user_from_token
+import asyncio
+import json
+import time
+
+# Router
+router = APIRouter()
+
+# Buffered samples are written and acknowledged once either limit is reached
+ACK_WINDOW_POINTS = 500
+ACK_WINDOW_MS = 1000
+
+class StreamBuffer:
+    """Samples received on one connection since the last acknowledged write"""
+
+    def __init__(self):
+        self.gaze = []
+        self.cursor = []
+        self.points = 0
+        self.rejected = 0
+        self.last_seq = None
+        self.opened_at = None
+
+    def add(self, kind, batch, seq):
+        # The window starts with its first sample, not when the buffer was created, so an
+        # idle gap doesn't make the next frame flush on its own
+        if self.points == 0:
+            self.opened_at = time.monotonic()
+        (self.gaze if kind == "gaze" else self.cursor).append(batch)
+        self.points += len(batch)
+        self.rejected += batch.rejected
+        if seq is not None:
+            self.last_seq = seq
+
+    def due(self):
+        if self.points >= ACK_WINDOW_POINTS:
+            return True
+        return self.points > 0 and (time.monotonic() - self.opened_at) * 1000 >= ACK_WINDOW_MS
+
+    def remaining_ms(self):
+        return max(0.0, ACK_WINDOW_MS - (time.monotonic() - self.opened_at) * 1000)
+
+async def _receive_frame(websocket):
+    """Receive one text or binary frame, raising WebSocketDisconnect when the client goes away"""
+    message = await websocket.receive()
+    if message["type"] == "websocket.disconnect":
+        raise WebSocketDisconnect(message.get("code", 1000))
+    return message.get("text"), message.get("bytes")
+
+def _decode_frame(text, data):
+    """
+    Turn a frame into (kind, batch, seq). Binary frames carry the packed columnar format;
+    text frames are JSON with either a "points" list or a "columns" object.
+    """
+    if data is not None:
+        kind = "cursor" if is_cursor_payload(data) else "gaze"
+        return kind, decode_binary(data, with_pupils=(kind == "gaze")), None
+
+    message = json.loads(text)
+    kind = message.get("type") if isinstance(message, dict) else None
+    if kind not in ("gaze", "cursor"):
+        return kind, None, None
+
+    if message.get("columns") is not None:
+        batch = batch_from_columns(message["columns"], with_pupils=(kind == "gaze"))
+    else:
+        points = message.get("points") or []
+        if not isinstance(points, list):
+            raise ValueError("points must be a list")
+        batch = batch_from_points(
+            points,
+            with_pupils=(kind == "gaze"),
+            parse_string_timestamps=(kind == "cursor")
+        )
+    return kind, batch, message.get("seq")
+
+async def _flush(session_id, buffer):
+    """Hand everything buffered to the ingestion queue and return the ack message"""
+    gaze = concat_batches(buffer.gaze)
+    cursor = concat_batches(buffer.cursor)
+    await ingest_queue.submit(session_id, gaze=gaze, cursor=cursor)
+    return {
+        "type": "ack",
+        "seq": buffer.last_seq,
+        "gaze_added": len(gaze) if gaze is not None else 0,
+        "cursor_added": len(cursor) if cursor is not None else 0,
+        "rejected": buffer.rejected
+    }
+
+@router.websocket("/sessions/{session_id}/stream")
+async def stream_session_data(websocket: WebSocket, session_id: int, token: str = None):
+    """
+    Streaming ingestion of live gaze and cursor samples.
+
+    Authenticate with ?token=<JWT>. Ownership of the session is checked once when the
+    connection opens. The client then sends JSON frames:
+        {"type": "gaze" | "cursor", "seq": <int, optional>, "points": [{timestamp, x, y, ...}, ...]}
+        {"type": "gaze" | "cursor", "seq": <int, optional>, "columns": {"t": [...], "x": [...], "y": [...]}}
+        {"type": "flush"}
+    or binary frames in the packed columnar format (app/columnar.py), flagged as cursor or gaze.
+    Samples are buffered and handed to the ingestion queue in windows of ACK_WINDOW_POINTS
+    points or ACK_WINDOW_MS milliseconds, whichever comes first. Each window is acknowledged with
+    {"type": "ack", "seq": <last seq in window>, "gaze_added", "cursor_added", "rejected"}.
+    If the window can't be accepted (the ingestion queue is full or the write failed), the
+    connection stays open and {"type": "error", "detail", "seq": <last seq in window>,
+    "retry": true} is sent instead; nothing in that window is saved and the client should
+    resend everything after its last acknowledged seq.
+    """
+    db = SessionLocal()
+    buffer = None
+    try:
+        user = get_user_from_token(db, token)
+        session = None
+        if user is not None:
+            session = db.query(SessionModel.id).filter(
+                SessionModel.id == session_id,
+                SessionModel.user_id == user.id
+            ).first()
+
+        if session is None:
+            await websocket.close(code=status.WS_1008_POLICY_VIOLATION)
+            return
+
+        # Ownership is only checked once; the connection doesn't need the DB after this
+        db.close()
+
+        await websocket.accept()
+        await websocket.send_json({"type": "ready", "session_id": session_id})
+
+        buffer = StreamBuffer()
+        while True:
+            try:
+                if buffer.points:
+                    frame = await asyncio.wait_for(_receive_frame(websocket), timeout=buffer.remaining_ms() / 1000)
+                else:
+                    frame = await _receive_frame(websocket)
+            except asyncio.TimeoutError:
+                frame = None
+
+            force = frame is None
+            if frame is not None:
+                try:
+                    kind, batch, seq = _decode_frame(*frame)
+                except ValueError as e:
+                    await websocket.send_json({"type": "error", "detail": f"Invalid frame: {str(e)}"})
+                    continue
+
+                if batch is not None:
+                    buffer.add(kind, batch, seq)
+                elif kind == "flush":
+                    force = True
+                else:
+                    await websocket.send_json({"type": "error", "detail": f"Unknown frame type: {kind}"})
+                    continue
+
+            if force or buffer.due():
+                try:
+                    reply = await _flush(session_id, buffer)
+                except (QueueFullError, IngestCommitError) as e:
+                    # Backpressure: leave the window unacknowledged so the client retries it
+                    reply = {"type": "error", "detail": f"Samples not saved: {str(e)}",
+                             "seq": buffer.last_seq, "retry": True}
+                await websocket.send_json(reply)
+                buffer = StreamBuffer()
+    except WebSocketDisconnect:
+        # Persist whatever arrived before the client went away
+        if buffer is not None and buffer.points:
+            try:
+                await _flush(session_id, buffer)
+            except Exception as e:
+                print(f"Error saving streamed data for session {session_id}: {e}")
+    except Exception as e:
+        print(f"Error in stream for session {session_id}: {e}")
+        try:
+            await websocket.close(code=status.WS_1011_INTERNAL_ERROR)
+        except Exception:
+            pass
+    finally:
+        db.close()
@@ -0,0 +1,164 @@
+"""
+Exactness checks for the per-session density indexes kept alongside the samples
+Writes randomized batches (both storage engines, out-of-order and off-screen samples) with
+heatmap reads interleaved, and asserts the incrementally maintained count grid and time-bucket
+index match what is computed from scratch over the stored samples, for random time windows.
+Run this script directly: python test_density_index.py (pytest also picks it up)
+"""
+import os
+import tempfile
+import numpy as np
+from sqlalchemy import create_engine, select, func
+from sqlalchemy.exc import IntegrityError
+from sqlalchemy.orm import sessionmaker
+
+import app.storage as storage
+import app.backlog as backlog
+from app.database import Base
+from app.models import User, Session as SessionModel, DensityBacklog
+from app.ingest import SampleBatch
+from app.grids import load_grid, _build_grid
+from app.timeline import load_index, window_counts, index_cache, _count, TIMELINE_BUCKET_MS
+
+START = 1.7e12
+SESSION_ID = 1
+
+def make_db(path):
+    engine = create_engine(f"sqlite:///{path}", connect_args={"check_same_thread": False})
+    Base.metadata.create_all(bind=engine)
+    factory = sessionmaker(autocommit=False, autoflush=False, bind=engine)
+    db = factory()
+    db.add(User(id=1, username="density", email="density@example.com", hashed_password="x"))
+    db.add(SessionModel(id=SESSION_ID, name="s", user_id=1))
+    db.commit()
+    db.close()
+    return engine, factory
+
+def random_batch(rng, count, span_ms):
+    timestamps = START + rng.uniform(0, span_ms, count)
+    # A few samples land off screen (outside the grid) and are not counted
+    x = rng.uniform(-50, 1970, count)
+    y = rng.uniform(-50, 1130, count)
+    return SampleBatch(timestamps, x, y)
+
+def ingest(factory, rng, engine_name):
+    previous = storage.STORAGE_ENGINE
+    storage.STORAGE_ENGINE = engine_name
+    db = factory()
+    try:
+        kind = "gaze" if rng.random() < 0.6 else "cursor"
+        batch = random_batch(rng, int(rng.integers(1, 400)), 60000)
+        storage.write_samples(db, SESSION_ID, **{kind: batch})
+        db.commit()
+    finally:
+        db.close()
+        storage.STORAGE_ENGINE = previous
+
+def test_grid_matches_a_rebuild():
+    rng = np.random.default_rng(2024)
+    with tempfile.TemporaryDirectory() as directory:
+        engine, factory = make_db(os.path.join(directory, "density.db"))
+        for step in range(60):
+            ingest(factory, rng, "chunks" if step % 3 == 0 else "rows")
+            if step % 7 == 0:
+                db = factory()
+                load_grid(db, SESSION_ID, "gaze")
+                db.close()
+
+        db = factory()
+        # Writes only leave a backlog; the grids are caught up on read
+        assert db.execute(select(func.count()).select_from(DensityBacklog)).scalar() > 0
+        for kind in ("gaze", "cursor"):
+            counts, total = load_grid(db, SESSION_ID, kind)
+            expected, expected_total = _build_grid(db, SESSION_ID, kind)
+            assert total == expected_total
+            assert np.array_equal(counts, expected)
+        assert db.execute(select(func.count()).select_from(DensityBacklog)).scalar() == 0
+        db.close()
+        engine.dispose()
+
+def clear_index_cache():
+    """Cached indexes are keyed by session id and data version, which repeat across test databases"""
+    index_cache._indexes.clear()
+    index_cache._bytes = 0
+
+def brute_force_window(db, kind, start_time, end_time):
+    """Count grid of the stored samples in the window, straight from storage"""
+    samples = storage.load_samples(db, SESSION_ID, kind)
+    micros = np.rint(samples.timestamps * 1000)
+    mask = np.ones(len(samples), dtype=bool)
+    if start_time is not None:
+        mask &= micros >= round(start_time * 1000)
+    if end_time is not None:
+        mask &= micros <= round(end_time * 1000)
+    return _count(samples.take(np.flatnonzero(mask)))
+
+def test_timeline_windows_are_exact():
+    rng = np.random.default_rng(19)
+    clear_index_cache()
+    with tempfile.TemporaryDirectory() as directory:
+        engine, factory = make_db(os.path.join(directory, "density.db"))
+        version = 0
+        for step in range(40):
+            ingest(factory, rng, "chunks" if step % 2 else "rows")
+            if step % 9 == 0:
+                # Reads in between fold part of the backlog into the buckets
+                version += 1
+                db = factory()
+                load_index(db, SESSION_ID, "gaze", version)
+                db.close()
+
+        version += 1
+        db = factory()
+        for kind in ("gaze", "cursor"):
+            index = load_index(db, SESSION_ID, kind, version)
+            windows = [(None, None)]
+            for _ in range(30):
+                start, end = np.sort(START + rng.uniform(-1000, 61000, 2))
+                windows.append((float(start), float(end)))
+            # Windows on bucket edges and shorter than one bucket
+            edge = (np.floor(START / TIMELINE_BUCKET_MS) + 2) * TIMELINE_BUCKET_MS
+            windows += [(edge, edge + TIMELINE_BUCKET_MS), (edge + 10, edge + 900), (None, edge), (edge, None)]
+            for start_time, end_time in windows:
+                counts, total = window_counts(db, SESSION_ID, kind, index, start_time, end_time)
+                expected, expected_total = brute_force_window(db, kind, start_time, end_time)
+                assert total == expected_total, (kind, start_time, end_time)
+                assert np.array_equal(counts, expected), (kind, start_time, end_time)
+        db.close()
+        engine.dispose()
+
+def test_racing_rebuild_reloads_the_index():
+    rng = np.random.default_rng(5)
+    with tempfile.TemporaryDirectory() as directory:
+        engine, factory = make_db(os.path.join(directory, "density.db"))
+        for _ in range(5):
+            ingest(factory, rng, "rows")
+        expected = factory()
+        _, expected_total = brute_force_window(expected, "gaze", None, None)
+        expected.close()
+
+        original = backlog.fold_backlog
+
+        def racing_fold(db, session_id, kind):
+            # Another reader wins the race to build the buckets, then this one's insert collides
+            other = factory()
+            original(other, session_id, kind)
+            other.close()
+            raise IntegrityError("INSERT", {}, Exception("UNIQUE constraint failed"))
+
+        backlog.fold_backlog = racing_fold
+        try:
+            clear_index_cache()
+            db = factory()
+            index = load_index(db, SESSION_ID, "gaze", 1)
+            assert int(index.counts.sum()) == expected_total
+            db.close()
+        finally:
+            backlog.fold_backlog = original
+        engine.dispose()
+
+if __name__ == "__main__":
+    test_grid_matches_a_rebuild()
+    test_timeline_windows_are_exact()
+    test_racing_rebuild_reloads_the_index()
+    print("Density index OK")
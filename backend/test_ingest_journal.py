@@ -0,0 +1,109 @@
+"""
+Durability check for the write-behind ingestion queue
+Injects a commit failure ("database is locked") for one session and asserts its samples are
+not checkpointed away: flush() reports the failure, the record is still in the journal, and
+a restart with a working database replays it.
+Run this script directly: python test_ingest_journal.py (pytest also picks it up)
+"""
+import os
+import asyncio
+import tempfile
+import numpy as np
+from sqlalchemy import create_engine
+from sqlalchemy.exc import OperationalError
+from sqlalchemy.orm import sessionmaker
+
+import app.ingest_queue as ingest_queue_module
+from app.database import Base
+from app.models import User, Session as SessionModel
+from app.ingest import SampleBatch
+from app.ingest_queue import IngestionQueue, IngestCommitError
+from app.journal import Journal
+
+GOOD_SESSION = 1
+LOCKED_SESSION = 2
+
+def make_db(path):
+    engine = create_engine(f"sqlite:///{path}", connect_args={"check_same_thread": False})
+    Base.metadata.create_all(bind=engine)
+    factory = sessionmaker(autocommit=False, autoflush=False, bind=engine)
+    db = factory()
+    db.add(User(id=1, username="journal", email="journal@example.com", hashed_password="x"))
+    db.add_all([SessionModel(id=session_id, name="s", user_id=1) for session_id in (GOOD_SESSION, LOCKED_SESSION)])
+    db.commit()
+    db.close()
+    return engine, factory
+
+def make_batch(count, start=0.0):
+    timestamps = start + np.arange(count, dtype=np.float64) * 10
+    return SampleBatch(timestamps, np.full(count, 100.0), np.full(count, 200.0), None, None)
+
+def lock_session(session_id):
+    """Make write_samples fail for one session the way a busy SQLite database does"""
+    original = ingest_queue_module.write_samples
+
+    def write_samples(db, failing_id, **batches):
+        if failing_id == session_id:
+            raise OperationalError("INSERT", {}, Exception("database is locked"))
+        return original(db, failing_id, **batches)
+
+    ingest_queue_module.write_samples = write_samples
+    return original
+
+def gaze_count(factory, session_id):
+    db = factory()
+    try:
+        return db.get(SessionModel, session_id).gaze_count
+    finally:
+        db.close()
+
+def test_failed_commit_stays_in_journal():
+    with tempfile.TemporaryDirectory() as directory:
+        engine, factory = make_db(os.path.join(directory, "journal.db"))
+        journal_dir = os.path.join(directory, "journal")
+
+        original = lock_session(LOCKED_SESSION)
+        try:
+            queue = IngestionQueue(session_factory=factory, flush_interval_ms=10,
+                                   journal=Journal(journal_dir, fsync_policy="never"))
+
+            async def ingest():
+                await queue.start()
+                await queue.submit(GOOD_SESSION, gaze=make_batch(50))
+                await queue.submit(LOCKED_SESSION, gaze=make_batch(30))
+                await queue.flush(GOOD_SESSION)
+                try:
+                    await queue.flush(LOCKED_SESSION)
+                except IngestCommitError:
+                    failed = True
+                else:
+                    failed = False
+                await queue.stop()
+                return failed
+
+            assert asyncio.run(ingest()), "flush() reported success for samples that were never written"
+            assert queue.stats["errors"] >= 1
+            assert gaze_count(factory, GOOD_SESSION) == 50
+            assert gaze_count(factory, LOCKED_SESSION) == 0
+
+            # The failed batch is still in the journal
+            records = Journal(journal_dir).replay()
+            assert [session_id for _, session_id, _, _ in records] == [LOCKED_SESSION]
+
+            # Replaying while the session is still locked keeps it there
+            restarted = IngestionQueue(session_factory=factory, journal=Journal(journal_dir, fsync_policy="never"))
+            assert restarted.recover() == 0
+            assert [session_id for _, session_id, _, _ in Journal(journal_dir).replay()] == [LOCKED_SESSION]
+        finally:
+            ingest_queue_module.write_samples = original
+
+        # Once the database accepts it, a restart writes it and checkpoints it away
+        restarted = IngestionQueue(session_factory=factory, journal=Journal(journal_dir, fsync_policy="never"))
+        assert restarted.recover() == 30
+        assert gaze_count(factory, LOCKED_SESSION) == 30
+        assert Journal(journal_dir).replay() == []
+        engine.dispose()
+
+if __name__ == "__main__":
+    test_failed_commit_stays_in_journal()
+    print("Ingestion journal OK")
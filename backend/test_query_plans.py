@@ -0,0 +1,90 @@
+"""
+Query-plan check for the per-sample tables
+Builds a database the way older versions created it (no composite indexes), runs the
+schema upgrade, and asserts SQLite answers the hot session queries from the
+(session_id, timestamp) indexes instead of scanning the tables.
+Run this script directly: python test_query_plans.py (pytest also picks it up)
+"""
+import os
+import tempfile
+from datetime import datetime
+from sqlalchemy import create_engine, select, func, text, or_
+
+from app.database import Base
+from app.models import GazeData, CursorData, SampleChunk
+from app.migrations import upgrade_schema, get_schema_version, SCHEMA_VERSION
+
+INDEXES = ["ix_gaze_data_session_timestamp", "ix_cursor_data_session_timestamp",
+           "ix_sample_chunks_session_kind_start"]
+
+def make_legacy_db(path):
+    """Create all tables, then drop the composite indexes to mimic a pre-upgrade heatgaze.db"""
+    engine = create_engine(f"sqlite:///{path}")
+    Base.metadata.create_all(bind=engine)
+    with engine.begin() as connection:
+        for name in INDEXES:
+            connection.execute(text(f"DROP INDEX IF EXISTS {name}"))
+    return engine
+
+def hot_queries(model):
+    """The statements the session, pagination and heatmap routes issue for one sample table"""
+    return {
+        "count": select(func.count()).select_from(model).where(model.session_id == 1),
+        "page": select(model.id, model.timestamp, model.x, model.y)
+            .where(model.session_id == 1).order_by(model.timestamp).offset(100).limit(1000),
+        "latest": select(model.timestamp, model.x, model.y)
+            .where(model.session_id == 1).order_by(model.timestamp.desc()).limit(10000),
+        # One keyset block of iter_samples (exports, frames, rebuilds)
+        "block": select(model.id, model.timestamp, model.x, model.y)
+            .where(model.session_id == 1, model.timestamp >= datetime(2024, 1, 1))
+            .where(or_(model.timestamp > datetime(2024, 1, 1), model.id > 100))
+            .order_by(model.timestamp, model.id).limit(5000),
+    }
+
+def query_plan(connection, statement):
+    compiled = statement.compile(connection, compile_kwargs={"literal_binds": True})
+    rows = connection.execute(text(f"EXPLAIN QUERY PLAN {compiled}")).all()
+    return " | ".join(row[-1] for row in rows)
+
+def check_plans(engine):
+    """Returns a list of (table, query, plan) for every query that doesn't use its index"""
+    failures = []
+    with engine.connect() as connection:
+        for model in (GazeData, CursorData):
+            index = f"ix_{model.__tablename__}_session_timestamp"
+            for name, statement in hot_queries(model).items():
+                plan = query_plan(connection, statement)
+                print(f"{model.__tablename__:>12} {name:>6}: {plan}")
+                if index not in plan or "TEMP B-TREE" in plan:
+                    failures.append((model.__tablename__, name, plan))
+
+        chunks = select(SampleChunk.data, SampleChunk.count).where(
+            SampleChunk.session_id == 1, SampleChunk.kind == "gaze"
+        ).order_by(SampleChunk.start_time)
+        plan = query_plan(connection, chunks)
+        print(f"{'sample_chunks':>12} {'load':>6}: {plan}")
+        if "ix_sample_chunks_session_kind_start" not in plan or "TEMP B-TREE" in plan:
+            failures.append(("sample_chunks", "load", plan))
+    return failures
+
+def test_upgrade_adds_indexes_used_by_hot_queries():
+    with tempfile.TemporaryDirectory() as directory:
+        engine = make_legacy_db(os.path.join(directory, "legacy.db"))
+
+        # Before the upgrade every hot query scans
+        assert check_plans(engine), "legacy database unexpectedly has the composite indexes"
+
+        assert upgrade_schema(engine) == list(range(1, SCHEMA_VERSION + 1))
+        with engine.connect() as connection:
+            assert get_schema_version(connection) == SCHEMA_VERSION
+
+        failures = check_plans(engine)
+        assert not failures, f"queries not using the composite indexes: {failures}"
+
+        # Running it again is a no-op
+        assert upgrade_schema(engine) == []
+        engine.dispose()
+
+if __name__ == "__main__":
+    test_upgrade_adds_indexes_used_by_hot_queries()
+    print("Query plans OK")
@@ -0,0 +1,63 @@
+"""
+Disk tier checks for the heatmap result cache
+Fills the disk tier past its limit and asserts pruning drops the least recently used files down
+to the low-water mark (so the next writes don't each rescan the directory), and that the async
+interface reads back through the disk tier after the memory tier is emptied.
+Run this script directly: python test_result_cache.py (pytest also picks it up)
+"""
+import os
+import asyncio
+import tempfile
+
+from app.cache import ResultCache, CACHE_DISK_LOW_WATER, CACHE_SUFFIX
+
+ENTRY_BYTES = 1000
+
+def disk_files(directory):
+    return sorted(name for name in os.listdir(directory) if name.endswith(CACHE_SUFFIX))
+
+def test_prune_to_low_water():
+    with tempfile.TemporaryDirectory() as directory:
+        cache = ResultCache(max_bytes=100 * ENTRY_BYTES, directory=directory,
+                            disk_max_bytes=10 * ENTRY_BYTES, enabled=True)
+        for i in range(10):
+            cache.put_bytes(f"k{i}", bytes(ENTRY_BYTES))
+            os.utime(os.path.join(directory, f"k{i}{CACHE_SUFFIX}"), (i, i))
+        assert cache.stats()["disk_evictions"] == 0
+
+        cache.put_bytes("k10", bytes(ENTRY_BYTES))
+        kept = int(10 * CACHE_DISK_LOW_WATER)
+        assert len(disk_files(directory)) == kept
+        assert f"k0{CACHE_SUFFIX}" not in disk_files(directory)
+        assert f"k10{CACHE_SUFFIX}" in disk_files(directory)
+        stats = cache.stats()
+        assert stats["disk_bytes"] == kept * ENTRY_BYTES
+        assert stats["disk_evictions"] == 11 - kept
+
+        # The headroom absorbs the next write without another prune
+        cache.put_bytes("k11", bytes(ENTRY_BYTES))
+        assert cache.stats()["disk_evictions"] == 11 - kept
+
+def test_async_interface_reads_through_disk():
+    with tempfile.TemporaryDirectory() as directory:
+        cache = ResultCache(max_bytes=100 * ENTRY_BYTES, directory=directory,
+                            disk_max_bytes=100 * ENTRY_BYTES, enabled=True)
+
+        async def roundtrip():
+            await cache.store("json", {"points": 3})
+            await cache.store_bytes("bytes", b"png")
+            with cache._lock:
+                cache._entries.clear()
+                cache._bytes = 0
+            return await cache.fetch("json"), await cache.fetch_bytes("bytes"), await cache.fetch_bytes("missing")
+
+        assert asyncio.run(roundtrip()) == ({"points": 3}, b"png", None)
+        stats = cache.stats()
+        assert (stats["disk_hits"], stats["misses"]) == (2, 1)
+        assert cache.get_bytes("bytes") == b"png"
+        assert cache.stats()["hits"] == 1
+
+if __name__ == "__main__":
+    test_prune_to_low_water()
+    test_async_interface_reads_through_disk()
+    print("Result cache OK")
@@ -0,0 +1,159 @@
+"""
+Checks for the blockwise sample readers behind exports and animation frames
+A reader paused between blocks (a slow download, a paused animation) must not hold a SQLite
+read lock that makes concurrent ingestion commits fail with "database is locked".
+Samples stored partly as rows and partly as chunks must come back merged in timestamp order,
+so animation frames count every sample in the frame its timestamp belongs to. Late batches on
+the chunk engine must not rewrite older chunks, and every reader must merge the overlapping
+chunks they produce.
+Run this script directly: python test_sample_reads.py (pytest also picks it up)
+"""
+import os
+import tempfile
+import numpy as np
+from sqlalchemy import create_engine, select
+from sqlalchemy.orm import sessionmaker
+
+import app.storage as storage
+from app.frames import iter_frame_counts
+from app.database import Base
+from app.models import User, Session as SessionModel, SampleChunk
+from app.ingest import SampleBatch
+
+START = 1.7e12
+
+def make_db(path):
+    # A short busy timeout so a held lock fails the test quickly instead of waiting
+    engine = create_engine(f"sqlite:///{path}", connect_args={"check_same_thread": False, "timeout": 0.5})
+    Base.metadata.create_all(bind=engine)
+    factory = sessionmaker(autocommit=False, autoflush=False, bind=engine)
+    db = factory()
+    db.add(User(id=1, username="reads", email="reads@example.com", hashed_password="x"))
+    db.add(SessionModel(id=1, name="s", user_id=1))
+    db.commit()
+    db.close()
+    return engine, factory
+
+def make_batch(timestamps):
+    timestamps = np.asarray(timestamps, dtype=np.float64)
+    count = len(timestamps)
+    return SampleBatch(timestamps, np.full(count, 100.0), np.full(count, 200.0), np.ones(count), np.ones(count))
+
+def write(factory, batch, engine="rows"):
+    previous = storage.STORAGE_ENGINE
+    storage.STORAGE_ENGINE = engine
+    db = factory()
+    try:
+        storage.write_samples(db, 1, gaze=batch)
+        db.commit()
+    finally:
+        db.close()
+        storage.STORAGE_ENGINE = previous
+
+def check_paused_reader(engine_name):
+    with tempfile.TemporaryDirectory() as directory:
+        engine, factory = make_db(os.path.join(directory, "reads.db"))
+        write(factory, make_batch(START + np.arange(10000)), engine_name)
+
+        reader = factory()
+        blocks = storage.iter_samples(reader, 1, "gaze", block_rows=1000)
+        first = next(blocks)
+
+        # The reader is paused mid-stream; a writer must still be able to commit
+        write(factory, make_batch(START + 20000 + np.arange(10)), engine_name)
+
+        total = len(first) + sum(len(block) for block in blocks)
+        assert total == 10010
+        reader.close()
+        engine.dispose()
+
+def test_paused_reader_does_not_block_writers():
+    for engine_name in ("rows", "chunks"):
+        check_paused_reader(engine_name)
+
+def test_rows_and_chunks_merge_by_timestamp():
+    with tempfile.TemporaryDirectory() as directory:
+        engine, factory = make_db(os.path.join(directory, "reads.db"))
+        rng = np.random.default_rng(7)
+        # Interleaved in time: even milliseconds as rows, odd ones as chunks, then late ones of both
+        write(factory, make_batch(START + np.arange(0, 6000, 2)), "rows")
+        write(factory, make_batch(START + np.arange(1, 6000, 2)), "chunks")
+        late = np.sort(rng.uniform(0, 6000, 500))
+        write(factory, make_batch(START + late[::2]), "rows")
+        write(factory, make_batch(START + late[1::2]), "chunks")
+        expected = np.sort(np.concatenate([np.arange(6000, dtype=np.float64), late]))
+
+        db = factory()
+        timestamps = np.concatenate([b.timestamps for b in storage.iter_samples(db, 1, "gaze", block_rows=700)])
+        assert len(timestamps) == len(expected)
+        assert np.all(np.diff(timestamps) >= 0), "samples not in timestamp order"
+        assert np.allclose(timestamps - START, expected, atol=1e-3)
+
+        # Cumulative and sliding frames count each sample in its own step
+        step = 500.0
+        ends = START + step * np.arange(1, 13)
+        cumulative = [points for _, _, _, points in iter_frame_counts(
+            db, 1, "gaze", START, START + 5999, step, 1920, 1080, scale=8)]
+        assert cumulative == [int(np.searchsorted(timestamps, end, side="left")) for end in ends]
+        sliding = [points for _, _, _, points in iter_frame_counts(
+            db, 1, "gaze", START, START + 5999, step, 1920, 1080, scale=8, mode="sliding", window_ms=2 * step)]
+        assert sliding == [int(np.searchsorted(timestamps, end, side="left") -
+                               np.searchsorted(timestamps, end - 2 * step, side="left")) for end in ends]
+        db.close()
+        engine.dispose()
+
+def chunk_rows(factory):
+    db = factory()
+    try:
+        return {row.id: row.data for row in db.execute(select(SampleChunk.id, SampleChunk.data))}
+    finally:
+        db.close()
+
+def test_late_samples_in_overlapping_chunks():
+    with tempfile.TemporaryDirectory() as directory:
+        engine, factory = make_db(os.path.join(directory, "reads.db"))
+        rng = np.random.default_rng(6)
+        stored = []
+        for start in range(0, 30000, 3000):
+            batch = START + start + np.arange(0, 3000, 1.5)
+            write(factory, make_batch(batch), "chunks")
+            stored.append(batch)
+
+        # A stale sample older than the whole session, and a late batch spread over all of it
+        before = chunk_rows(factory)
+        late = [np.array([START - 5000.0]), START + np.sort(rng.uniform(0, 30000, 300))]
+        for batch in late:
+            write(factory, make_batch(batch), "chunks")
+            stored.append(batch)
+        after = chunk_rows(factory)
+        assert all(after[chunk_id] == data for chunk_id, data in before.items()), "a late batch rewrote older chunks"
+        assert len(after) == len(before) + 2
+
+        expected = np.sort(np.concatenate(stored))
+        db = factory()
+        timestamps = np.concatenate([b.timestamps for b in storage.iter_samples(db, 1, "gaze")])
+        assert np.allclose(timestamps, expected, rtol=0, atol=1e-3)
+
+        # Keyset and offset pages both walk the merged order
+        keyset, token = [], None
+        while True:
+            page, token = storage.read_page(db, 1, "gaze", limit=997, after=token)
+            keyset += [p["timestamp"].timestamp() * 1000 for p in page]
+            if token is None:
+                break
+        assert np.allclose(keyset, expected, rtol=0, atol=1e-3)
+        offset_page, _ = storage.read_page(db, 1, "gaze", offset=4000, limit=500)
+        assert np.allclose([p["timestamp"].timestamp() * 1000 for p in offset_page], expected[4000:4500], rtol=0, atol=1e-3)
+
+        first = storage.load_samples(db, 1, "gaze", limit=50)
+        last = storage.load_samples(db, 1, "gaze", latest=True, limit=50)
+        assert np.allclose(first.timestamps, expected[:50], rtol=0, atol=1e-3)
+        assert np.allclose(last.timestamps, expected[-50:], rtol=0, atol=1e-3)
+        db.close()
+        engine.dispose()
+
+if __name__ == "__main__":
+    test_paused_reader_does_not_block_writers()
+    test_rows_and_chunks_merge_by_timestamp()
+    test_late_samples_in_overlapping_chunks()
+    print("Sample reads OK")
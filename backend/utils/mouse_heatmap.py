@@ -9,17 +9,61 @@ import plotly.graph_objects as go
 from plotly.graph_objects import Figure
 import base64
 import io
+import json
 from datetime import datetime
 from typing import List, Dict, Tuple, Any, Optional
 
+try:
+    from .raster_plot import Chart, colormap_rgb
+except ImportError:
+    # Loaded as a top-level module (see the import fallbacks in routes/cursor_data.py)
+    from raster_plot import Chart, colormap_rgb
+
+# "fast" draws PNGs in-process (utils/raster_plot.py); "plotly" returns the interactive
+# Plotly figure as JSON. Plotly's own static export (Kaleido) is not used.
+RENDERERS = ("fast", "plotly")
+DEFAULT_RENDERER = "fast"
+
+# Bump when the fast renderer's output changes, so cached images and their ETags are replaced
+FAST_RENDER_VERSION = 1
+
+
+def _figure_json(fig: Figure) -> Dict[str, Any]:
+    """A Plotly figure as a JSON-ready dict (for Plotly.react on the client)"""
+    return json.loads(fig.to_json())
+
+
+def _timestamps_seconds(df: pd.DataFrame) -> np.ndarray:
+    """Sample times in seconds: numeric timestamps are milliseconds, others are parsed as dates"""
+    timestamps = df['timestamp']
+    if pd.api.types.is_numeric_dtype(timestamps):
+        return timestamps.to_numpy(dtype=np.float64) / 1000.0
+    timestamps = pd.to_datetime(timestamps)
+    return (timestamps - timestamps.min()).dt.total_seconds().to_numpy()
+
+
+def _bin_counts(x: np.ndarray, y: np.ndarray, width: int, height: int, bin_size: int) -> np.ndarray:
+    """
+    Point counts in bin_size squares starting at 0, indexed [x bin, y bin]. Bins cover
+    range(0, width, bin_size) and range(0, height, bin_size); the last ones may reach past the edge.
+    """
+    cols = len(range(0, width, bin_size))
+    rows = len(range(0, height, bin_size))
+    bx = np.floor(x / bin_size).astype(np.int64)
+    by = np.floor(y / bin_size).astype(np.int64)
+    inside = (bx >= 0) & (bx < cols) & (by >= 0) & (by < rows)
+    counts = np.bincount(bx[inside] * rows + by[inside], minlength=cols * rows)
+    return counts.reshape(cols, rows)
+
 
 def create_mouse_heatmap(
     data: List[Dict[str, Any]], 
     width: int = 1920, 
     height: int = 1080, 
     bin_size: int = 50,
-    colorscale: str = 'Inferno'
-) -> Tuple[str, Dict[str, Any]]:
+    colorscale: str = 'Inferno',
+    renderer: str = DEFAULT_RENDERER
+) -> Tuple[Any, Dict[str, Any]]:
     """
     Create a density heatmap of mouse cursor positions
     
@@ -29,9 +73,10 @@ def create_mouse_heatmap(
         height: Height of the screen in pixels
         bin_size: Size of bins for heatmap
         colorscale: Plotly colorscale name
+        renderer: "fast" for a PNG, "plotly" for the interactive figure JSON
         
     Returns:
-        Tuple containing (base64_encoded_image, stats_dict)
+        Tuple containing (base64_encoded_image or figure dict, stats_dict)
     """
     if not data or len(data) < 5:
         return None, {"error": "Not enough data points for heatmap"}
@@ -44,57 +89,62 @@ def create_mouse_heatmap(
         if 'x' not in df.columns or 'y' not in df.columns:
             return None, {"error": "Missing required columns x or y"}
         
-        # Create 2D histogram
-        fig = px.density_heatmap(
-            df, 
-            x='x', 
-            y='y',
-            nbinsx=width//bin_size,
-            nbinsy=height//bin_size,
-            color_continuous_scale=colorscale,
-            range_x=[0, width],
-            range_y=[0, height],
-            title="Mouse Movement Density Heatmap"
-        )
-        
-        # Invert y-axis to match screen coordinates
-        fig.update_yaxes(autorange="reversed")
-        
-        # Add size reference
-        fig.update_layout(
-            width=900,
-            height=600,
-            xaxis_title="X Position",
-            yaxis_title="Y Position",
-            coloraxis_colorbar=dict(
-                title="Density"
+        bin_size = max(1, int(bin_size))
+        x = df['x'].to_numpy(dtype=np.float64)
+        y = df['y'].to_numpy(dtype=np.float64)
+        counts = _bin_counts(x, y, width, height, bin_size)
+
+        if renderer == "plotly":
+            # Create 2D histogram
+            fig = px.density_heatmap(
+                df, 
+                x='x', 
+                y='y',
+                nbinsx=width//bin_size,
+                nbinsy=height//bin_size,
+                color_continuous_scale=colorscale,
+                range_x=[0, width],
+                range_y=[0, height],
+                title="Mouse Movement Density Heatmap"
             )
-        )
-        
-        # Convert to image
-        img_bytes = fig.to_image(format="png", scale=2)
-        img_base64 = base64.b64encode(img_bytes).decode('utf-8')
+            
+            # Invert y-axis to match screen coordinates
+            fig.update_yaxes(autorange="reversed")
+            
+            # Add size reference
+            fig.update_layout(
+                width=900,
+                height=600,
+                xaxis_title="X Position",
+                yaxis_title="Y Position",
+                coloraxis_colorbar=dict(
+                    title="Density"
+                )
+            )
+            image = _figure_json(fig)
+        else:
+            chart = Chart((0, width), (0, height), title="Mouse Movement Density Heatmap",
+                          x_title="X Position", y_title="Y Position")
+            colors = colormap_rgb(colorscale)
+            peak = float(counts.max())
+            chart.heatmap(counts.T, (0, counts.shape[0] * bin_size, 0, counts.shape[1] * bin_size),
+                          colors, 0, peak)
+            chart.colorbar(colors, 0, peak, title="Density")
+            image = base64.b64encode(chart.png()).decode('utf-8')
         
         # Calculate stats
-        counts = []
-        for x in range(0, width, bin_size):
-            for y in range(0, height, bin_size):
-                count = len(df[(df['x'] >= x) & (df['x'] < x+bin_size) & 
-                             (df['y'] >= y) & (df['y'] < y+bin_size)])
-                if count > 0:
-                    counts.append((x, y, count))
-        
-        df_counts = pd.DataFrame(counts, columns=['x', 'y', 'count'])
-        
-        if len(df_counts) > 0:
-            max_count_row = df_counts.loc[df_counts['count'].idxmax()]
-            max_location = {'x': max_count_row['x'] + bin_size/2, 'y': max_count_row['y'] + bin_size/2}
-            max_value = max_count_row['count']
+        active = counts > 0
+        total_bins = (width // bin_size) * (height // bin_size)
+        
+        if active.any():
+            # First bin with the highest count, scanning x then y
+            max_x, max_y = np.unravel_index(int(np.argmax(counts)), counts.shape)
+            max_location = {'x': max_x * bin_size + bin_size/2, 'y': max_y * bin_size + bin_size/2}
+            max_value = counts[max_x, max_y]
             
             # Calculate coverage
-            total_bins = (width // bin_size) * (height // bin_size)
-            active_bins = len(df_counts)
-            percentage = (active_bins / total_bins) * 100
+            active_bins = int(active.sum())
+            percentage = (active_bins / total_bins) * 100 if total_bins else 0.0
             
             stats = {
                 "count": len(df),
@@ -116,13 +166,13 @@ def create_mouse_heatmap(
                     "max_value": 0
                 },
                 "coverage": {
-                    "total_bins": (width // bin_size) * (height // bin_size),
+                    "total_bins": total_bins,
                     "active_bins": 0,
                     "percentage": 0.0
                 }
             }
         
-        return img_base64, stats
+        return image, stats
         
     except Exception as e:
         import traceback
@@ -137,8 +187,9 @@ def create_time_based_heatmap(
     width: int = 1920,
     height: int = 1080,
     bin_size: int = 50,
-    colorscale: str = 'Viridis'
-) -> Tuple[str, Dict[str, Any]]:
+    colorscale: str = 'Viridis',
+    renderer: str = DEFAULT_RENDERER
+) -> Tuple[Any, Dict[str, Any]]:
     """
     Create a heatmap showing dwell time at different cursor positions
     
@@ -148,9 +199,10 @@ def create_time_based_heatmap(
         height: Height of the screen in pixels
         bin_size: Size of bins for heatmap
         colorscale: Plotly colorscale name
+        renderer: "fast" for a PNG, "plotly" for the interactive figure JSON
         
     Returns:
-        Tuple containing (base64_encoded_image, stats_dict)
+        Tuple containing (base64_encoded_image or figure dict, stats_dict)
     """
     if not data or len(data) < 5:
         return None, {"error": "Not enough data points for heatmap"}
@@ -163,23 +215,18 @@ def create_time_based_heatmap(
         if 'x' not in df.columns or 'y' not in df.columns or 'timestamp' not in df.columns:
             return None, {"error": "Missing required columns x, y, or timestamp"}
         
-        # Ensure timestamp is in datetime format
-        if isinstance(df['timestamp'][0], str):
-            df['timestamp'] = pd.to_datetime(df['timestamp'])
-        
-        # Sort by timestamp
-        df = df.sort_values('timestamp')
+        # Timestamps in seconds, in order
+        bin_size = max(1, int(bin_size))
+        df['seconds'] = _timestamps_seconds(df)
+        df = df.sort_values('seconds')
         
         # Calculate time spent in each bin
         df['bin_x'] = (df['x'] // bin_size) * bin_size
         df['bin_y'] = (df['y'] // bin_size) * bin_size
-        df['next_timestamp'] = df['timestamp'].shift(-1)
         
-        # Handle the last row
-        df.loc[df.index[-1], 'next_timestamp'] = df.loc[df.index[-1], 'timestamp']
-        
-        # Calculate dwell time in seconds
-        df['dwell_time'] = (df['next_timestamp'] - df['timestamp']).dt.total_seconds()
+        # Dwell time in seconds until the next sample (0 for the last one)
+        seconds = df['seconds'].to_numpy()
+        df['dwell_time'] = np.append(np.diff(seconds), 0.0)
         
         # Filter out too large values (e.g., when there's a big gap)
         df = df[df['dwell_time'] < 10]  # Max 10 seconds dwell
@@ -187,30 +234,47 @@ def create_time_based_heatmap(
         # Group by bins and sum dwell time
         bin_times = df.groupby(['bin_x', 'bin_y'])['dwell_time'].sum().reset_index()
         
-        # Create figure
-        fig = go.Figure()
-        
-        # Add heatmap
-        fig.add_trace(go.Heatmap(
-            x=bin_times['bin_x'],
-            y=bin_times['bin_y'],
-            z=bin_times['dwell_time'],
-            colorscale=colorscale,
-            colorbar=dict(title="Dwell Time (s)"),
-        ))
-        
-        # Set layout
-        fig.update_layout(
-            title="Cursor Dwell Time Heatmap",
-            width=900,
-            height=600,
-            xaxis=dict(title="X Position", range=[0, width]),
-            yaxis=dict(title="Y Position", range=[height, 0]),
-        )
-        
-        # Convert to image
-        img_bytes = fig.to_image(format="png", scale=2)
-        img_base64 = base64.b64encode(img_bytes).decode('utf-8')
+        if renderer == "plotly":
+            # Create figure
+            fig = go.Figure()
+            
+            # Add heatmap
+            fig.add_trace(go.Heatmap(
+                x=bin_times['bin_x'],
+                y=bin_times['bin_y'],
+                z=bin_times['dwell_time'],
+                colorscale=colorscale,
+                colorbar=dict(title="Dwell Time (s)"),
+            ))
+            
+            # Set layout
+            fig.update_layout(
+                title="Cursor Dwell Time Heatmap",
+                width=900,
+                height=600,
+                xaxis=dict(title="X Position", range=[0, width]),
+                yaxis=dict(title="Y Position", range=[height, 0]),
+            )
+            image = _figure_json(fig)
+        else:
+            # Bins without samples stay unpainted, like the gaps in Plotly's heatmap
+            cols = (bin_times['bin_x'] // bin_size).astype(np.int64).to_numpy()
+            rows = (bin_times['bin_y'] // bin_size).astype(np.int64).to_numpy()
+            col0, row0 = cols.min(), rows.min()
+            values = np.zeros((rows.max() - row0 + 1, cols.max() - col0 + 1))
+            values[rows - row0, cols - col0] = bin_times['dwell_time'].to_numpy()
+            filled = np.zeros(values.shape, dtype=bool)
+            filled[rows - row0, cols - col0] = True
+            
+            chart = Chart((0, width), (0, height), title="Cursor Dwell Time Heatmap",
+                          x_title="X Position", y_title="Y Position")
+            colors = colormap_rgb(colorscale)
+            low, high = float(values[filled].min()), float(values[filled].max())
+            chart.heatmap(values, (col0 * bin_size, (cols.max() + 1) * bin_size,
+                                   row0 * bin_size, (rows.max() + 1) * bin_size),
+                          colors, low, high, mask=filled)
+            chart.colorbar(colors, low, high, title="Dwell Time (s)")
+            image = base64.b64encode(chart.png()).decode('utf-8')
         
         # Calculate stats
         total_time = df['dwell_time'].sum()
@@ -231,7 +295,7 @@ def create_time_based_heatmap(
             }
         }
         
-        return img_base64, stats
+        return image, stats
         
     except Exception as e:
         import traceback
@@ -247,8 +311,9 @@ def create_trajectory_plot(
     height: int = 1080,
     max_points: int = 1000,
     line_color: str = 'rgb(0, 100, 255)',
-    point_color: str = 'rgba(30, 150, 255, 0.5)'
-) -> Tuple[str, Dict[str, Any]]:
+    point_color: str = 'rgba(30, 150, 255, 0.5)',
+    renderer: str = DEFAULT_RENDERER
+) -> Tuple[Any, Dict[str, Any]]:
     """
     Create a trajectory plot showing the path of cursor movement
     
@@ -259,9 +324,10 @@ def create_trajectory_plot(
         max_points: Maximum number of points to plot
         line_color: Color of the trajectory line
         point_color: Color of the cursor points
+        renderer: "fast" for a PNG, "plotly" for the interactive figure JSON
         
     Returns:
-        Tuple containing (base64_encoded_image, stats_dict)
+        Tuple containing (base64_encoded_image or figure dict, stats_dict)
     """
     if not data or len(data) < 5:
         return None, {"error": "Not enough data points for trajectory plot"}
@@ -274,122 +340,110 @@ def create_trajectory_plot(
         if 'x' not in df.columns or 'y' not in df.columns or 'timestamp' not in df.columns:
             return None, {"error": "Missing required columns x, y, or timestamp"}
         
-        # Ensure timestamp is in datetime format
-        if isinstance(df['timestamp'][0], str):
-            df['timestamp'] = pd.to_datetime(df['timestamp'])
-        
-        # Sort by timestamp
-        df = df.sort_values('timestamp')
+        # Timestamps in seconds, in order
+        df['seconds'] = _timestamps_seconds(df)
+        df = df.sort_values('seconds')
         
         # Sample points if too many
         if len(df) > max_points:
             step = len(df) // max_points
             df = df.iloc[::step].copy()
         
-        # Create figure
-        fig = go.Figure()
+        x = df['x'].to_numpy(dtype=np.float64)
+        y = df['y'].to_numpy(dtype=np.float64)
         
-        # Add trajectory line
-        fig.add_trace(go.Scatter(
-            x=df['x'],
-            y=df['y'],
-            mode='lines',
-            line=dict(color=line_color, width=2),
-            name='Cursor Path'
-        ))
-        
-        # Add points
-        fig.add_trace(go.Scatter(
-            x=df['x'],
-            y=df['y'],
-            mode='markers',
-            marker=dict(color=point_color, size=8),
-            name='Cursor Points'
-        ))
-        
-        # Add arrows to show direction
-        arrow_step = max(len(df) // 20, 1)  # Show ~20 arrows
+        # Arrows to show direction: ~20 of them, skipping short hops
+        arrows = []
+        arrow_step = max(len(df) // 20, 1)
         for i in range(0, len(df) - arrow_step, arrow_step):
-            x1, y1 = df.iloc[i]['x'], df.iloc[i]['y']
-            x2, y2 = df.iloc[i + arrow_step]['x'], df.iloc[i + arrow_step]['y']
-            
-            # Skip if points are too close
-            if abs(x2 - x1) < 5 and abs(y2 - y1) < 5:
-                continue
-                
-            # Calculate arrow properties
-            dx, dy = x2 - x1, y2 - y1
+            x1, y1 = x[i], y[i]
+            dx, dy = x[i + arrow_step] - x1, y[i + arrow_step] - y1
             length = np.sqrt(dx**2 + dy**2)
-            
-            # Skip if too short
-            if length < 20:
+            if (abs(dx) < 5 and abs(dy) < 5) or length < 20:
                 continue
-                
-            # Normalize and scale
+            # Normalize and scale; the arrow points along the path
             dx, dy = dx / length * 10, dy / length * 10
+            arrows.append((x1, y1, x1 + dx * 3, y1 + dy * 3))
+        
+        if renderer == "plotly":
+            # Create figure
+            fig = go.Figure()
             
-            # Add arrow annotation
-            fig.add_annotation(
-                x=x1 + dx * 3,  # Place arrow along the path
-                y=y1 + dy * 3,
-                ax=x1,
-                ay=y1,
-                xref="x",
-                yref="y",
-                axref="x",
-                ayref="y",
-                showarrow=True,
-                arrowhead=2,
-                arrowsize=1,
-                arrowwidth=2,
-                arrowcolor='rgba(255, 0, 0, 0.6)'
+            # Add trajectory line
+            fig.add_trace(go.Scatter(
+                x=df['x'],
+                y=df['y'],
+                mode='lines',
+                line=dict(color=line_color, width=2),
+                name='Cursor Path'
+            ))
+            
+            # Add points
+            fig.add_trace(go.Scatter(
+                x=df['x'],
+                y=df['y'],
+                mode='markers',
+                marker=dict(color=point_color, size=8),
+                name='Cursor Points'
+            ))
+            
+            for x1, y1, x2, y2 in arrows:
+                fig.add_annotation(
+                    x=x2,
+                    y=y2,
+                    ax=x1,
+                    ay=y1,
+                    xref="x",
+                    yref="y",
+                    axref="x",
+                    ayref="y",
+                    showarrow=True,
+                    arrowhead=2,
+                    arrowsize=1,
+                    arrowwidth=2,
+                    arrowcolor='rgba(255, 0, 0, 0.6)'
+                )
+            
+            # Set layout
+            fig.update_layout(
+                title="Cursor Movement Trajectory",
+                width=900,
+                height=600,
+                xaxis=dict(title="X Position", range=[0, width]),
+                yaxis=dict(title="Y Position", range=[height, 0]),
+                showlegend=True
             )
-        
-        # Set layout
-        fig.update_layout(
-            title="Cursor Movement Trajectory",
-            width=900,
-            height=600,
-            xaxis=dict(title="X Position", range=[0, width]),
-            yaxis=dict(title="Y Position", range=[height, 0]),
-            showlegend=True
-        )
-        
-        # Convert to image
-        img_bytes = fig.to_image(format="png", scale=2)
-        img_base64 = base64.b64encode(img_bytes).decode('utf-8')
-        
-        # Calculate stats
-        df['next_x'] = df['x'].shift(-1)
-        df['next_y'] = df['y'].shift(-1)
-        df = df.dropna()
-        
-        # Calculate distances between consecutive points
-        df['distance'] = np.sqrt((df['next_x'] - df['x'])**2 + (df['next_y'] - df['y'])**2)
-        
-        # Calculate time differences
-        df['next_timestamp'] = df['timestamp'].shift(-1)
-        df['time_diff'] = (df['next_timestamp'] - df['timestamp']).dt.total_seconds()
-        
-        # Calculate speed (pixels per second)
-        df['speed'] = df['distance'] / df['time_diff']
+            image = _figure_json(fig)
+        else:
+            chart = Chart((0, width), (0, height), title="Cursor Movement Trajectory",
+                          x_title="X Position", y_title="Y Position")
+            chart.polyline(x, y, line_color, width=2)
+            chart.markers(x, y, point_color, size=8)
+            chart.arrows(arrows, 'rgba(255, 0, 0, 0.6)', width=2)
+            chart.legend([("Cursor Path", "line", line_color), ("Cursor Points", "marker", point_color)])
+            image = base64.b64encode(chart.png()).decode('utf-8')
+        
+        # Calculate stats: distance, time and speed (pixels per second) between consecutive points
+        distance = np.sqrt(np.diff(x)**2 + np.diff(y)**2)
+        time_diff = np.diff(df['seconds'].to_numpy())
+        with np.errstate(divide='ignore', invalid='ignore'):
+            speed = distance / time_diff
         
         # Filter out invalid speeds (too large or infinite)
-        df = df[(df['speed'] < 5000) & (df['speed'] > 0)]
-        
-        total_distance = df['distance'].sum()
-        avg_speed = df['speed'].mean()
+        valid = (speed < 5000) & (speed > 0)
+        total_distance = distance[valid].sum()
+        avg_speed = speed[valid].mean() if valid.any() else 0.0
         
         stats = {
             "count": len(data),
             "trajectory": {
                 "total_distance": float(total_distance),
                 "avg_speed": float(avg_speed),
-                "points_plotted": len(df)
+                "points_plotted": int(valid.sum())
             }
         }
         
-        return img_base64, stats
+        return image, stats
         
     except Exception as e:
         import traceback
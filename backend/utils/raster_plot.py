@@ -0,0 +1,285 @@
+"""
+Minimal in-process chart renderer for the mouse_heatmap views
+Draws binned heatmaps, paths, markers and arrows with axes, ticks, titles, a colorbar and a
+legend straight into a NumPy RGB image with OpenCV, and encodes it with Pillow. It replaces
+Plotly's static image export, which runs a Chromium process through Kaleido for every image.
+"""
+
+import io
+import math
+import numpy as np
+import cv2
+from PIL import Image
+from typing import List, Optional, Sequence, Tuple
+
+# Figure size in layout pixels; images are rendered at FIGURE_SCALE times this (like to_image(scale=2))
+FIGURE_WIDTH = 900
+FIGURE_HEIGHT = 600
+FIGURE_SCALE = 2
+
+# Layout margins in layout pixels
+MARGIN_LEFT = 80
+MARGIN_RIGHT = 130
+MARGIN_TOP = 60
+MARGIN_BOTTOM = 60
+
+# Plotly's default template colors, so both renderers look alike
+PAPER_COLOR = (255, 255, 255)
+PLOT_COLOR = (229, 236, 246)
+GRID_COLOR = (255, 255, 255)
+TEXT_COLOR = (42, 63, 95)
+
+FONT = cv2.FONT_HERSHEY_SIMPLEX
+
+# Colorscale names (case-insensitive, as given to Plotly) and their OpenCV colormaps
+COLORMAPS = {
+    "inferno": cv2.COLORMAP_INFERNO,
+    "viridis": cv2.COLORMAP_VIRIDIS,
+    "plasma": cv2.COLORMAP_PLASMA,
+    "magma": cv2.COLORMAP_MAGMA,
+    "hot": cv2.COLORMAP_HOT,
+    "jet": cv2.COLORMAP_JET,
+    "turbo": cv2.COLORMAP_TURBO,
+}
+
+
+def colormap_rgb(name: str) -> np.ndarray:
+    """256 x 3 RGB lookup table for a colorscale name (unknown names fall back to inferno)"""
+    colormap = COLORMAPS.get(str(name).lower(), cv2.COLORMAP_INFERNO)
+    bgr = cv2.applyColorMap(np.arange(256, dtype=np.uint8).reshape(256, 1), colormap)
+    return np.ascontiguousarray(bgr[:, 0, ::-1])
+
+
+def parse_color(color) -> Tuple[Tuple[int, int, int], float]:
+    """(rgb, alpha) from a CSS rgb()/rgba() string or an (r, g, b[, a]) tuple"""
+    if isinstance(color, str):
+        inside = color[color.index("(") + 1:color.rindex(")")]
+        values = [float(v) for v in inside.split(",")]
+    else:
+        values = [float(v) for v in color]
+    rgb = tuple(int(round(v)) for v in values[:3])
+    alpha = values[3] if len(values) > 3 else 1.0
+    return rgb, alpha
+
+
+def nice_ticks(low: float, high: float, count: int = 6) -> List[float]:
+    """Round tick values between low and high, about count of them"""
+    span = abs(high - low)
+    if span == 0 or not math.isfinite(span):
+        return [low]
+    raw = span / max(1, count)
+    magnitude = 10 ** math.floor(math.log10(raw))
+    step = next(m * magnitude for m in (1, 2, 2.5, 5, 10) if m * magnitude >= raw)
+    start = math.ceil(min(low, high) / step) * step
+    ticks = []
+    value = start
+    while value <= max(low, high) + step * 1e-9:
+        ticks.append(round(value, 10))
+        value += step
+    return ticks
+
+
+def format_tick(value: float) -> str:
+    """Tick label: integers without a decimal point, other values with up to 3 significant digits"""
+    if float(value).is_integer():
+        return str(int(value))
+    return f"{value:.3g}"
+
+
+class Chart:
+    """
+    A figure with one plot area in data coordinates. The y axis runs top to bottom
+    (screen coordinates). Draw data first, then call png() to add the axes and encode.
+    """
+
+    def __init__(self, x_range: Tuple[float, float], y_range: Tuple[float, float], title: str = "",
+                 x_title: str = "", y_title: str = "", width: int = FIGURE_WIDTH,
+                 height: int = FIGURE_HEIGHT, scale: int = FIGURE_SCALE):
+        self.scale = scale
+        self.x_range = x_range
+        self.y_range = y_range
+        self.title = title
+        self.x_title = x_title
+        self.y_title = y_title
+        self.image = np.empty((height * scale, width * scale, 3), dtype=np.uint8)
+        self.image[:] = PAPER_COLOR
+        self.left = MARGIN_LEFT * scale
+        self.top = MARGIN_TOP * scale
+        self.right = (width - MARGIN_RIGHT) * scale
+        self.bottom = (height - MARGIN_BOTTOM) * scale
+        self.plot = self.image[self.top:self.bottom, self.left:self.right]
+        self.plot[:] = PLOT_COLOR
+        self.x_ticks = nice_ticks(*x_range)
+        self.y_ticks = nice_ticks(*y_range)
+        self._draw_grid()
+
+    def px(self, x, y):
+        """Data coordinates to pixel coordinates inside the plot area (floats)"""
+        x0, x1 = self.x_range
+        y0, y1 = self.y_range
+        plot_width = self.right - self.left
+        plot_height = self.bottom - self.top
+        px = (np.asarray(x, dtype=np.float64) - x0) / ((x1 - x0) or 1) * plot_width
+        py = (np.asarray(y, dtype=np.float64) - y0) / ((y1 - y0) or 1) * plot_height
+        return px, py
+
+    def _text_size(self, text, size):
+        font_scale = size * self.scale / 22
+        thickness = max(1, round(self.scale * size / 14))
+        (w, h), baseline = cv2.getTextSize(text, FONT, font_scale, thickness)
+        return w, h, baseline, font_scale, thickness
+
+    def text(self, text, x, y, size=12, anchor="left", color=TEXT_COLOR, target=None):
+        """Draw text with its vertical center at y; anchor is left, center or right of x"""
+        target = self.image if target is None else target
+        w, h, _, font_scale, thickness = self._text_size(text, size)
+        if anchor == "center":
+            x -= w // 2
+        elif anchor == "right":
+            x -= w
+        cv2.putText(target, text, (int(x), int(y + h // 2)), FONT, font_scale, color, thickness, cv2.LINE_AA)
+
+    def vertical_text(self, text, x, y, size=12, color=TEXT_COLOR):
+        """Draw text rotated 90 degrees counter-clockwise, centered on (x, y)"""
+        w, h, baseline, _, _ = self._text_size(text, size)
+        pad = 2 * self.scale
+        strip = np.empty((h + baseline + 2 * pad, w + 2 * pad, 3), dtype=np.uint8)
+        strip[:] = PAPER_COLOR
+        self.text(text, pad, pad + h // 2, size, color=color, target=strip)
+        rotated = np.ascontiguousarray(np.rot90(strip))
+        top = int(y - rotated.shape[0] // 2)
+        left = int(x - rotated.shape[1] // 2)
+        self.image[top:top + rotated.shape[0], left:left + rotated.shape[1]] = rotated
+
+    def _draw_grid(self):
+        line = max(1, self.scale)
+        xs, _ = self.px(self.x_ticks, [])
+        _, ys = self.px([], self.y_ticks)
+        for x in xs:
+            cv2.line(self.plot, (int(round(x)), 0), (int(round(x)), self.plot.shape[0]), GRID_COLOR, line)
+        for y in ys:
+            cv2.line(self.plot, (0, int(round(y))), (self.plot.shape[1], int(round(y))), GRID_COLOR, line)
+
+    def heatmap(self, values: np.ndarray, extent: Tuple[float, float, float, float], colors: np.ndarray,
+                low: float, high: float, mask: Optional[np.ndarray] = None):
+        """
+        Paint a grid of values (rows along y) covering extent = (x0, x1, y0, y1) in data
+        coordinates, colored with a 256-entry RGB table between low and high. Cells where
+        mask is False are left unpainted.
+        """
+        rows, cols = values.shape
+        x0, x1, y0, y1 = extent
+        plot_height, plot_width = self.plot.shape[:2]
+        # Data coordinate of each pixel center, then the cell it falls into
+        data_x = self.x_range[0] + (np.arange(plot_width) + 0.5) / plot_width * (self.x_range[1] - self.x_range[0])
+        data_y = self.y_range[0] + (np.arange(plot_height) + 0.5) / plot_height * (self.y_range[1] - self.y_range[0])
+        col = np.floor((data_x - x0) / (x1 - x0) * cols).astype(np.int64)
+        row = np.floor((data_y - y0) / (y1 - y0) * rows).astype(np.int64)
+        col_ok = (col >= 0) & (col < cols)
+        row_ok = (row >= 0) & (row < rows)
+        if not col_ok.any() or not row_ok.any():
+            return
+
+        span = (high - low) or 1
+        indices = np.clip((values - low) / span * 255, 0, 255).astype(np.uint8)
+        cells = indices[np.ix_(row[row_ok], col[col_ok])]
+        region = self.plot[np.ix_(row_ok, col_ok)]
+        painted = colors[cells]
+        if mask is not None:
+            keep = mask[np.ix_(row[row_ok], col[col_ok])]
+            painted = np.where(keep[..., None], painted, region)
+        self.plot[np.ix_(row_ok, col_ok)] = painted
+
+    def polyline(self, x, y, color, width=2):
+        """Connect the points in order"""
+        rgb, alpha = parse_color(color)
+        px, py = self.px(x, y)
+        points = np.stack([px, py], axis=1).round().astype(np.int32).reshape(-1, 1, 2)
+        self._blend(alpha, lambda layer: cv2.polylines(layer, [points], False, rgb, width * self.scale, cv2.LINE_AA))
+
+    def markers(self, x, y, color, size=8):
+        """Filled circles of diameter size (layout pixels) at the points"""
+        rgb, alpha = parse_color(color)
+        px, py = self.px(x, y)
+        radius = max(1, size * self.scale // 2)
+
+        def draw(layer):
+            for cx, cy in zip(px.round().astype(int), py.round().astype(int)):
+                cv2.circle(layer, (cx, cy), radius, rgb, -1, cv2.LINE_AA)
+        self._blend(alpha, draw)
+
+    def arrows(self, segments: Sequence[Tuple[float, float, float, float]], color, width=2):
+        """Arrows from (x1, y1) to (x2, y2) for each segment, in data coordinates"""
+        rgb, alpha = parse_color(color)
+
+        def draw(layer):
+            for x1, y1, x2, y2 in segments:
+                (ax, bx), (ay, by) = self.px([x1, x2], [y1, y2])
+                length = math.hypot(bx - ax, by - ay) or 1
+                cv2.arrowedLine(layer, (int(ax), int(ay)), (int(bx), int(by)), rgb, width * self.scale,
+                                cv2.LINE_AA, tipLength=min(0.5, 10 * self.scale / length))
+        self._blend(alpha, draw)
+
+    def _blend(self, alpha, draw):
+        """Draw onto the plot area, blended with opacity alpha (overlaps don't stack)"""
+        if alpha >= 1:
+            draw(self.plot)
+            return
+        layer = self.plot.copy()
+        draw(layer)
+        cv2.addWeighted(layer, alpha, self.plot, 1 - alpha, 0, dst=self.plot)
+
+    def colorbar(self, colors: np.ndarray, low: float, high: float, title: str = ""):
+        """Vertical color scale in the right margin, low at the bottom"""
+        s = self.scale
+        left = self.right + 20 * s
+        width = 20 * s
+        height = self.bottom - self.top
+        ramp = colors[np.linspace(255, 0, height).round().astype(np.int64)]
+        self.image[self.top:self.bottom, left:left + width] = ramp[:, None, :]
+        for value in nice_ticks(low, high, 5):
+            if not low <= value <= high:
+                continue
+            y = self.bottom - (value - low) / ((high - low) or 1) * height
+            cv2.line(self.image, (left + width, int(y)), (left + width + 4 * s, int(y)), TEXT_COLOR, max(1, s // 2))
+            self.text(format_tick(value), left + width + 7 * s, y, size=11)
+        if title:
+            self.text(title, left, self.top - 14 * s, size=11)
+
+    def legend(self, entries: Sequence[Tuple[str, str, str]]):
+        """Legend in the right margin: (label, kind, color) with kind "line" or "marker" """
+        s = self.scale
+        x = self.right + 8 * s
+        y = self.top + 10 * s
+        for label, kind, color in entries:
+            rgb, alpha = parse_color(color)
+            swatch = self.image.copy()
+            if kind == "line":
+                cv2.line(swatch, (x, y), (x + 24 * s, y), rgb, 2 * s, cv2.LINE_AA)
+            else:
+                cv2.circle(swatch, (x + 12 * s, y), 4 * s, rgb, -1, cv2.LINE_AA)
+            cv2.addWeighted(swatch, alpha, self.image, 1 - alpha, 0, dst=self.image)
+            self.text(label, x + 30 * s, y, size=10)
+            y += 20 * s
+
+    def _draw_axes(self):
+        s = self.scale
+        xs, _ = self.px(self.x_ticks, [])
+        _, ys = self.px([], self.y_ticks)
+        for value, x in zip(self.x_ticks, xs):
+            self.text(format_tick(value), self.left + x, self.bottom + 12 * s, size=11, anchor="center")
+        for value, y in zip(self.y_ticks, ys):
+            self.text(format_tick(value), self.left - 6 * s, self.top + y, size=11, anchor="right")
+        if self.x_title:
+            self.text(self.x_title, (self.left + self.right) // 2, self.bottom + 36 * s, size=13, anchor="center")
+        if self.y_title:
+            self.vertical_text(self.y_title, self.left - 58 * s, (self.top + self.bottom) // 2, size=13)
+        if self.title:
+            self.text(self.title, self.left, self.top // 2, size=16)
+
+    def png(self) -> bytes:
+        """Finish the figure (axes, labels, title) and encode it as PNG"""
+        self._draw_axes()
+        buf = io.BytesIO()
+        Image.fromarray(self.image).save(buf, format="PNG", compress_level=3)
+        return buf.getvalue()
@@ -1,6 +1,8 @@
 import React, { useState } from 'react';
 import { useNavigate } from 'react-router-dom';
 import { testCorrelationMetrics } from '../utils/debug';
+import { HEATMAP_PALETTES } from '../utils/heatmapGrid';
+import HeatmapCanvas from './HeatmapCanvas';
 
 /**
  * A debug component for testing heatmap metrics
@@ -10,6 +12,8 @@ const DebugHeatmap = () => {
   const [results, setResults] = useState(null);
   const [loading, setLoading] = useState(false);
   const [error, setError] = useState(null);
+  const [gridSessionId, setGridSessionId] = useState(null);
+  const [palette, setPalette] = useState('heat');
   const navigate = useNavigate();
   
   const handleSubmit = async (e) => {
@@ -23,6 +27,7 @@ const DebugHeatmap = () => {
     setLoading(true);
     setError(null);
     setResults(null);
+    setGridSessionId(sessionId.trim());
     
     try {
       const metrics = await testCorrelationMetrics(sessionId);
@@ -156,6 +161,32 @@ const DebugHeatmap = () => {
         </div>
       )}
       
+      {gridSessionId && (
+        <div style={{ marginTop: '20px' }}>
+          <h2>Density Grids</h2>
+          <p style={{ color: '#666', fontSize: '0.9rem' }}>
+            Raw density grids colorized in the browser; switching the palette does not contact the server.
+          </p>
+          <label htmlFor="palette" style={{ marginRight: '8px' }}>Palette:</label>
+          <select id="palette" value={palette} onChange={(e) => setPalette(e.target.value)} style={{ padding: '4px' }}>
+            {Object.keys(HEATMAP_PALETTES).map((name) => (
+              <option key={name} value={name}>{name}</option>
+            ))}
+          </select>
+          {['gaze', 'cursor'].map((type) => (
+            <div key={type} style={{ marginTop: '10px' }}>
+              <h3 style={{ marginBottom: '5px' }}>{type}</h3>
+              <HeatmapCanvas
+                sessionId={gridSessionId}
+                type={type}
+                palette={palette}
+                style={{ border: '1px solid #e0e0e0', backgroundColor: '#fff' }}
+              />
+            </div>
+          ))}
+        </div>
+      )}
+      
       <div style={{ marginTop: '30px', fontSize: '0.9rem', color: '#666' }}>
         <p>Debugging Tips:</p>
         <ul style={{ paddingLeft: '20px' }}>
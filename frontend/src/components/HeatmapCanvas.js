@@ -0,0 +1,62 @@
+import React, { useState, useEffect, useRef } from 'react';
+import { fetchHeatmapGrid, drawHeatmapGrid } from '../utils/heatmapGrid';
+
+/**
+ * Heatmap colorized in the browser from the session's raw density grid.
+ * Changing the palette redraws locally; only session, type and quality refetch.
+ */
+const HeatmapCanvas = ({ sessionId, type = 'gaze', quality = 'medium', palette = 'heat', className, style }) => {
+  const canvasRef = useRef(null);
+  const [grid, setGrid] = useState(null);
+  const [error, setError] = useState(null);
+
+  useEffect(() => {
+    let cancelled = false;
+    setGrid(null);
+    setError(null);
+    fetchHeatmapGrid(sessionId, { type, quality })
+      .then((result) => {
+        if (!cancelled) setGrid(result);
+      })
+      .catch((err) => {
+        console.error('Error fetching heatmap grid:', err);
+        if (!cancelled) setError(err.response?.status === 404 ? `No ${type} data` : err.message);
+      });
+    return () => {
+      cancelled = true;
+    };
+  }, [sessionId, type, quality]);
+
+  useEffect(() => {
+    if (grid && canvasRef.current) {
+      drawHeatmapGrid(canvasRef.current, grid, palette);
+    }
+  }, [grid, palette]);
+
+  if (error) {
+    return <div className={className} style={{ color: '#c62828', ...style }}>{error}</div>;
+  }
+
+  // The grid's last row/column can reach past the screen edge; crop it with the wrapper
+  const overflowX = grid ? (grid.cols * grid.scale) / grid.width : 1;
+  const overflowY = grid ? (grid.rows * grid.scale) / grid.height : 1;
+  return (
+    <div
+      className={className}
+      style={{
+        position: 'relative',
+        overflow: 'hidden',
+        aspectRatio: grid ? `${grid.width} / ${grid.height}` : '16 / 9',
+        ...style
+      }}
+    >
+      <canvas
+        ref={canvasRef}
+        style={{ position: 'absolute', left: 0, top: 0, width: `${overflowX * 100}%`, height: `${overflowY * 100}%` }}
+      />
+      {!grid && <p style={{ position: 'absolute', margin: '8px', color: '#666' }}>Loading...</p>}
+    </div>
+  );
+};
+
+export default HeatmapCanvas;
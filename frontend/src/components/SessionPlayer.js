@@ -50,7 +50,8 @@ const SessionPlayerComponent = ({
   const [hasMoreData, setHasMoreData] = useState(true);
   const [currentBatch, setCurrentBatch] = useState(0);
   const [canvasDimensions, setCanvasDimensions] = useState({ width: 1920, height: 1080 });
-  const BATCH_SIZE = 1000;
+  const [activity, setActivity] = useState(null);  // Samples per time bucket from /timeline
+  const BATCH_SIZE = 5000;
   
   const canvasRef = useRef(null);
   const gazeHeatmapCanvasRef = useRef(null);
@@ -58,6 +59,7 @@ const SessionPlayerComponent = ({
   const canvasContainerRef = useRef(null);
   const animationFrameRef = useRef(null);
   const startTimeRef = useRef(null);
+  const nextGazePageRef = useRef(null);  // Continuation token from the X-Next-Page header
   const lastFrameTimeRef = useRef(null);
   const videoRef = useRef(null);
   
@@ -103,6 +105,18 @@ const SessionPlayerComponent = ({
     }
   }, [sessionId, videoUrl, compact]);
   
+  // Fetch the per-bucket sample counts drawn behind the progress bar
+  useEffect(() => {
+    if (!sessionId || compact) return;
+    let cancelled = false;
+    api.get(`/api/sessions/${sessionId}/timeline?type=gaze`)
+      .then(response => {
+        if (!cancelled) setActivity(response.data);
+      })
+      .catch(err => console.warn('Timeline not available:', err));
+    return () => { cancelled = true; };
+  }, [sessionId, compact]);
+  
   // Handle resizing of canvas container
   useEffect(() => {
     const updateCanvasDimensions = () => {
@@ -324,6 +338,7 @@ const SessionPlayerComponent = ({
             
             sessionData = sessionResponse.data;
             initialGazeData = gazeResponse.data;
+            nextGazePageRef.current = gazeResponse.headers?.['x-next-page'] || null;
             
             // Make sure cursor data is an array
             initialCursorData = [];
@@ -351,8 +366,8 @@ const SessionPlayerComponent = ({
           console.log(`Setting cursor data: ${initialCursorData.length} points`);
           console.log(`Cursor data is array: ${Array.isArray(initialCursorData)}`);
           
-          // Set hasMoreData based on returned data size
-          setHasMoreData(initialGazeData.length === BATCH_SIZE);
+          // Set hasMoreData from the continuation token, or the returned data size for preloaded data
+          setHasMoreData(nextGazePageRef.current ? true : initialGazeData.length === BATCH_SIZE);
           setCurrentBatch(1);  // We've loaded the first batch
           
           // Calculate duration based on last data point
@@ -1184,17 +1199,21 @@ const SessionPlayerComponent = ({
     
     try {
       const nextBatch = currentBatch + 1;
-      const offset = nextBatch * BATCH_SIZE;
+      // Continue from the last page's key when we have a token, so later pages stay cheap
+      const page = nextGazePageRef.current
+        ? `after=${encodeURIComponent(nextGazePageRef.current)}`
+        : `offset=${gazeData.length}`;
       
-      const response = await api.get(`/api/sessions/${sessionId}/gaze?offset=${offset}&limit=${BATCH_SIZE}`);
+      const response = await api.get(`/api/sessions/${sessionId}/gaze?${page}&limit=${BATCH_SIZE}`);
       
-      const newPoints = response.data.points || [];
-      console.log(`Loaded ${newPoints.length} more points from offset ${offset}`);
+      const newPoints = Array.isArray(response.data) ? response.data : (response.data.points || []);
+      nextGazePageRef.current = response.headers?.['x-next-page'] || null;
+      console.log(`Loaded ${newPoints.length} more points (batch ${nextBatch})`);
       
       if (newPoints.length > 0) {
         setGazeData(prev => [...prev, ...newPoints]);
         setCurrentBatch(nextBatch);
-        setHasMoreData(newPoints.length === BATCH_SIZE);
+        setHasMoreData(Boolean(nextGazePageRef.current));
       } else {
         setHasMoreData(false);
       }
@@ -1471,6 +1490,25 @@ const SessionPlayerComponent = ({
             </button> */}
           </div>
           
+          {activity && activity.buckets.length > 0 && duration > 0 && (
+            <div className="activity-timeline" onClick={handleTimelineClick} title="Gaze samples over time">
+              {(() => {
+                const peak = Math.max(...activity.buckets.map(bucket => bucket.count));
+                return activity.buckets.map(bucket => (
+                  <div
+                    key={bucket.start_time}
+                    className="activity-bar"
+                    style={{
+                      left: `${Math.max(0, (bucket.start_time - activity.start_time) / duration * 100)}%`,
+                      width: `${Math.max(0.2, activity.bucket_ms / duration * 100)}%`,
+                      height: `${Math.max(4, bucket.count / peak * 100)}%`
+                    }}
+                  ></div>
+                ));
+              })()}
+            </div>
+          )}
+          
           <div className="progress-container">
             <div className="time-display">{formatTime(currentTime)}</div>
             <div 
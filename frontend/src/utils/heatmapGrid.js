@@ -0,0 +1,138 @@
+// Client side of the raw density grid format (GET /api/sessions/:id/heatmap?format=grid,
+// see backend/app/rawgrid.py), so heatmaps can be colorized and recolored in the browser
+import api from './api';
+
+const GRID_MAGIC = 'HGG1';
+const HEADER_SIZE = 32;
+const DTYPE_UINT8 = 1;
+const DTYPE_FLOAT16 = 2;
+const FLAG_ZLIB = 1;
+
+// Color stops as RGBA in [0, 1], evenly spaced from 0 to 1. "heat" matches the server's PNGs.
+export const HEATMAP_PALETTES = {
+  heat: [[0, 0, 0, 0], [0, 0, 1, 0.3], [0, 1, 1, 0.5], [0, 1, 0, 0.7], [1, 1, 0, 0.8], [1, 0, 0, 0.9]],
+  viridis: [[0.27, 0, 0.33, 0], [0.23, 0.32, 0.55, 0.5], [0.13, 0.57, 0.55, 0.7], [0.37, 0.79, 0.38, 0.8], [0.99, 0.91, 0.14, 0.9]],
+  grayscale: [[0, 0, 0, 0], [1, 1, 1, 0.9]]
+};
+
+const canInflate = typeof DecompressionStream !== 'undefined';
+
+/**
+ * Decode a half-precision float
+ * @param {number} bits - The 16 bits of the value
+ * @returns {number} The value
+ */
+const float16 = (bits) => {
+  const exponent = (bits >> 10) & 0x1f;
+  const fraction = bits & 0x3ff;
+  const sign = bits & 0x8000 ? -1 : 1;
+  if (exponent === 0) return sign * fraction * 2 ** -24;
+  if (exponent === 0x1f) return fraction ? NaN : sign * Infinity;
+  return sign * (1 + fraction / 1024) * 2 ** (exponent - 15);
+};
+
+/**
+ * Inflate a zlib stream with the browser's DecompressionStream
+ * @param {ArrayBuffer} buffer - Compressed bytes
+ * @returns {Promise<ArrayBuffer>} The inflated bytes
+ */
+const inflate = async (buffer) => {
+  const stream = new Blob([buffer]).stream().pipeThrough(new DecompressionStream('deflate'));
+  return new Response(stream).arrayBuffer();
+};
+
+/**
+ * Parse a grid response body
+ * @param {ArrayBuffer} buffer - The response body
+ * @returns {Promise<Object>} { rows, cols, scale, width, height, points, values: Float32Array of 0..1 }
+ */
+export const parseHeatmapGrid = async (buffer) => {
+  const view = new DataView(buffer);
+  const magic = String.fromCharCode(...new Uint8Array(buffer, 0, 4));
+  if (buffer.byteLength < HEADER_SIZE || magic !== GRID_MAGIC) {
+    throw new Error('Not a heatmap grid response');
+  }
+  const dtype = view.getUint8(4);
+  const flags = view.getUint8(5);
+  const [rows, cols, scale, width, height, points] = [8, 12, 16, 20, 24, 28].map((offset) => view.getUint32(offset, true));
+
+  let body = buffer.slice(HEADER_SIZE);
+  if (flags & FLAG_ZLIB) {
+    body = await inflate(body);
+  }
+
+  const count = rows * cols;
+  const values = new Float32Array(count);
+  if (dtype === DTYPE_UINT8) {
+    const cells = new Uint8Array(body, 0, count);
+    for (let i = 0; i < count; i++) values[i] = cells[i] / 255;
+  } else if (dtype === DTYPE_FLOAT16) {
+    const cells = new DataView(body);
+    for (let i = 0; i < count; i++) values[i] = float16(cells.getUint16(i * 2, true));
+  } else {
+    throw new Error(`Unknown grid cell type ${dtype}`);
+  }
+  return { rows, cols, scale, width, height, points, values };
+};
+
+/**
+ * Fetch a session's density grid
+ * @param {string|number} sessionId - Session ID
+ * @param {Object} options - { type: 'gaze' | 'cursor', quality, dtype: 'uint8' | 'float16' }
+ * @returns {Promise<Object>} The parsed grid (see parseHeatmapGrid)
+ */
+export const fetchHeatmapGrid = async (sessionId, { type = 'gaze', quality = 'medium', dtype = 'uint8' } = {}) => {
+  const response = await api.get(`/api/sessions/${sessionId}/heatmap`, {
+    params: { format: 'grid', type, quality, dtype, compress: canInflate },
+    responseType: 'arraybuffer'
+  });
+  return parseHeatmapGrid(response.data);
+};
+
+const lutCache = {};
+
+/**
+ * 256-entry RGBA lookup table interpolated between a palette's color stops
+ * @param {string} palette - Key of HEATMAP_PALETTES
+ * @returns {Uint8ClampedArray} 256 * 4 bytes
+ */
+export const colormapLut = (palette = 'heat') => {
+  if (lutCache[palette]) return lutCache[palette];
+  const stops = HEATMAP_PALETTES[palette] || HEATMAP_PALETTES.heat;
+  const lut = new Uint8ClampedArray(256 * 4);
+  for (let i = 0; i < 256; i++) {
+    const position = (i / 255) * (stops.length - 1);
+    const low = Math.min(Math.floor(position), stops.length - 2);
+    const t = position - low;
+    for (let channel = 0; channel < 4; channel++) {
+      const value = stops[low][channel] + (stops[low + 1][channel] - stops[low][channel]) * t;
+      lut[i * 4 + channel] = Math.floor(value * 255);
+    }
+  }
+  lutCache[palette] = lut;
+  return lut;
+};
+
+/**
+ * Draw a grid onto a canvas, one canvas pixel per cell (scale it up with CSS)
+ * @param {HTMLCanvasElement} canvas - Target canvas
+ * @param {Object} grid - A parsed grid
+ * @param {string} palette - Key of HEATMAP_PALETTES
+ */
+export const drawHeatmapGrid = (canvas, grid, palette = 'heat') => {
+  const lut = colormapLut(palette);
+  canvas.width = grid.cols;
+  canvas.height = grid.rows;
+  const context = canvas.getContext('2d');
+  const image = context.createImageData(grid.cols, grid.rows);
+  const pixels = image.data;
+  const { values } = grid;
+  for (let i = 0; i < values.length; i++) {
+    const index = Math.min(255, Math.floor(values[i] * 256)) * 4;
+    pixels[i * 4] = lut[index];
+    pixels[i * 4 + 1] = lut[index + 1];
+    pixels[i * 4 + 2] = lut[index + 2];
+    pixels[i * 4 + 3] = lut[index + 3];
+  }
+  context.putImageData(image, 0, 0);
+};